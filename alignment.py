@@ -0,0 +1,215 @@
+import numpy as np
+import shapes
+from waves import MAX_TONES, WaveGenerator
+
+# Signal parameters stored for every rig in a parameter snapshot
+RIG_FIELDS = ('vmulti', 'freq', 'camber', 'zphase', 'zcoeff', 'phase')
+SNAPSHOT_VERSION = 2  # Version 1 snapshots have no shape and tone fields
+
+
+def snapshot_dtype(n_rigs, version=SNAPSHOT_VERSION):
+    """The numpy record type of one parameter snapshot, i.e. the parameters a chunk of output was generated with.
+
+    Args:
+        n_rigs (int): number of coil systems driven by the SignalWriter
+        version (int): the version of the snapshots, e.g. from the header of an older parameter log
+
+    Returns:
+        a numpy dtype with the fields
+            sample_index: index of the first sample of the chunk, counted from the first start of the writer
+            time: time in s of the first sample on the shared clock (the reader's sample clock)
+            monotonic_ns: time.monotonic_ns() when the chunk was generated
+            funcg_rate: the write rate of the chunk
+            calib_mode: whether the calibration waves were generated
+            vmulti, freq, camber, zphase, zcoeff, phase: one value per rig, phase being the phase of the wave at the
+                first sample of the chunk
+            shape: name of the field shape, see shapes.py
+            shape_parameters: values of the shape's parameters in the order of their sorted names, padded with zeros
+                to shapes.MAX_PARAMETERS
+            n_tones: number of multi-tone components, 0 for a single tone
+            tones: the (weight, frequency, camber, zphase) of each component, padded with zeros to waves.MAX_TONES
+            tone_phase: the phase of each component at the first sample of the chunk, padded like tones
+    """
+    fields = [
+        ('sample_index', np.int64),
+        ('time', np.float64),
+        ('monotonic_ns', np.int64),
+        ('funcg_rate', np.float64),
+        ('calib_mode', np.bool_),
+    ] + [(name, np.float64, (n_rigs,)) for name in RIG_FIELDS]
+    if version >= 2:
+        fields += [
+            ('shape', 'U32'),
+            ('shape_parameters', np.float64, (shapes.MAX_PARAMETERS,)),
+            ('n_tones', np.int16),
+            ('tones', np.float64, (MAX_TONES, 4)),
+            ('tone_phase', np.float64, (MAX_TONES,)),
+        ]
+    return np.dtype(fields)
+
+
+def shape_fields(shape, parameters):
+    """The shape fields of a snapshot for a shape and the values of its parameters, see snapshot_dtype."""
+    values = np.zeros(shapes.MAX_PARAMETERS)
+    defaults = shapes.get(shape).parameters
+    for i, name in enumerate(sorted(defaults)):
+        values[i] = parameters.get(name, defaults[name])
+    return {'shape': shape, 'shape_parameters': values}
+
+
+def tone_fields(tones, tone_phase):
+    """The tone fields of a snapshot for the tones (None for a single tone) and their phases, see snapshot_dtype."""
+    padded, phases = np.zeros([MAX_TONES, 4]), np.zeros(MAX_TONES)
+    n_tones = 0 if tones is None else len(tones)
+    if n_tones:
+        padded[:n_tones] = tones
+        if np.shape(tone_phase) == (n_tones,):  # Otherwise the tones just changed and start at a phase of 0
+            phases[:n_tones] = tone_phase
+    return {'n_tones': n_tones, 'tones': padded, 'tone_phase': phases}
+
+
+class ParameterHistory:
+    """A preallocated ring buffer of the parameter snapshots of the most recent output chunks.
+
+    The SignalWriter appends one snapshot per chunk. Since the snapshots are stamped with the time of their first
+    sample on the reader's sample clock, the parameters in effect at any acquired sample can be found with a binary
+    search.
+
+    Attributes:
+        records (ndarray): the ring buffer of snapshots, see snapshot_dtype
+        capacity (int): number of snapshots kept
+        count (int): total number of snapshots appended so far
+    """
+    def __init__(self, n_rigs, capacity=8192):
+        self.records = np.zeros(capacity, dtype=snapshot_dtype(n_rigs))
+        self.capacity = capacity
+        self.count = 0
+
+    def append(self, **fields):
+        """Store a snapshot, overwriting the oldest once the buffer is full.
+
+        Args:
+            **fields: a value for each field of snapshot_dtype
+        """
+        position = self.count % self.capacity
+        for name, value in fields.items():
+            self.records[name][position] = value
+        self.count += 1
+
+    def truncate(self, sample_index):
+        """Forget the newest snapshots of chunks starting at or after sample_index, e.g. chunks that were queued but
+        dropped before they were generated. Keeps the times in the buffer sorted for the next arm."""
+        while self.count > 0 and self.records['sample_index'][(self.count - 1) % self.capacity] >= sample_index:
+            self.count -= 1
+
+    def ordered(self):
+        """Return a copy of the stored snapshots from oldest to newest."""
+        if self.count <= self.capacity:
+            return self.records[:self.count].copy()
+        split = self.count % self.capacity
+        return np.concatenate((self.records[split:], self.records[:split]))
+
+    def lookup_time(self, times):
+        """Find the snapshots in effect at the given times on the shared clock.
+
+        Args:
+            times: a time or an array of times in s
+
+        Returns:
+            the matching records, and the offset in samples of each time from the start of its chunk. Times before
+            the oldest stored snapshot map to the oldest snapshot with a negative offset.
+        """
+        n = min(self.count, self.capacity)
+        if n == 0:
+            raise LookupError('No parameter snapshots have been recorded yet.')
+        split = self.count % self.capacity if self.count > self.capacity else 0
+        time_column = self.records['time']
+        ordered_times = np.concatenate((time_column[split:n], time_column[:split]))
+
+        index = np.clip(np.searchsorted(ordered_times, times, side='right') - 1, 0, n - 1)
+        records = self.records[(index + split) % self.capacity]
+        offsets = np.around((np.asarray(times) - records['time']) * records['funcg_rate']).astype(np.int64)
+        return records, offsets
+
+    def lookup_read_index(self, read_indices, daq_rate):
+        """Find the snapshots in effect at the given sample indices of the reader, see lookup_time."""
+        return self.lookup_time(np.asarray(read_indices) / daq_rate)
+
+
+def reconstruct_commanded(record, offset, n_samples, rig=0):
+    """Regenerate the field commanded from a snapshot, e.g. to compare with the acquired signal.
+
+    The field shape and its parameters are looked up in shapes.py by the name in the snapshot, so custom shapes must
+    be registered as they were when the snapshot was taken. Version 1 snapshots are rebuilt as a rotating field.
+
+    Args:
+        record: a snapshot from ParameterHistory
+        offset (int): first sample to regenerate, counted from the start of the snapshot's chunk
+        n_samples (int): number of samples to regenerate
+        rig (int): index of the rig
+
+    Returns:
+        a [3, n_samples] array of the x, y and z field at the write rate of the snapshot
+    """
+    WaveGen = WaveGenerator()
+    rate = record['funcg_rate']
+    shape, parameters, n_tones = 'Rotating', {}, 0
+    if 'shape' in record.dtype.names:
+        shape, n_tones = str(record['shape']), int(record['n_tones'])
+        parameters = dict(zip(sorted(shapes.get(shape).parameters), record['shape_parameters']))
+
+    if n_tones:
+        tones = record['tones'][:n_tones]
+        WaveGen.tone_phase = (record['tone_phase'][:n_tones] + 2 * np.pi * tones[:, 1] * offset / rate) % (2 * np.pi)
+        return WaveGen.generate_multitone_field(rate, n_samples, record['vmulti'][rig], tones, shape, parameters)
+    WaveGen.phase = (record['phase'][rig] + 2 * np.pi * record['freq'][rig] * offset / rate) % (2 * np.pi)
+    return WaveGen.generate_field(rate, n_samples, record['vmulti'][rig], record['freq'][rig],
+                                  record['camber'][rig], record['zphase'][rig], shape, parameters)
+
+
+def estimate_lag(commanded, measured, rate):
+    """Estimate how far the measured signal lags behind the commanded signal by cross-correlation.
+
+    Both signals must be sampled at the same rate. The correlation peak is refined with a parabolic fit, so the lag
+    is resolved to a fraction of a sample.
+
+    Args:
+        commanded: 1D array of the commanded signal
+        measured: 1D array of the measured signal, same length
+        rate: sample rate of both signals in samples/s
+
+    Returns:
+        the lag in s, positive when the measured signal is late
+    """
+    commanded = commanded - np.mean(commanded)
+    measured = measured - np.mean(measured)
+    n = len(commanded)
+    size = 1 << int(np.ceil(np.log2(2 * n)))
+    correlation = np.fft.irfft(np.fft.rfft(measured, size) * np.conj(np.fft.rfft(commanded, size)), size)
+    correlation = np.concatenate((correlation[-(n - 1):], correlation[:n]))  # lags -(n-1) .. n-1
+
+    peak = int(np.argmax(correlation))
+    shift = 0.0
+    if 0 < peak < len(correlation) - 1:
+        left, centre, right = correlation[peak - 1:peak + 2]
+        denominator = left - 2 * centre + right
+        if denominator != 0:
+            shift = 0.5 * (left - right) / denominator
+    return (peak - (n - 1) + shift) / rate
+
+
+def phase_error(commanded, measured, freq, rate):
+    """Phase of the measured signal relative to the commanded signal at the frequency `freq`.
+
+    Args:
+        commanded: 1D array of the commanded signal
+        measured: 1D array of the measured signal, same length and rate
+        freq: frequency in Hz to compare at, usually the commanded field frequency
+        rate: sample rate of both signals in samples/s
+
+    Returns:
+        the phase error in degrees, wrapped to [-180, 180), negative when the measured signal lags
+    """
+    reference = np.exp(-2j * np.pi * freq * np.arange(len(commanded)) / rate)
+    difference = np.angle(np.dot(measured, reference)) - np.angle(np.dot(commanded, reference))
+    return (np.degrees(difference) + 180) % 360 - 180
@@ -0,0 +1,201 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from alignment import snapshot_dtype
+from eventlog import ParameterLogReader
+from recording import open_session
+
+MAGIC = b'MUCTLARC'
+SUFFIX = '.mca'
+FOOTER = struct.Struct('<QQQ8s')  # Offsets of the block index, the parameter records and the JSON header, MAGIC
+INDEX_DTYPE = np.dtype([('sample', '<i8'), ('offset', '<i8'), ('size', '<i8')])
+
+
+def compress_block(block, level=1):
+    """Compress a [samples, channels] float64 block. The bytes are shuffled (all first bytes of the values, then all
+    second bytes, ...) so the slowly changing sign and exponent bytes end up next to each other."""
+    raw = np.ascontiguousarray(block, dtype='<f8').view(np.uint8).reshape(-1, 8)
+    return zlib.compress(np.ascontiguousarray(raw.T).tobytes(), level)
+
+
+def decompress_block(buffer, channels):
+    """Undo compress_block, returning a [samples, channels] array."""
+    shuffled = np.frombuffer(zlib.decompress(buffer), dtype=np.uint8).reshape(8, -1)
+    return np.ascontiguousarray(shuffled.T).view('<f8').reshape(-1, channels)
+
+
+def convert_session(path, archive_path, event_log=None, block_samples=65536, workers=None, level=1):
+    """Convert a recorded session (see recording.py) into an archive, see SessionArchive.
+
+    The blocks are compressed on a thread pool (zlib releases the GIL), with a bounded number of blocks in flight so
+    memory use does not grow with the length of the recording, and written in order.
+
+    Args:
+        path (str): the recorded session
+        archive_path (str): the archive to write
+        event_log (str): optional ParameterLog file of the same session, its records are stored in the archive
+        block_samples (int): samples per channel in one compressed block
+        workers (int): threads compressing blocks, None for the ThreadPoolExecutor default
+        level (int): zlib compression level
+
+    Returns:
+        the header of the archive
+    """
+    data, info = open_session(path)
+    workers = workers or os.cpu_count() or 1
+    records, events_header = None, None
+    if event_log is not None:
+        log = ParameterLogReader(event_log)
+        records, events_header = np.array(log.records), log.header
+
+    with ThreadPoolExecutor(max_workers=workers) as pool, open(archive_path, 'wb') as f:
+        f.write(MAGIC)
+        index = np.zeros(-(-len(data) // block_samples), dtype=INDEX_DTYPE)
+        in_flight = deque()
+        starts = iter(range(0, len(data), block_samples))
+        for block, start in enumerate(range(0, len(data), block_samples)):
+            while len(in_flight) < 2 * workers:
+                queued = next(starts, None)
+                if queued is None:
+                    break
+                in_flight.append(pool.submit(compress_block, data[queued:queued + block_samples], level))
+            compressed = in_flight.popleft().result()
+            index[block] = (start, f.tell(), len(compressed))
+            f.write(compressed)
+
+        index_offset = f.tell()
+        f.write(index.tobytes())
+        events_offset = f.tell()
+        if records is not None:
+            f.write(records.tobytes())
+        header = {'version': 1, 'daq_rate': info['daq_rate'], 'channels': info.get('channels'),
+                  'n_channels': data.shape[1], 'dtype': '<f8', 'samples': len(data),
+                  'first_index': info.get('first_index') or 0, 'block_samples': block_samples, 'blocks': len(index),
+                  'codec': 'zlib-shuffle', 'events': 0 if records is None else len(records),
+                  'events_header': events_header}
+        header_offset = f.tell()
+        f.write(json.dumps(header).encode())
+        f.write(FOOTER.pack(index_offset, events_offset, header_offset, MAGIC))
+    return header
+
+
+class SessionArchive:
+    """Random access to an archived session: compressed blocks of samples, a block index and the parameter records.
+
+    The file starts with MAGIC, followed by the compressed blocks of *block_samples* samples of all channels, the
+    block index (sample, offset and size of every block), the ParameterLog records of the session, a JSON header and
+    the FOOTER. The file is memory-mapped and only the blocks overlapping a requested window are decompressed, so
+    reading a window costs the same anywhere in a recording of any length. The last few decompressed blocks are
+    cached for sequential reads.
+
+    Slicing the archive like an array, archive[start:stop], returns a [samples, channels] array, so it can stand in
+    for the memory-mapped raw recording, e.g. in ReplaySource.
+
+    Attributes:
+        header (dict): the JSON header, see convert_session
+        daq_rate (int): sample rate of the session
+        channels (list): names of the recorded channels
+        n_channels (int): number of recorded channels
+        index (ndarray): the block index, see INDEX_DTYPE
+        events (ndarray): the parameter records, see alignment.snapshot_dtype, empty without a parameter log
+    """
+    def __init__(self, path, cache_blocks=4):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, events_offset, header_offset, magic = FOOTER.unpack(self.map[-FOOTER.size:])
+        if self.map[:len(MAGIC)] != MAGIC or magic != MAGIC:
+            raise ValueError(f'{path} is not a session archive')
+        self.header = json.loads(self.map[header_offset:len(self.map) - FOOTER.size].decode())
+        self.daq_rate = self.header['daq_rate']
+        self.block_samples = self.header['block_samples']
+        self.n_channels = self.header['n_channels']
+        self.index = np.frombuffer(self.map, dtype=INDEX_DTYPE, count=self.header['blocks'], offset=index_offset)
+        if self.header['events']:
+            events_header = self.header['events_header']
+            dtype = snapshot_dtype(events_header['n_rigs'], events_header.get('version', 1))
+            self.events = np.frombuffer(self.map, dtype=dtype, count=self.header['events'], offset=events_offset)
+        else:
+            self.events = np.zeros(0, dtype=snapshot_dtype(1))
+        self.channels = self.header['channels'] or []
+        self.cache = OrderedDict()
+        self.cache_blocks = cache_blocks
+
+    def __len__(self):
+        return self.header['samples']
+
+    @property
+    def shape(self):
+        return len(self), self.n_channels
+
+    def block(self, number):
+        """The decompressed block with the given number."""
+        if number in self.cache:
+            self.cache.move_to_end(number)
+            return self.cache[number]
+        _, offset, size = self.index[number]
+        block = decompress_block(self.map[offset:offset + size], self.n_channels)
+        self.cache[number] = block
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return block
+
+    def read(self, start, stop):
+        """Samples start to stop as a [samples, channels] array."""
+        start, stop = max(start, 0), min(stop, len(self))
+        if stop <= start:
+            return np.zeros([0, self.n_channels])
+        first, last = start // self.block_samples, (stop - 1) // self.block_samples
+        window = np.concatenate([self.block(number) for number in range(first, last + 1)])
+        offset = first * self.block_samples
+        return window[start - offset:stop - offset]
+
+    def read_time(self, start, stop):
+        """The samples between two times in s from the start of the recording."""
+        return self.read(int(round(start * self.daq_rate)), int(round(stop * self.daq_rate)))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, _ = key.indices(len(self))
+            return self.read(start, stop)
+        if isinstance(key, (int, np.integer)):
+            key = key + len(self) if key < 0 else key
+            return self.read(key, key + 1)[0]
+        raise IndexError('Session archives only support slices with a step of 1 and integer indices')
+
+    def parameters_at(self, samples):
+        """The parameter records in effect at the given samples of the recording.
+
+        The records are stamped with the time on the reader's clock, which the recording joined at its first_index.
+
+        Returns:
+            the matching records, samples before the first record map to the first record
+        """
+        if len(self.events) == 0:
+            raise LookupError('The archive holds no parameter records.')
+        times = (np.asarray(samples) + self.header['first_index']) / self.daq_rate
+        positions = np.clip(np.searchsorted(self.events['time'], times, side='right') - 1, 0, None)
+        return self.events[positions]
+
+    def close(self):
+        self.cache.clear()
+        self.index = self.events = None  # Release the views before the map
+        self.map.close()
+        self.file.close()
+
+
+def open_archive(path):
+    """Open an archive like recording.open_session opens a raw recording.
+
+    Returns:
+        data: a SessionArchive, sliced like a [samples, channels] array, info: dictionary with 'daq_rate' and
+        'channels'
+    """
+    archive = SessionArchive(path)
+    channels = archive.channels or [f'ai{i}' for i in range(archive.n_channels)]
+    return archive, {'daq_rate': archive.daq_rate, 'channels': channels}
@@ -0,0 +1,117 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+from pyqtgraph.Qt import QtCore
+
+
+class TriggeredCapture(QtCore.QObject):
+    """Captures full-rate acquisition windows around events, with history from before the event.
+
+    The full-rate stream (AcquisitionPipeline.newFullRate) is kept in a preallocated ring buffer holding a little more
+    than the pre- and post-trigger windows. On a trigger, the window from *pre* seconds before to *post* seconds
+    after the trigger is copied out of the ring once the post-trigger samples have arrived, and written to disk on a
+    background thread as a [channels, samples] .npy file with a JSON sidecar describing the event.
+
+    Triggers come from the main window (output and swarm toggles), the command API, or a threshold crossing on one
+    of the channels, which is checked on every chunk.
+
+    Attributes:
+        daq_rate (int): rate of the stream
+        pre, post (float): length in s of the windows before and after a trigger
+        folder (str): where the captures are written
+        threshold_channel (int): channel watched for threshold crossings, None to not watch any
+        threshold_level (float): a rising crossing of this level triggers a capture
+        latest_index (int): sample index of the end of the newest chunk
+        pending (list): (trigger index, reason) of the captures waiting for their post-trigger samples
+        captures (int): number of captures written
+    """
+    captureWritten = QtCore.pyqtSignal(object)  # Path of a written capture
+
+    def __init__(self, daq_rate, pre=0.5, post=1.0, folder='', threshold_channel=None, threshold_level=1.0):
+        super().__init__()
+        self.daq_rate = daq_rate
+        self.pre = pre
+        self.post = post
+        self.folder = folder
+        self.threshold_channel = threshold_channel
+        self.threshold_level = threshold_level
+        self.ring = None  # Allocated with the first chunk, once the number of channels is known
+        self.latest_index = 0
+        self.pending = []
+        self.holdoff_until = 0  # Threshold crossings before this sample index don't trigger
+        self.last_sample = None  # Last sample of the threshold channel, to find crossings at chunk boundaries
+        self.captures = 0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def pre_samples(self):
+        return int(self.pre * self.daq_rate)
+
+    @property
+    def post_samples(self):
+        return int(self.post * self.daq_rate)
+
+    def trigger(self, reason, sample_index=None):
+        """Capture the window around a sample, by default the newest one. Safe to call from any thread."""
+        self.pending.append((self.latest_index if sample_index is None else sample_index, reason))
+
+    def process(self, start_index, chunk):
+        """Slot for the full-rate stream, store the chunk and complete the captures whose window is available."""
+        n_channels, n = chunk.shape
+        if self.ring is None or self.ring.shape[0] != n_channels or self.ring.shape[1] < self.pre_samples + \
+                self.post_samples + 2 * n:
+            self.ring = np.zeros([n_channels, self.pre_samples + self.post_samples + 4 * n])
+        capacity = self.ring.shape[1]
+        positions = np.arange(start_index, start_index + n) % capacity
+        self.ring[:, positions] = chunk
+        self.latest_index = start_index + n
+
+        if self.threshold_channel is not None and self.threshold_channel < n_channels:
+            self.check_threshold(start_index, chunk[self.threshold_channel])
+
+        for trigger_index, reason in list(self.pending):
+            if trigger_index + self.post_samples <= self.latest_index:
+                self.pending.remove((trigger_index, reason))
+                self.complete(trigger_index, reason)
+
+    def check_threshold(self, start_index, channel):
+        """Trigger on rising crossings of the threshold level, at most once per post-trigger window."""
+        previous = channel[0] if self.last_sample is None else self.last_sample
+        values = np.concatenate([[previous], channel])
+        self.last_sample = channel[-1]
+        crossings = np.flatnonzero((values[:-1] < self.threshold_level) & (values[1:] >= self.threshold_level))
+        for crossing in crossings + start_index:
+            if crossing >= self.holdoff_until:
+                self.trigger('threshold', crossing)
+                self.holdoff_until = crossing + self.post_samples
+
+    def complete(self, trigger_index, reason):
+        """Copy a window out of the ring and write it on the background thread."""
+        capacity = self.ring.shape[1]
+        first = max(trigger_index - self.pre_samples, self.latest_index - capacity, 0)
+        last = trigger_index + self.post_samples
+        window = self.ring[:, np.arange(first, last) % capacity]  # Fancy indexing copies
+
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        path = os.path.join(self.folder, f'capture_{stamp}_{reason}.npy')
+        info = {'reason': reason, 'daq_rate': self.daq_rate, 'trigger_index': int(trigger_index),
+                'first_index': int(first), 'pre_samples': int(trigger_index - first), 'post_samples': int(last -
+                                                                                                        trigger_index)}
+        self.executor.submit(self.write, path, window, info)
+
+    def write(self, path, window, info):
+        try:
+            np.save(path, window)
+            with open(path + '.json', 'w') as f:
+                json.dump(info, f)
+        except OSError as e:
+            print(f'Could not write the capture {path}: {e}')
+            return
+        self.captures += 1
+        self.captureWritten.emit(path)
+
+    def close(self):
+        """Wait for the captures being written."""
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,131 @@
+"""Client for the local command API of MuControl (threads/CommandServer.py), and a quick check of its latency.
+
+External programs, e.g. tracking software, steer the swarm by sending batches of commands to the CommandServer on
+localhost. A batch is either one line of JSON
+
+    {"id": 1, "commands": [{"cmd": "heading", "value": 90}, {"cmd": "camber", "value": 45, "rig": 0}]}
+
+where a command may also be written as a list, ["heading", 90] or ["heading", 90, rig], or a binary frame
+
+    BATCH_HEADER (magic, id, number of commands) followed by one COMMAND (opcode, rig, value) per command.
+
+Commands: heading (Z-Phase in °), camber (°), freq (Hz), vmulti (V), zcoeff, swarm (start the swarm mode named by
+"mode", or with the index of SWARM_MODES as value in binary), stop (stop the swarm mode), steering (1 or 0 to turn
+closed-loop steering on or off), waypoints (JSON only, the path for closed-loop steering as [[x, y], ...]), capture
+(save the acquired data around this moment, see capture.py) and delay (run the rest of the batch this many seconds
+after it was received, which turns a batch into a schedule). Without a rig, or with rig 255 in binary, the command
+goes to the rig selected in the parameter tree. Values must be finite numbers and rigs one of the writer's rigs,
+otherwise the batch is refused from that command on.
+
+Every batch is acknowledged, with the time in µs between receiving the batch and applying its last immediate command:
+
+    {"id": 1, "ok": true, "applied": 2, "scheduled": 0, "latency_us": 41.2}
+    or ACK (magic, id, status, applied, latency_us) for binary batches, status 0 meaning ok
+
+Run this file to send a heading sweep and print the acknowledgement latencies:
+
+    python command_client.py --batches 1000 --binary
+"""
+import argparse
+import json
+import socket
+import struct
+import sys
+from time import perf_counter
+import numpy as np
+
+DEFAULT_PORT = 5757
+MAX_LINE = 65536  # Longest JSON batch in bytes
+MAX_COMMANDS = 1024  # Most commands in one batch
+
+BINARY_MAGIC = 0xB5
+BATCH_HEADER = struct.Struct('<BIH')  # magic, batch id, number of commands
+COMMAND = struct.Struct('<BBd')  # opcode, rig (255 = active rig), value
+ACK = struct.Struct('<BIBHf')  # magic, batch id, status, commands applied, latency in µs
+
+# Binary opcodes and the signal parameter (SignalWriter attribute) each one sets
+OPCODES = {1: 'heading', 2: 'camber', 3: 'freq', 4: 'vmulti', 5: 'zcoeff', 16: 'swarm', 17: 'stop', 18: 'steering',
+           19: 'capture', 32: 'delay'}
+PARAMETERS = {'heading': 'zphase', 'camber': 'camber', 'freq': 'freq', 'vmulti': 'vmulti', 'zcoeff': 'zcoeff'}
+SWARM_MODES = ('Rolling', 'Corkscrew', 'Flipping', 'Switchback')
+ACTIVE_RIG = 255
+
+
+class CommandClient:
+    """A blocking client for the CommandServer.
+
+    Args:
+        host (str): address of the server
+        port (int): port of the server
+    """
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT):
+        self.socket = socket.create_connection((host, port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.socket.makefile('rb')
+        self.next_id = 0
+
+    def send_json(self, commands):
+        """Send a JSON batch and wait for its acknowledgement.
+
+        Args:
+            commands (list): command dictionaries or lists, see the module docstring
+
+        Returns:
+            the acknowledgement as a dictionary
+        """
+        self.next_id += 1
+        self.socket.sendall(json.dumps({'id': self.next_id, 'commands': commands}).encode() + b'\n')
+        return json.loads(self.file.readline())
+
+    def send_binary(self, commands):
+        """Send a binary batch and wait for its acknowledgement.
+
+        Args:
+            commands (list): (name, value) or (name, value, rig) tuples, names as in OPCODES
+
+        Returns:
+            the acknowledgement as a dictionary
+        """
+        self.next_id = (self.next_id + 1) % 2 ** 32
+        codes = {name: code for code, name in OPCODES.items()}
+        frame = BATCH_HEADER.pack(BINARY_MAGIC, self.next_id, len(commands)) + b''.join(
+            COMMAND.pack(codes[command[0]], command[2] if len(command) > 2 else ACTIVE_RIG, command[1])
+            for command in commands)
+        self.socket.sendall(frame)
+        _, batch_id, status, applied, latency_us = ACK.unpack(self.file.read(ACK.size))
+        return {'id': batch_id, 'ok': status == 0, 'applied': applied, 'latency_us': latency_us}
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--batches', type=int, default=200, help='number of heading commands to send')
+    parser.add_argument('--binary', action='store_true', help='use binary instead of JSON batches')
+    args = parser.parse_args()
+
+    client = CommandClient(args.host, args.port)
+    acks, round_trips = [], []
+    for i in range(args.batches):
+        heading = (3.6 * i) % 360
+        start = perf_counter()
+        if args.binary:
+            ack = client.send_binary([('heading', heading)])
+        else:
+            ack = client.send_json([['heading', heading]])
+        round_trips.append(perf_counter() - start)
+        acks.append(ack['latency_us'])
+    client.close()
+
+    for name, values in (('server latency [µs]', np.array(acks)), ('round trip [µs]', 1e6 * np.array(round_trips))):
+        print(f'{name}: median {np.median(values):.1f}, p95 {np.percentile(values, 95):.1f}, '
+              f'max {np.max(values):.1f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
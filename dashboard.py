@@ -0,0 +1,122 @@
+from pyqtgraph.Qt import QtCore, QtWidgets
+from time import perf_counter
+from telemetry import RateCounter, DurationCounter, ProcessMonitor
+
+
+class PerformancePanel(QtWidgets.QDockWidget):
+    """A dockable panel in the main window showing the operational telemetry of the application a few times a second.
+
+    All values come from the cumulative counters the threads keep (see telemetry.py). The panel only reads them and
+    works with the difference to its previous reading, so the threads never wait on it.
+
+    Attributes:
+        window: the MyWindow whose threads and plots are monitored
+        refresh_rate (float): updates per second
+    """
+    def __init__(self, window, refresh_rate=4):
+        super().__init__('Performance')
+        self.setObjectName('PerformancePanel')
+        self.window = window
+        self.process = ProcessMonitor()
+
+        # One label per line of telemetry
+        self.rows = ['Writer callbacks', 'Buffer margin', 'Underruns', 'Rigs', 'Reader chunks', 'Signal plot',
+                     '3D plot', 'Spectrum plot', 'Dropped frames', 'Gamepad events', 'Key presses', 'API batches',
+                     'Steering', 'Captures', 'Sweep', 'CPU', 'Memory']
+        self.labels = {}
+        form = QtWidgets.QFormLayout()
+        for row in self.rows:
+            self.labels[row] = QtWidgets.QLabel('-')
+            form.addRow(f'<b>{row}</b>', self.labels[row])
+        box = QtWidgets.QWidget()
+        box.setLayout(form)
+        self.setWidget(box)
+
+        self.previous = {}
+        self.last_update = perf_counter()
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.update_labels)
+        self.timer.start(int(1000 / refresh_rate))
+
+    def delta(self, key, counter):
+        """Return the current and the previous snapshot of a counter and remember the current one."""
+        snapshot = counter.snapshot()
+        previous = self.previous.get(key, snapshot)
+        self.previous[key] = snapshot
+        return snapshot, previous
+
+    def rate(self, key, counter, elapsed):
+        snapshot, previous = self.delta(key, counter)
+        return RateCounter.since(snapshot, previous, elapsed)
+
+    def frame(self, key, counter):
+        snapshot, previous = self.delta(key, counter)
+        mean = DurationCounter.since(snapshot, previous)
+        maximum, counter.maximum = counter.maximum, 0.0
+        return f'{1000 * mean:.1f} ms mean, {1000 * maximum:.1f} ms max'
+
+    def update_labels(self):
+        """Read every counter and refresh the labels. Skipped while the panel is hidden."""
+        if not self.isVisible():
+            return
+        now = perf_counter()
+        elapsed = max(now - self.last_update, 1e-6)
+        self.last_update = now
+        w = self.window
+        text = {}
+
+        writer = w.writeThread
+        if hasattr(writer, 'callback_counter'):
+            rate, jitter = self.rate('writer', writer.callback_counter, elapsed)
+            text['Writer callbacks'] = f'{rate:.1f} /s, jitter {1000 * jitter:.2f} ms'
+            text['Underruns'] = str(writer.underruns)
+            if writer.running and writer.regenerating:
+                state = '' if writer.output_on else 'output off, '
+                text['Buffer margin'] = f'{state}hardware regeneration, {writer.loop_length} sample loop'
+                text['Rigs'] = '<br>'.join(f"{rig['name']}: regenerating" for rig in writer.rig_stats())
+            elif writer.running:
+                rigs = writer.rig_stats()
+                margin = min(rig['buffer_latency'] for rig in rigs)
+                text['Buffer margin'] = f'{1000 * margin:.1f} ms ({margin * writer.funcg_rate:.0f} samples)'
+                text['Rigs'] = '<br>'.join(
+                    f"{rig['name']}: {rig['rate'] / 1000:.1f} kS/s, "
+                    f"latency {1000 * (rig['buffer_latency'] + rig['write_time']):.1f} ms" for rig in rigs)
+            else:
+                text['Buffer margin'] = text['Rigs'] = 'tasks stopped'
+
+        source = getattr(w, 'readThread', writer)  # In debug mode the data generator stands in for the reader
+        if hasattr(source, 'chunk_counter'):
+            rate, jitter = self.rate('reader', source.chunk_counter, elapsed)
+            text['Reader chunks'] = f'{rate:.1f} /s, jitter {1000 * jitter:.2f} ms'
+
+        text['Signal plot'] = self.frame('p1', w.p1.frame_time)
+        text['3D plot'] = self.frame('p2', w.p2.frame_time)
+        text['Spectrum plot'] = self.frame('p3', w.p3.frame_time) if w.p3.running else 'hidden'
+        text['Dropped frames'] = f'signal {w.p1.dropped_frames}, 3D {w.p2.dropped_frames}'
+        text['Gamepad events'] = f"{self.rate('gamepad', w.gamepadThread.event_counter, elapsed)[0]:.1f} /s"
+        text['Key presses'] = f"{self.rate('keys', w.p1.key_counter, elapsed)[0]:.1f} /s"
+        server = getattr(w, 'commandServer', None)
+        if server is not None:
+            rate = self.rate('api', server.batch_counter, elapsed)[0]
+            snapshot, previous = self.delta('api latency', server.ack_latency)
+            text['API batches'] = f'{rate:.1f} /s, ack {1e6 * DurationCounter.since(snapshot, previous):.0f} µs'
+        steering = getattr(w, 'steeringThread', None)
+        if steering is not None:
+            rate = self.rate('steering', steering.update_counter, elapsed)[0]
+            snapshot, previous = self.delta('steering time', steering.update_time)
+            state = 'on' if steering.enabled else 'off'
+            text['Steering'] = f'{state}, {rate:.0f} /s, {1e6 * DurationCounter.since(snapshot, previous):.1f} µs'
+
+        capture = getattr(w, 'capture', None)
+        if capture is not None:
+            text['Captures'] = f'{capture.captures} written, {len(capture.pending)} waiting'
+        sweep = getattr(w, 'sweep', None)
+        if sweep is not None:
+            text['Sweep'] = f'{len(sweep.done)} of {len(sweep)} done, condition {sweep.current}: {sweep.phase}'
+
+        text['CPU'] = f'{self.process.cpu_percent():.0f} %'
+        memory = self.process.memory_mb()
+        text['Memory'] = 'install psutil to show' if memory is None else f'{memory:.0f} MB'
+
+        for row, value in text.items():
+            self.labels[row].setText(value)
@@ -0,0 +1,143 @@
+import json
+import os
+import struct
+import threading
+from time import monotonic_ns, time_ns
+import numpy as np
+from alignment import SNAPSHOT_VERSION, snapshot_dtype
+
+MAGIC = b'MUCTLLOG'
+INDEX_STRIDE = 256  # Records per entry of the sparse time index of ParameterLogReader
+
+
+class ParameterLog:
+    """An append-only binary log of every parameter snapshot the SignalWriter applies.
+
+    The records have the fixed width of snapshot_dtype and are appended to a preallocated ring buffer, which a
+    background thread flushes to the file every *flush_interval* seconds. Appending therefore never touches the disk
+    and never takes a lock: the writer thread is the only one moving `count`, the flush thread the only one moving
+    `flushed`.
+
+    The file starts with MAGIC, the length of a JSON header and the header itself, which holds the number of rigs and
+    the wall clock and monotonic clock at the time the log was opened. The records follow back to back, so the file
+    can be memory-mapped, see ParameterLogReader.
+
+    Attributes:
+        path (str): the log file
+        records (ndarray): the ring buffer, see snapshot_dtype
+        count (int): total number of records appended
+        flushed (int): total number of records written to the file
+        dropped (int): records overwritten before they could be flushed
+    """
+    def __init__(self, path, n_rigs, capacity=4096, flush_interval=0.5):
+        self.path = path
+        self.records = np.zeros(capacity, dtype=snapshot_dtype(n_rigs))
+        self.capacity = capacity
+        self.count = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.flush_interval = flush_interval
+
+        header = json.dumps({'version': SNAPSHOT_VERSION, 'n_rigs': n_rigs, 'wall_ns': time_ns(),
+                             'monotonic_ns': monotonic_ns()}).encode()
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC + struct.pack('<I', len(header)) + header)
+
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.flush_loop, name='ParameterLog', daemon=True)
+        self.thread.start()
+
+    def append(self, **fields):
+        """Append a snapshot, taking the same fields as ParameterHistory.append."""
+        position = self.count % self.capacity
+        for name, value in fields.items():
+            self.records[name][position] = value
+        self.count += 1
+
+    def flush_loop(self):
+        while not self.stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Write the records appended since the last flush."""
+        count = self.count
+        if count - self.flushed > self.capacity:  # The writer lapped the buffer, the oldest records are gone
+            self.dropped += count - self.flushed - self.capacity
+            self.flushed = count - self.capacity
+        start, end = self.flushed % self.capacity, count % self.capacity
+        if count == self.flushed:
+            return
+        if start < end:
+            self.file.write(self.records[start:end].tobytes())
+        else:  # Wrapped around the end of the ring
+            self.file.write(self.records[start:].tobytes())
+            self.file.write(self.records[:end].tobytes())
+        self.file.flush()
+        self.flushed = count
+
+    def close(self):
+        """Stop the flush thread, write the remaining records and close the file."""
+        self.stop.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+
+class ParameterLogReader:
+    """Memory-maps a ParameterLog file to answer "what was the commanded field at time t" queries.
+
+    A sparse index holding the time of every INDEX_STRIDE-th record is kept in memory. A query first searches the
+    index and then only the one block of records it points to, so only a few pages of the file are read.
+
+    Attributes:
+        records (ndarray): the memory-mapped records, see snapshot_dtype
+        header (dict): the header of the file
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a parameter log')
+            length, = struct.unpack('<I', f.read(4))
+            self.header = json.loads(f.read(length).decode())
+        offset = len(MAGIC) + 4 + length
+        dtype = snapshot_dtype(self.header['n_rigs'], self.header.get('version', 1))
+        n = (os.path.getsize(path) - offset) // dtype.itemsize
+        self.records = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(n,))
+        self.index = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def wall_to_monotonic(self, wall_ns):
+        """Convert time.time_ns() values, e.g. the timestamps of a video, to the monotonic clock of the log."""
+        return np.asarray(wall_ns) - self.header['wall_ns'] + self.header['monotonic_ns']
+
+    def lookup(self, times, clock='monotonic_ns'):
+        """Find the records in effect at the given times.
+
+        Args:
+            times: a time or an array of times
+            clock (str): 'monotonic_ns' for time.monotonic_ns() values, 'wall_ns' for time.time_ns() values, or
+                'time' for times in s on the shared clock of the reader
+
+        Returns:
+            the matching records. Times before the first record map to the first record.
+        """
+        if len(self.records) == 0:
+            raise LookupError('The parameter log is empty.')
+        if clock == 'wall_ns':
+            times, clock = self.wall_to_monotonic(times), 'monotonic_ns'
+
+        if clock not in self.index:
+            self.index[clock] = np.array(self.records[clock][::INDEX_STRIDE])
+        blocks = np.clip(np.searchsorted(self.index[clock], times, side='right') - 1, 0, None)
+
+        # Search within the block of each time, the last one may be shorter
+        times = np.atleast_1d(times)
+        positions = np.empty(len(times), dtype=np.int64)
+        for i, (block, t) in enumerate(zip(np.atleast_1d(blocks), times)):
+            start = block * INDEX_STRIDE
+            column = np.array(self.records[clock][start:start + INDEX_STRIDE])
+            positions[i] = start + max(np.searchsorted(column, t, side='right') - 1, 0)
+        records = self.records[positions]
+        return records if np.ndim(blocks) else records[0]
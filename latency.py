@@ -0,0 +1,89 @@
+import numpy as np
+from time import perf_counter
+
+# Stages an input event passes through on its way to the coils, in order
+STAGES = ('input', 'tree', 'change', 'generate', 'output')
+
+probe = None  # The active LatencyProbe, None when latency measurement is off
+
+
+class LatencyProbe:
+    """Timestamps input events at every stage on their way from the keyboard or gamepad to the coils.
+
+    An event is started with begin() where the input arrives, and each later stage calls mark() with its name. Only
+    the first mark of each stage counts, so an event is attributed to the first chunk generated after it was applied.
+    The 'output' stage can't be observed directly, so the SignalWriter estimates when the first sample of that chunk
+    leaves the buffer from the number of samples queued ahead of it.
+
+    The instrumented code checks the module level `probe` before calling in, so measuring costs nothing when it is
+    off.
+
+    Attributes:
+        stamps (ndarray): [capacity, stages] array of perf_counter timestamps, NaN for stages not reached
+        count (int): number of events begun so far
+    """
+    def __init__(self, capacity=4096):
+        self.stamps = np.full([capacity, len(STAGES)], np.nan)
+        self.capacity = capacity
+        self.count = 0
+
+    def begin(self):
+        """Start a new event at the input stage."""
+        row = self.count % self.capacity
+        self.stamps[row] = np.nan
+        self.stamps[row, 0] = perf_counter()
+        self.count += 1
+
+    def mark(self, stage, timestamp=None):
+        """Timestamp the current event at a stage, unless it already passed that stage.
+
+        Args:
+            stage (str): one of STAGES
+            timestamp (float): perf_counter time, defaults to now
+        """
+        if self.count == 0:
+            return
+        row = (self.count - 1) % self.capacity
+        column = STAGES.index(stage)
+        if np.isnan(self.stamps[row, column]):
+            self.stamps[row, column] = perf_counter() if timestamp is None else timestamp
+
+    def pending(self, stage):
+        """Whether the current event reached the stage before `stage` but not `stage` itself."""
+        if self.count == 0:
+            return False
+        row = (self.count - 1) % self.capacity
+        column = STAGES.index(stage)
+        return not np.isnan(self.stamps[row, column - 1]) and np.isnan(self.stamps[row, column])
+
+    def complete(self):
+        """Return the stamps of the events that reached every stage."""
+        stamps = self.stamps[:min(self.count, self.capacity)]
+        return stamps[~np.isnan(stamps).any(axis=1)]
+
+    def report(self, bins=10):
+        """Format a latency histogram of every stage and of the total.
+
+        Args:
+            bins (int): number of histogram bins per stage
+
+        Returns:
+            the report as a string
+        """
+        stamps = self.complete()
+        if len(stamps) == 0:
+            return 'No event reached the coils.'
+
+        lines = [f'{len(stamps)} of {min(self.count, self.capacity)} events reached the coils.']
+        durations = [(f'{STAGES[i - 1]} -> {STAGES[i]}', np.diff(stamps[:, i - 1:i + 1], axis=1)[:, 0])
+                     for i in range(1, len(STAGES))]
+        durations.append(('total', stamps[:, -1] - stamps[:, 0]))
+
+        for name, duration in durations:
+            ms = 1000 * duration
+            lines.append(f'\n{name}: median {np.median(ms):.3f} ms, p95 {np.percentile(ms, 95):.3f} ms, '
+                         f'max {np.max(ms):.3f} ms')
+            counts, edges = np.histogram(ms, bins=bins)
+            for n, low, high in zip(counts, edges[:-1], edges[1:]):
+                lines.append(f'  {low:9.3f} - {high:9.3f} ms | {"#" * int(round(40 * n / counts.max()))} {n}')
+        return '\n'.join(lines)
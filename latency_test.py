@@ -0,0 +1,83 @@
+"""Measure the latency from a gamepad input to a changed field at the coils.
+
+Synthetic gamepad events are injected into a ControllerThread, so they take the same path as a real gamepad:
+ControllerThread -> MyParamTree.on_gamepad_event -> MyWindow.change -> the SignalWriter's buffer -> the DAQ. Every
+stage is timestamped by latency.LatencyProbe and a histogram per stage is printed at the end.
+
+Run it against NI simulated devices (created in NI MAX) to use it in regression testing, e.g.
+
+    python latency_test.py --funcg SimDev1 --daq SimDev2 --events 200 --max-ms 100
+
+The exit code is 1 if the 95th percentile of the total latency exceeds --max-ms.
+"""
+import argparse
+import sys
+from types import SimpleNamespace
+import numpy as np
+from pyqtgraph.Qt import QtCore, QtWidgets
+
+import latency
+from main import MyWindow
+from settings import SettingsWindow
+from threads.Controller import ControllerThread
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--funcg', help='function generator name, defaults to the one in the settings')
+    parser.add_argument('--daq', help='read device name, defaults to the one in the settings')
+    parser.add_argument('--events', type=int, default=100, help='number of input events to inject')
+    parser.add_argument('--interval', type=int, default=100, help='time between events in ms')
+    parser.add_argument('--max-ms', type=float, default=None, help='fail if the p95 total latency is above this')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    app = QtWidgets.QApplication([])
+
+    config = SettingsWindow()
+    if args.daq:
+        config.daq_name = args.daq
+    if args.funcg:
+        config.funcg_name = args.funcg
+        config.rigs[0]['funcg_name'] = args.funcg
+
+    w = MyWindow(config)
+    latency.probe = latency.LatencyProbe(capacity=max(args.events, 1))
+
+    # Inject the events through a controller thread of our own, alternating frequency up (Y) and down (X)
+    controller = ControllerThread(synthetic=True)
+    controller.newGamepadEvent.connect(w.t.on_gamepad_event)
+    controller.start()
+    w.t.setParamValue('Toggle Output', True)
+
+    sent = [0]
+
+    def inject():
+        if sent[0] < args.events:
+            button = 'Y' if sent[0] % 2 == 0 else 'X'
+            controller.injected_events.append(SimpleNamespace(type=4, button=button))
+            sent[0] += 1
+        else:
+            timer.stop()
+            w.t.setParamValue('Toggle Output', False)
+            controller.running = False
+            QtCore.QTimer.singleShot(500, w.close)
+
+    timer = QtCore.QTimer()
+    timer.timeout.connect(inject)
+    QtCore.QTimer.singleShot(1000, lambda: timer.start(args.interval))  # Give the output a second to start
+    app.exec_()
+    controller.wait(1000)
+
+    print(latency.probe.report())
+    stamps = latency.probe.complete()
+    if args.max_ms is not None:
+        if len(stamps) == 0 or 1000 * np.percentile(stamps[:, -1] - stamps[:, 0], 95) > args.max_ms:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
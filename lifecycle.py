@@ -0,0 +1,86 @@
+from time import perf_counter
+from pyqtgraph.Qt import QtCore
+
+
+def sleep_while_running(thread, seconds, step=0.01):
+    """Sleep for up to `seconds` in short steps, returning early once thread.running is False.
+
+    Used by the run loops that pace themselves, so a stop request never waits for a whole chunk or poll interval.
+    """
+    end = perf_counter() + seconds
+    while thread.running:
+        remaining = end - perf_counter()
+        if remaining <= 0:
+            return
+        QtCore.QThread.usleep(int(min(remaining, step) * 1e6))
+
+
+class ThreadLifecycle:
+    """Stops the application's threads in a fixed order, each with a deadline.
+
+    Every thread is registered with a stage and optionally its own stop method, by default running is set to False.
+    Stopping goes stage by stage: the threads of a stage are asked to stop together, then joined with QThread.wait
+    until the shared deadline. The next stage is only asked to stop once the previous one has finished, e.g. the
+    reader keeps acquiring until the writer has ramped the coils down. Threads still running at the deadline are
+    reported, and waited for up to *grace* seconds more before the next stage is stopped, instead of being terminated.
+
+    Threads that need longer to stop register a *stop_time* method, e.g. the writer generates its queued chunks and
+    the ramp-down chunk first. The deadline is extended to the longest stop time of every stage.
+
+    Attributes:
+        entries (list): dictionaries with the 'name', 'thread', 'stage' and 'stop' method of every registered thread
+        stop_time (float): duration in s of the last stop
+    """
+    def __init__(self):
+        self.entries = []
+        self.stop_time = 0.0
+
+    def register(self, name, thread, stage, stop=None, stop_time=None):
+        """Add a thread.
+
+        Args:
+            name (str): shown when the thread misses the deadline
+            thread (QThread): the thread
+            stage (int): threads of lower stages are stopped first
+            stop: method asking the thread to stop without blocking, defaults to setting running to False
+            stop_time: method returning the time in s the thread needs to stop, if that can exceed the deadline
+        """
+        self.unregister(thread)
+        self.entries.append({'name': name, 'thread': thread, 'stage': stage, 'stop': stop, 'stop_time': stop_time})
+
+    def unregister(self, thread):
+        self.entries = [entry for entry in self.entries if entry['thread'] is not thread]
+
+    def stop(self, deadline=0.1, threads=None, grace=1.0):
+        """Stop the registered threads, or only the given ones, stage by stage.
+
+        Args:
+            deadline (float): time in s allowed for all stages together, extended to the stop times of the threads
+            threads (list): the threads to stop, None for all of them
+            grace (float): time in s a thread that missed the deadline is waited for before the next stage is stopped
+
+        Returns:
+            the names of the threads that missed the deadline
+        """
+        start = perf_counter()
+        entries = [entry for entry in self.entries if threads is None or entry['thread'] in threads]
+        stages = sorted({entry['stage'] for entry in entries})
+        needed = sum(max((entry['stop_time']() for entry in entries
+                          if entry['stage'] == stage and entry['stop_time'] is not None), default=0)
+                     for stage in stages)
+        deadline = max(deadline, needed)
+        late = []
+        for stage in stages:
+            stage_entries = [entry for entry in entries if entry['stage'] == stage]
+            for entry in stage_entries:
+                if entry['stop'] is not None:
+                    entry['stop']()
+                else:
+                    entry['thread'].running = False
+            for entry in stage_entries:
+                remaining = deadline - (perf_counter() - start)
+                if not entry['thread'].wait(max(int(1000 * remaining), 0)):
+                    late.append(entry['name'])
+                    entry['thread'].wait(int(1000 * grace))  # Still finish the stage before stopping the next one
+        self.stop_time = perf_counter() - start
+        return late
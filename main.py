@@ -1,7 +1,7 @@
 # Public Libraries
 from pyqtgraph.Qt import QtCore, QtGui, QtWidgets
+from concurrent.futures import ThreadPoolExecutor
 import sys
-from time import sleep
 
 # Custom modules
 from threads.DataGenerator import Generator
@@ -10,10 +10,32 @@ from settings import SettingsWindow
 from threads.Reader import SignalReader
 from threads.Writer import SignalWriter
 from threads.Controller import ControllerThread
-from plots import SignalPlot, ThreeDPlot
+from threads.DeviceRegistry import DeviceRegistry
+from threads.CommandServer import CommandServer
+from threads.Steering import SteeringThread
+from threads.Replay import ReplaySource
+from threads.CoilSimulator import CoilSimulator
+from recording import SessionRecorder
+from archive import SUFFIX, convert_session
+from sweep import load_plan, SweepRunner
+from eventlog import ParameterLog
+from waves import parse_tones
+import shapes
+from pipeline import AcquisitionPipeline, WelchEstimator
+from capture import TriggeredCapture
+from plots import SignalPlot, ThreeDPlot, FieldTrace, SpectrumPlot
 from misc_functions import set_style
+from dashboard import PerformancePanel
+from lifecycle import ThreadLifecycle
+import latency
+import tracing
 
 debug_mode = False     # Switch to either use NI threads or a random data generator.
+simulate_coils = True  # In debug mode, simulate the amplifiers and coils instead of emitting random noise
+command_port = None  # Port of the local command API on localhost (see command_client.py), e.g. 5757, None for off
+steering_port = None  # UDP port on localhost receiving position estimates for closed-loop steering, e.g. 5758
+steering_track = None  # Path of recorded position estimates (t, x, y) to steer from instead of the UDP port
+replay_file = None  # In debug mode, path of a recorded session (File > Record Session) to stream instead of noise
 fbs_mode = False  # Switch to use either the PyQt5 app starting or the FBS container
 
 
@@ -27,18 +49,35 @@ class MyWindow(QtGui.QMainWindow):
     Attributes:
         config: instantiated version of the SettingsWindow class located in settings.py
     """
+    archiveConverted = QtCore.pyqtSignal(object)  # Status message of a finished archive conversion
 
-    def __init__(self):
+    def __init__(self, config=None):
         super().__init__()  # Inherit everything from the Qt "QMainWindow" class
 
-        # Instantiate class in settings.py which contains the settings UI AND the persistent QSettings values
-        self.config = SettingsWindow()
+        # Instantiate class in settings.py which contains the settings UI AND the persistent QSettings values, unless
+        # a tool like latency_test.py passes in a modified one
+        self.config = SettingsWindow() if config is None else config
 
         set_style()  # Pulled in from misc_functions, simply sets background and foreground colors for plots
 
         # Call setup methods below
         self.initUI()
         self.initThreads(self.config)
+        self.config.settingsApplied.connect(self.reconfigure)  # Changed settings are applied without a restart
+
+        # Dockable telemetry panel, toggled from the View menu
+        self.performancePanel = PerformancePanel(self)
+        self.addDockWidget(QtCore.Qt.RightDockWidgetArea, self.performancePanel)
+        self.viewMenu.addAction(self.performancePanel.toggleViewAction())
+
+        # Dockable spectrum of the acquired signals, only estimated while it is shown
+        self.spectrumDock = QtWidgets.QDockWidget('Spectrum')
+        self.spectrumDock.setObjectName('SpectrumDock')
+        self.spectrumDock.setWidget(self.p3)
+        self.addDockWidget(QtCore.Qt.BottomDockWidgetArea, self.spectrumDock)
+        self.spectrumDock.hide()
+        self.spectrumDock.visibilityChanged.connect(self.p3.set_running)
+        self.viewMenu.addAction(self.spectrumDock.toggleViewAction())
 
         self.p1.keyPressed.connect(self.t.on_key)  # Connect keyPresses on signal plot to Param Tree
 
@@ -56,6 +95,7 @@ class MyWindow(QtGui.QMainWindow):
         mainMenu = self.menuBar()
         # mainMenu.setStyleSheet("""QMenuBar { background-color: #F0F0F0; }""")  # Makes the menu bar grey-ish
         fileMenu = mainMenu.addMenu('File')  # Adds the file button
+        self.viewMenu = mainMenu.addMenu('View')
         helpMenu = mainMenu.addMenu('Help')
 
         # Settings button
@@ -64,6 +104,44 @@ class MyWindow(QtGui.QMainWindow):
         settingsButton.triggered.connect(self.config.show)  # when the settings button is clicked, window is shown
         fileMenu.addAction(settingsButton)  # Adds the settings button to the file menu
 
+        # Timing trace buttons, recording is off by default
+        traceButton = QtWidgets.QAction('Record Timing Trace', self, checkable=True)
+        traceButton.toggled.connect(tracing.set_enabled)
+        fileMenu.addAction(traceButton)
+        exportTraceButton = QtWidgets.QAction('Export Timing Trace...', self)
+        exportTraceButton.triggered.connect(self.export_trace)
+        fileMenu.addAction(exportTraceButton)
+
+        # Session recording / replay buttons
+        if not debug_mode:
+            self.recorder = None
+            self.recordButton = QtWidgets.QAction('Record Session', self, checkable=True)
+            self.recordButton.toggled.connect(self.record_session)
+            fileMenu.addAction(self.recordButton)
+            self.logButton = QtWidgets.QAction('Log Parameter Changes', self, checkable=True)
+            self.logButton.toggled.connect(self.log_parameters)
+            fileMenu.addAction(self.logButton)
+        elif replay_file:
+            seekButton = QtWidgets.QAction('Replay: Seek...', self)
+            seekButton.triggered.connect(self.seek_replay)
+            fileMenu.addAction(seekButton)
+            speedButton = QtWidgets.QAction('Replay: Speed...', self)
+            speedButton.triggered.connect(self.set_replay_speed)
+            fileMenu.addAction(speedButton)
+
+        # Converting recordings runs in the background, one conversion at a time
+        self.archiveExecutor = ThreadPoolExecutor(max_workers=1)
+        self.archiveConverted.connect(lambda message: self.statusBar().showMessage(message, 10000))
+        archiveButton = QtWidgets.QAction('Convert Recording to Archive...', self)
+        archiveButton.triggered.connect(self.convert_recording)
+        fileMenu.addAction(archiveButton)
+
+        # Parameter sweeps run on the acquisition thread once started
+        self.sweep = None
+        self.sweepButton = QtWidgets.QAction('Run Parameter Sweep', self, checkable=True)
+        self.sweepButton.toggled.connect(self.run_sweep)
+        fileMenu.addAction(self.sweepButton)
+
         # Exit Button
         exitButton = QtWidgets.QAction('Exit', self)
         exitButton.setShortcut('Ctrl+Q')
@@ -95,6 +173,10 @@ class MyWindow(QtGui.QMainWindow):
             zphase=self.config.defaults['zphase'],
         )
         self.p2.setSizePolicy(self.p1.sizePolicy())  # 2D plot size = 3D plot size
+        self.p3 = SpectrumPlot()  # Shown in a dock, see __init__
+        measuredButton = QtWidgets.QAction('Measured Field Trace', self, checkable=True)
+        measuredButton.toggled.connect(self.p2.set_show_measured)
+        self.viewMenu.addAction(measuredButton)
 
         # Create control descriptions
         self.keyboardlbl = QtWidgets.QLabel(
@@ -139,28 +221,146 @@ class MyWindow(QtGui.QMainWindow):
 
         """
         if not debug_mode:
-            # Instantiate the readThread
-            self.readThread = SignalReader(
-                daq_name=config.daq_name,
-                readchannel_list=config.readchannel_list,
-                daq_rate=config.daq_rate,
-                readchunksize=config.readchunksize
-            )
-
-            # Connect the outputs of the readThread and start it
-            self.readThread.newData.connect(
-                self.p1.on_new_data_update_plot)  # Connect the signal from the thread to the plotting method
-            self.readThread.errorMessage.connect(self.error_handling)  # Connect error signal from readThread
+            # Enumerate and probe the NI devices in the background, the settings are re-validated on every change
+            self.deviceRegistry = DeviceRegistry()
+            self.deviceRegistry.devicesChanged.connect(config.on_devices_changed)
+            self.deviceRegistry.start()
+            self.deviceRegistry.setPriority(QtCore.QThread.LowestPriority)
+
+            # Instantiate the readThread and start it
+            self.readThread = self.make_reader(config)
             self.readThread.start()  # Start the read loop, runs the run() method in the readThread
 
             # Instantiate the writeThread
-            self.writeThread = SignalWriter(
-                funcg_name=config.funcg_name,
-                writechannel_list=config.writechannel_list,
-                funcg_rate=config.funcg_rate,
-                writechunksize=config.writechunksize,
+            self.writeThread = self.make_writer(config)
+            self.writeThread.start()  # Pre-arm the output tasks, they generate the idle level until Toggle Output
+
+        elif debug_mode:
+            # For debugging purposes, don't initialize the NI part but instead replay a recorded session, simulate the
+            # coils or use a random data generator. Each is started with Toggle Output.
+            self.writeThread = self.make_debug_source(config)
+
+        # Fan the acquired data out into the full-rate stream (recording, analysis) and a decimated one for the signal
+        # plot, and keep the last moments of the full-rate stream for triggered captures
+        self.pipeline = self.capture = None
+        self.init_pipeline(config)
+        self.t.swarmToggled.connect(self.on_swarm_toggled)
+
+        # Closed-loop steering from position estimates, it sets the Z-Phase of the writeThread directly
+        self.steeringThread = None
+        if steering_port is not None or steering_track is not None:
+            self.steeringThread = SteeringThread(self.writeThread, port=steering_port, track_file=steering_track)
+            self.steeringThread.errorMessage.connect(lambda message: self.statusBar().showMessage(message, 10000))
+            self.steeringThread.start()
+
+        # Serve the local command API, which sets the parameters of the writeThread directly
+        if command_port is not None:
+            self.commandServer = CommandServer(self.writeThread, port=command_port)
+            self.commandServer.steering = self.steeringThread
+            self.commandServer.capture = self.capture
+            self.commandServer.swarmCommand.connect(self.on_swarm_command)
+            self.commandServer.errorMessage.connect(lambda message: self.statusBar().showMessage(message, 10000))
+            self.commandServer.start()
+
+        # Lastly, initialize and connect the controller input listening thread
+        self.gamepadThread = ControllerThread()
+        self.gamepadThread.newGamepadEvent.connect(self.t.on_gamepad_event)
+        self.gamepadThread.start()
+        self.gamepadThread.setPriority(QtCore.QThread.LowestPriority)
+
+        # Stop order on close, see lifecycle.py: the inputs, and the writer ramping the coils down, first. The data
+        # source last, so it still acquires the ramp-down
+        self.lifecycle = ThreadLifecycle()
+        self.lifecycle.register('gamepad', self.gamepadThread, stage=0)
+        if command_port is not None:
+            self.lifecycle.register('command API', self.commandServer, stage=0)
+        if self.steeringThread is not None:
+            self.lifecycle.register('steering', self.steeringThread, stage=0)
+        if not debug_mode:
+            self.lifecycle.register('device registry', self.deviceRegistry, stage=0)
+            self.lifecycle.register('writer', self.writeThread, stage=0, stop=self.writeThread.stop,
+                                    stop_time=self.writeThread.stop_time)
+            self.lifecycle.register('reader', self.readThread, stage=1, stop=self.readThread.stop)
+        else:
+            self.lifecycle.register('data source', self.writeThread, stage=1)
+
+    def trace_zcoeff(self):
+        """Z-Coefficient of the first rig, whose coil monitors the FieldTrace reads."""
+        if hasattr(self.writeThread, 'state'):
+            return float(self.writeThread.state['zcoeff'][0])
+        return getattr(self.writeThread, 'zcoeff', self.config.defaults['zcoeff'])
+
+    def make_reader(self, config):
+        """Create a readThread for the current settings, connected but not started."""
+        readThread = SignalReader(
+            daq_name=config.daq_name,
+            readchannel_list=config.readchannel_list,
+            daq_rate=config.daq_rate,
+            readchunksize=config.readchunksize,
+            start_trigger=f'/{config.funcg_name}/ao/StartTrigger' if config.shared_start_trigger else None
+        )
+        readThread.errorMessage.connect(self.error_handling)  # Connect error signal from readThread
+        return readThread
+
+    def make_writer(self, config, previous=None, output_on=False):
+        """Create a writeThread for the current settings, connected but not started.
+
+        Args:
+            config: the SettingsWindow
+            previous: a SignalWriter being replaced, its signal parameters and parameter log are carried over so the
+                field continues as before. With a different number of rigs, the log is closed instead, as its records
+                are sized for the old rigs
+            output_on (bool): whether the new writer starts with the field on. Read it from the previous writer before
+                stopping that, as stopping turns its output off
+        """
+        writeThread = SignalWriter(
+            funcg_name=config.funcg_name,
+            writechannel_list=config.writechannel_list,
+            funcg_rate=config.funcg_rate,
+            writechunksize=config.writechunksize,
+            funcg_max_rate=config.funcg_max_rate,
+            samples_per_period=config.samples_per_period,
+            write_latency=config.write_latency,
+            rigs=config.rigs,
+            zcoeff=config.defaults['zcoeff'],
+            # Default wave values
+            vmulti=self.t.getParamValue('Voltage Multiplier'),
+            freq=self.t.getParamValue('Frequency'),
+            camber=self.t.getParamValue('Field Camber'),
+            zphase=self.t.getParamValue('Z-Phase'),
+            calib_xamp=self.t.getParamValue('Calibration X-Voltage Ampl.', branch='Calibration'),
+            calib_yamp=self.t.getParamValue('Calibration Y-Voltage Ampl.', branch='Calibration'),
+            calib_zamp=self.t.getParamValue('Calibration Z-Voltage Ampl.', branch='Calibration'),
+        )
+        writeThread.errorMessage.connect(self.error_handling)  # Connect error signal from writeThread
+        writeThread.reference = getattr(self, 'readThread', None)  # The reader's sample clock is the shared clock
+        writeThread.output_on = output_on
+        if previous is not None:
+            if len(previous.rigs) == len(writeThread.rigs):  # Otherwise the rigs start from the tree's values
+                writeThread.state = {name: values.copy() for name, values in previous.state.items()}
+                writeThread.active_rig = previous.active_rig
+            writeThread.shape, writeThread.tones = previous.shape, previous.tones
+            writeThread.shape_parameters = previous.shape_parameters
+            writeThread.calib_mode = previous.calib_mode
+            if len(previous.rigs) == len(writeThread.rigs):
+                writeThread.event_log = previous.event_log
+            elif previous.event_log is not None:
+                path = previous.event_log.path
+                self.logButton.setChecked(False)  # Closes the log of the previous writer
+                self.statusBar().showMessage(f'The number of rigs changed, stopped the parameter log {path}', 10000)
+        return writeThread
+
+    def make_debug_source(self, config):
+        """Create the data source used in debug mode, see the module flags."""
+        if replay_file:
+            return ReplaySource(replay_file)
+        if simulate_coils:
+            return CoilSimulator(
+                daq_rate=config.daq_rate,
+                chunksize=config.readchunksize,
+                matrix=config.rigs[0]['matrix'],
+                offsets=config.rigs[0]['offsets'],
                 zcoeff=config.defaults['zcoeff'],
-                # Default wave values
                 vmulti=self.t.getParamValue('Voltage Multiplier'),
                 freq=self.t.getParamValue('Frequency'),
                 camber=self.t.getParamValue('Field Camber'),
@@ -169,19 +369,141 @@ class MyWindow(QtGui.QMainWindow):
                 calib_yamp=self.t.getParamValue('Calibration Y-Voltage Ampl.', branch='Calibration'),
                 calib_zamp=self.t.getParamValue('Calibration Z-Voltage Ampl.', branch='Calibration'),
             )
-            self.writeThread.errorMessage.connect(self.error_handling)  # Connect error signal from writeThread
+        return Generator(0.2, 10)
 
-        elif debug_mode:
-            # For debugging purposes, don't initialize the NI part but instead use a random data generator
-            self.writeThread = Generator(0.2, 10)
-            self.writeThread.newData.connect(self.p1.on_new_data_update_plot)
+    def init_pipeline(self, config):
+        """(Re)connect the acquisition pipeline and the triggered capture to the current data source.
 
-        # Lastly, initialize and connect the controller input listening thread
-        self.gamepadThread = ControllerThread()
-        self.gamepadThread.newGamepadEvent.connect(self.t.on_gamepad_event)
-        self.gamepadThread.start()
-        self.gamepadThread.setPriority(QtCore.QThread.LowestPriority)
+        The decimation runs on the source's thread, the direct connection skips the GUI event loop.
+        """
+        source = self.writeThread if debug_mode else self.readThread
+        if self.pipeline is not None:
+            self.pipeline_source.newChunk.disconnect(self.pipeline.process)
+            self.pipeline.newDisplayData.disconnect(self.p1.on_new_data_update_plot)
+        self.pipeline_source = source
+        if self.capture is not None:
+            self.capture.close()
+
+        self.pipeline = AcquisitionPipeline(getattr(source, 'daq_rate', config.daq_rate), rates=[config.display_rate])
+        source.newChunk.connect(self.pipeline.process, QtCore.Qt.DirectConnection)
+        self.pipeline.newDisplayData.connect(self.p1.on_new_data_update_plot)
+        self.p1.set_rate(self.pipeline.rates()[0], config.display_duration)
+
+        # Keep the last moments of the full-rate stream in memory and save windows around events to the capture folder
+        self.capture = None
+        if config.capture['folder']:
+            self.capture = TriggeredCapture(self.pipeline.daq_rate, **config.capture)
+            self.pipeline.newFullRate.connect(self.capture.process, QtCore.Qt.DirectConnection)
+            self.capture.captureWritten.connect(lambda path: self.statusBar().showMessage(f'Captured {path}', 3000))
+
+        # Field measured by the coil monitors of the first rig, for the trace in the 3D plot
+        try:
+            trace = FieldTrace(self.pipeline.daq_rate, config.rigs[0]['matrix'], config.rigs[0]['offsets'],
+                               config.field_channels, config.field_gain, self.trace_zcoeff(),
+                               vertices=len(self.p2.trace_colors))
+            self.pipeline.newFullRate.connect(trace.process, QtCore.Qt.DirectConnection)
+        except (ValueError, TypeError) as e:
+            print(f'Cannot show the measured field: {e}')
+            trace = None
+        self.p2.set_trace(trace)
+
+        # Spectrum of every channel at the full rate
+        self.p3.set_estimator(WelchEstimator(self.pipeline.daq_rate))
+        self.pipeline.newFullRate.connect(self.p3.on_new_chunk, QtCore.Qt.DirectConnection)
+        if getattr(self, 'commandServer', None) is not None:
+            self.commandServer.capture = self.capture
+
+        # A running sweep follows the new stream, the sample clock may have restarted so its condition starts over
+        if self.sweep is not None:
+            self.sweep.restart(daq_rate=self.pipeline.daq_rate)
+            self.pipeline.newFullRate.connect(self.sweep.process, QtCore.Qt.DirectConnection)
+
+    def on_swarm_toggled(self, mode):
+        if self.capture is not None:
+            self.capture.trigger(f'swarm_{mode.lower()}')
+
+    def reconfigure(self, changed):
+        """Apply changed settings without restarting the application.
+
+        Only what depends on the changed settings is rebuilt, everything else keeps running. Read and write settings
+        replace the readThread or writeThread: the old thread is stopped through the ThreadLifecycle (the writer
+        ramps the coils down), and a new one creates its tasks on its own thread, so the GUI only waits for the stop.
+        A new writer continues with the signal parameters and output state of the old one. With a shared start
+        trigger, both are replaced together and the reader is started first to wait for the writer's trigger.
+
+        A reader replaced alone restarts its sample count, the writer's history follows the new clock from its next
+        arm. A recording in progress is stopped when the reader is replaced, as its channels may have changed.
 
+        Args:
+            changed (list): the changed settings as 'Branch/Setting' strings, see SettingsWindow.settingsApplied
+        """
+        config = self.config
+        groups = {string.split('/')[0] for string in changed}
+        display_only = {'Read Parameters/Display Rate [sps]', 'Read Parameters/Display Duration [s]'}
+        replace_reader = any(string.startswith('Read Parameters/') and string not in display_only
+                             for string in changed)
+        replace_writer = 'Write Parameters' in groups
+        if debug_mode:
+            # The data source stands in for both
+            replace_writer = (replace_reader or replace_writer) and not replay_file
+            replace_reader = False
+        elif config.shared_start_trigger and (replace_reader or replace_writer):
+            replace_reader = replace_writer = True
+
+        if 'Default Signal Values/Custom Field Shapes' in changed:
+            self.t.p.param('Signal Design Parameters', 'Field Shape').setLimits(shapes.names())
+
+        # Stop what is replaced, the writer first so the reader still acquires the ramp-down
+        source_running = self.writeThread.isRunning()
+        output_on = self.writeThread.output_on  # Stopping the writer turns it off
+        stopped = ([self.writeThread] if replace_writer else []) + ([self.readThread] if replace_reader else [])
+        for name in self.lifecycle.stop(threads=stopped):
+            print(f'The {name} missed the stop deadline')
+        for thread in stopped:
+            thread.wait()
+            self.lifecycle.unregister(thread)
+        if replace_reader and self.recorder is not None:
+            self.recordButton.setChecked(False)  # Stops the recording
+
+        if replace_reader:
+            self.readThread = self.make_reader(config)
+            self.lifecycle.register('reader', self.readThread, stage=1, stop=self.readThread.stop)
+            self.readThread.start()
+            self.writeThread.reference = self.readThread
+        if replace_writer and debug_mode:
+            self.set_writer(self.make_debug_source(config), 'data source', stage=1)
+            if source_running:
+                self.writeThread.start()
+        elif replace_writer:
+            writeThread = self.make_writer(config, previous=self.writeThread, output_on=output_on)
+            self.set_writer(writeThread, 'writer', stage=0)
+            self.writeThread.start()
+            rig_names = [rig['name'] for rig in config.rigs]
+            self.t.p.param('Signal Design Parameters', 'Active Rig').setLimits(rig_names)
+            self.t.setParamValue('Active Rig', rig_names[self.writeThread.active_rig])
+        if replace_reader or replace_writer or groups & {'Read Parameters', 'Triggered Capture'}:
+            self.init_pipeline(config)
+
+        self.statusBar().showMessage(f"Applied the new settings: {', '.join(sorted(groups))}", 5000)
+
+    def set_writer(self, writeThread, name, stage):
+        """Replace the writeThread everywhere it is used."""
+        self.writeThread = writeThread
+        is_writer = isinstance(writeThread, SignalWriter)
+        self.lifecycle.register(name, writeThread, stage=stage, stop=writeThread.stop if is_writer else None,
+                                stop_time=writeThread.stop_time if is_writer else None)
+        if self.steeringThread is not None:
+            self.steeringThread.writer = writeThread
+        if command_port is not None:
+            self.commandServer.writer = writeThread
+        if self.sweep is not None:
+            try:
+                self.sweep.restart(writer=writeThread)
+            except ValueError as e:
+                self.statusBar().showMessage(f'Stopped the sweep: {e}', 10000)
+                self.sweepButton.setChecked(False)
+
+    @tracing.traced('MyWindow.change')
     def change(self, param, changes):
         """Parses the value change signals coming in from the Parameter Tree.
 
@@ -217,8 +539,23 @@ class MyWindow(QtGui.QMainWindow):
                 self.writeThread.zphase = data
                 self.p2.zphase = data
                 self.p2.plot_data()
+            if path[1] == 'Field Shape' and change == 'value':
+                if len(path) == 2:  # A new shape, otherwise one of its parameters (see show_shape_parameters)
+                    self.t.show_shape_parameters(data)
+                shape_parameters = self.t.shape_parameters()
+                self.writeThread.shape_parameters = shape_parameters  # Before the shape, whose defaults fill any gaps
+                self.writeThread.shape = self.p2.shape = self.t.getParamValue('Field Shape')
+                self.p2.shape_parameters = shape_parameters
+                self.p2.plot_data()
+            if path[1] == 'Tones':
+                try:
+                    self.writeThread.tones = parse_tones(data)
+                except ValueError as e:
+                    self.statusBar().showMessage(str(e), 5000)
             if path[1] == 'Z-Coefficient':
                 self.writeThread.zcoeff = data
+                if self.p2.trace is not None:
+                    self.p2.trace.set_zcoeff(self.trace_zcoeff())
             if path[1] == 'Output Mode':
                 if data == 'Calibration':
                     self.writeThread.calib_mode = True
@@ -230,20 +567,210 @@ class MyWindow(QtGui.QMainWindow):
                 self.writeThread.calib_yamp = data
             if path[1] == 'Calibration Z-Voltage Ampl.':
                 self.writeThread.calib_zamp = data
+            if path[1] == 'Closed-Loop Steering' and self.steeringThread is not None:
+                self.steeringThread.enabled = data
+                if not data:  # Hand the heading back to the parameter tree
+                    self.t.setParamValue('Z-Phase', self.writeThread.zphase)
+            if path[1] == 'Active Rig':
+                self.select_rig(data)
+
+        if latency.probe is not None:
+            latency.probe.mark('change')
+
+    def select_rig(self, name):
+        """Switch the rig controlled by the parameter tree and load its parameters into the tree.
+
+        Args:
+            name: name of the rig, as listed in config.rigs
+        """
+        if not isinstance(self.writeThread, SignalWriter):  # Debug mode
+            return
+
+        self.writeThread.active_rig = [rig['name'] for rig in self.config.rigs].index(name)
+
+        # Setting these emits the usual change signals, which also update the 3D plot
+        self.t.setParamValue('Voltage Multiplier', self.writeThread.vmulti)
+        self.t.setParamValue('Frequency', self.writeThread.freq)
+        self.t.setParamValue('Field Camber', self.writeThread.camber)
+        self.t.setParamValue('Z-Phase', self.writeThread.zphase)
+        self.t.setParamValue('Z-Coefficient', self.writeThread.zcoeff, branch='Calibration')
+        self.t.setParamValue('Calibration X-Voltage Ampl.', self.writeThread.calib_xamp, branch='Calibration')
+        self.t.setParamValue('Calibration Y-Voltage Ampl.', self.writeThread.calib_yamp, branch='Calibration')
+        self.t.setParamValue('Calibration Z-Voltage Ampl.', self.writeThread.calib_zamp, branch='Calibration')
+
+    def on_swarm_command(self, mode, start):
+        """Start or stop a swarm mode on request of the command API.
+
+        Args:
+            mode: name of the swarm mode, as in the Swarm Mode list of the parameter tree
+            start: True to start the mode, False to stop the running one
+        """
+        if not start:
+            self.t.running_explode = False
+        elif not self.t.running_explode:
+            self.t.setParamValue('Swarm Mode', mode)
+            self.t.toggle_swarm()  # Runs until stopped, processing events in between
+
+    def export_trace(self):
+        """Ask for a file name and export the recorded timing spans as a Chrome trace, see tracing.py."""
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Export Timing Trace', 'mucontrol_trace.json',
+                                                        'Chrome trace (*.json)')
+        if path:
+            n_spans = tracing.export_chrome_trace(path)
+            self.statusBar().showMessage(f'Exported {n_spans} spans to {path}', 5000)
+
+    def record_session(self, on):
+        """Start or stop recording the acquired data to a file that can be replayed in debug mode.
+
+        Args:
+            on: a boolean, whether the menu entry is checked or not
+        """
+        if on:
+            path, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Record Session', 'mucontrol_session.bin',
+                                                            'Recorded session (*.bin)')
+            if not path:
+                self.sender().setChecked(False)
+                return
+            self.recorder = SessionRecorder(path, self.config.daq_rate, self.config.readchannel_list)
+            # Written on a background thread, the full-rate stream never passes through the GUI thread
+            self.readThread.newChunk.connect(self.recorder.write_in_background, QtCore.Qt.DirectConnection)
+            self.statusBar().showMessage(f'Recording to {path}', 5000)
+        elif self.recorder is not None:
+            self.readThread.newChunk.disconnect(self.recorder.write_in_background)
+            self.recorder.close()
+            self.statusBar().showMessage(f'Recorded {self.recorder.samples / self.recorder.daq_rate:.1f} s to '
+                                         f'{self.recorder.path}', 5000)
+            self.recorder = None
+
+    def log_parameters(self, on):
+        """Start or stop logging every parameter change applied by the writeThread to a binary file, see eventlog.py.
+
+        Args:
+            on: a boolean, whether the menu entry is checked or not
+        """
+        if on:
+            path, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Log Parameter Changes', 'mucontrol_parameters.log',
+                                                            'Parameter log (*.log)')
+            if not path:
+                self.sender().setChecked(False)
+                return
+            self.writeThread.logged_signature = None  # Log the current parameters first
+            self.writeThread.event_log = ParameterLog(path, len(self.config.rigs))
+        elif self.writeThread.event_log is not None:
+            event_log, self.writeThread.event_log = self.writeThread.event_log, None
+            event_log.close()
+            self.statusBar().showMessage(f'Logged {event_log.flushed} parameter changes to {event_log.path}', 5000)
+
+    def convert_recording(self):
+        """Ask for a recorded session and optionally its parameter log, and convert them to an indexed, compressed
+        archive in the background, see archive.py."""
+        path, _ = QtWidgets.QFileDialog.getOpenFileName(self, 'Convert Recording', '', 'Recorded session (*.bin *.npy)')
+        if not path:
+            return
+        event_log, _ = QtWidgets.QFileDialog.getOpenFileName(self, 'Parameter Log of the Recording (optional)', '',
+                                                             'Parameter log (*.log)')
+        archive_path, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Save Archive', path.rsplit('.', 1)[0] + SUFFIX,
+                                                                f'Session archive (*{SUFFIX})')
+        if not archive_path:
+            return
+
+        def convert():
+            try:
+                header = convert_session(path, archive_path, event_log or None)
+            except (OSError, ValueError, KeyError) as e:
+                self.archiveConverted.emit(f'Could not convert {path}: {e}')
+            else:
+                self.archiveConverted.emit(f"Archived {header['samples'] / header['daq_rate']:.1f} s and "
+                                           f"{header['events']} parameter changes to {archive_path}")
+
+        self.archiveExecutor.submit(convert)
+        self.statusBar().showMessage(f'Converting {path} to {archive_path}', 5000)
+
+    def run_sweep(self, on):
+        """Start or stop an unattended parameter sweep, see sweep.py.
+
+        The results are written to a folder, choosing a folder with the results of an interrupted run of the same
+        sweep resumes it.
+
+        Args:
+            on: a boolean, whether the menu entry is checked or not
+        """
+        if on:
+            path, _ = QtWidgets.QFileDialog.getOpenFileName(self, 'Run Parameter Sweep', '',
+                                                            'Sweep definition (*.json)')
+            folder = QtWidgets.QFileDialog.getExistingDirectory(self, 'Results Folder') if path else ''
+            if not folder:
+                self.sweepButton.setChecked(False)
+                return
+            if not debug_mode and not self.writeThread.output_on:
+                self.statusBar().showMessage('Turn the output on before starting a sweep', 5000)
+                self.sweepButton.setChecked(False)
+                return
+            try:
+                self.sweep = SweepRunner(load_plan(path), folder, self.writeThread, self.pipeline.daq_rate,
+                                         self.config.readchannel_list)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.statusBar().showMessage(f'Cannot run the sweep: {e}', 10000)
+                self.sweepButton.setChecked(False)
+                return
+            self.sweep.conditionFinished.connect(self.on_sweep_condition)
+            self.sweep.finished.connect(self.on_sweep_finished)
+            self.pipeline.newFullRate.connect(self.sweep.process, QtCore.Qt.DirectConnection)
+            self.statusBar().showMessage(f'Sweeping {len(self.sweep) - len(self.sweep.done)} of {len(self.sweep)} '
+                                         f'conditions, results in {folder}', 5000)
+        elif self.sweep is not None:
+            sweep, self.sweep = self.sweep, None
+            self.pipeline.newFullRate.disconnect(sweep.process)
+            sweep.stop()
+            sweep.close()
+            self.statusBar().showMessage(f'Sweep stopped with {len(sweep.done)} of {len(sweep)} conditions done',
+                                         5000)
+
+    def on_sweep_condition(self, result):
+        self.statusBar().showMessage(f"Sweep condition {result['condition'] + 1} done: {result['parameters']}", 5000)
+
+    def on_sweep_finished(self):
+        self.sweepButton.setChecked(False)  # Stops the sweep
+
+    def seek_replay(self):
+        """Ask for a time and continue the replay from there."""
+        seconds, ok = QtWidgets.QInputDialog.getDouble(
+            self, 'Seek', f'Time [s] (0 - {self.writeThread.duration:.1f}):',
+            self.writeThread.sample_index / self.writeThread.daq_rate, 0, self.writeThread.duration, 2)
+        if ok:
+            self.writeThread.seek(seconds)
+
+    def set_replay_speed(self):
+        """Ask for the replay speed, 1 is real-time."""
+        speed, ok = QtWidgets.QInputDialog.getDouble(self, 'Replay Speed', 'Speed [x real-time]:',
+                                                     self.writeThread.speed, 0.01, 1000, 2)
+        if ok:
+            self.writeThread.speed = speed
 
     def toggle_writeThread(self, data):
-        """A sub-method that starts or stops the writeThread when a toggle is requested.
+        """A sub-method that turns the output on or off when a toggle is requested.
+
+        The SignalWriter keeps its tasks running and ramps the field, it is only started here if it could not start
+        its tasks before. The debug data sources are started and stopped.
 
         Args:
             data: a boolean, whether the checkbox is checked or not
 
         """
-        if data is True:  # If the box is checked
+        if not debug_mode:
+            self.writeThread.output_on = data
+            if data is True and not self.writeThread.isRunning():
+                self.writeThread.start()
+
+        elif data is True:  # If the box is checked
             self.writeThread.start()  # Start the thread
 
         elif data is False:
             self.writeThread.running = False
 
+        if self.capture is not None:
+            self.capture.trigger('output_on' if data else 'output_off')
+
     def error_handling(self, error_message):
         """When an error signal is sent to this method, show an error box with the message inside.
 
@@ -260,42 +787,33 @@ class MyWindow(QtGui.QMainWindow):
         """ This method runs when Qt detects the main window closing. Used to gracefully end threads.
 
         The purpose of this method is to try and gracefully close threads to avoid persisting processes or bugs with
-        the National Instruments cards.
+        the National Instruments cards. The threads are stopped in order by the ThreadLifecycle: the coils are ramped
+        down before the tasks are closed and blocking reads are aborted. The deadline is 100 ms or the time the writer
+        needs to generate its queued chunks and the ramp, three chunks at most. Threads that miss the deadline are
+        reported and waited for, never terminated.
 
         Args:
             evnt: dummy variable, unused
 
         """
-        # Close controller thread
-        self.gamepadThread.running = False
-        self.gamepadThread.exit()
-        # Close writeThread
-        self.writeThread.running = False
-        self.writeThread.exit()
-
-        if not debug_mode:
-            # Close readThread
-            self.readThread.running = False
-            self.readThread.exit()
-
-        # Make sure the threads are closed before shutting down
-        sleeps = 0
-        if debug_mode:
-            while self.gamepadThread.isRunning() or self.writeThread.isRunning():
-                sleeps += 1
-                sleep(0.4)
-
-                if sleeps > 1:  # Forcibly quit if it does not close...
-                    self.gamepadThread.terminate()
-        # Good stuff
-        elif not debug_mode:
-            while self.gamepadThread.isRunning() or self.writeThread.isRunning() or self.readThread.isRunning():
-                sleeps += 1
-                sleep(0.4)
-
-                if sleeps > 1:  # Forcibly quit if it does not close...
-                    self.gamepadThread.terminate()
-
+        self.t.running_explode = False  # End a running swarm mode
+        late = self.lifecycle.stop(deadline=0.1)
+        print(f'Threads stopped in {1000 * self.lifecycle.stop_time:.0f} ms')
+        if late:
+            print(f"Still stopping after the deadline: {', '.join(late)}")
+            for entry in self.lifecycle.entries:
+                entry['thread'].wait()
+
+        # Close the files once no more data comes in
+        if not debug_mode and self.recorder is not None:
+            self.record_session(False)
+        if not debug_mode and self.writeThread.event_log is not None:
+            self.log_parameters(False)
+        if self.capture is not None:
+            self.capture.close()
+        if self.sweep is not None:
+            self.run_sweep(False)
+        self.archiveExecutor.shutdown(wait=True)  # Finish a running conversion rather than leave a partial archive
 
 if __name__ == '__main__':
 
@@ -1,19 +1,126 @@
+import json
 import numpy as np
-import nidaqmx
 import pyqtgraph as pg
-from PyQt5.QtCore import QEventLoop, QTimer
+from PyQt5.QtCore import QEventLoop, QTimer, QSettings
 
 def find_ni_devices():
-    system = nidaqmx.system.System.local()
-    dev_name_list = []
-    for device in system.devices:
-        assert device is not None
-        # device looks like "Device(name=cDAQ1Mod1)"
-        dev_name = str(device).replace(')', '').split('=')[1]
-        dev_name_list.append(dev_name)
+    """Return the names of the connected NI devices as a string, for use in error messages.
+
+    This reads the device cache kept up to date in the background by threads/DeviceRegistry.py instead of enumerating
+    the NI system, so it is cheap enough to call from the reader and writer error paths.
+    """
+    dev_name_list = [device['name'] for device in load_device_cache().values() if device['connected']]
     return str(dev_name_list)
 
 
+def device_key(device):
+    """Key used to identify a device in the cache: the serial number, or the name for devices without one.
+
+    Args:
+        device: a nidaqmx.system.Device
+
+    Returns:
+        a string key, e.g. '1A2B3C4' or 'name:Dev1' for simulated devices which report a serial number of 0
+    """
+    serial = device.dev_serial_num
+    if serial == 0:
+        return f'name:{device.name}'
+    return format(serial, 'X')
+
+
+def probe_ni_device(device):
+    """Probe the channel lists and maximum sample rates of a single NI device.
+
+    Devices without analog inputs or outputs raise on the corresponding properties, so each probe is guarded and
+    falls back to an empty list or a rate of 0.
+
+    Args:
+        device: a nidaqmx.system.Device
+
+    Returns:
+        a dictionary describing the capabilities of the device
+    """
+    def guarded(getter, fallback):
+        try:
+            return getter()
+        except Exception:
+            return fallback
+
+    return {
+        'name': device.name,
+        'serial': device_key(device),
+        'product_type': guarded(lambda: device.product_type, ''),
+        'simulated': guarded(lambda: device.dev_is_simulated, False),
+        'ai_channels': guarded(lambda: [c.split('/')[-1] for c in device.ai_physical_chans.channel_names], []),
+        'ao_channels': guarded(lambda: [c.split('/')[-1] for c in device.ao_physical_chans.channel_names], []),
+        'ai_max_single_chan_rate': guarded(lambda: float(device.ai_max_single_chan_rate), 0.0),
+        'ai_max_multi_chan_rate': guarded(lambda: float(device.ai_max_multi_chan_rate), 0.0),
+        'ao_max_rate': guarded(lambda: float(device.ao_max_rate), 0.0),
+        'connected': True,
+    }
+
+
+def load_device_cache():
+    """Read the cached device capabilities from QSettings.
+
+    Returns:
+        a dictionary of device dictionaries (see probe_ni_device) keyed by device serial
+    """
+    qsettings = QSettings("MarrLabCSM", "MuControl")
+    qsettings.beginGroup('Device Cache')
+    devices = {}
+    for key in qsettings.childKeys():
+        try:
+            devices[key] = json.loads(qsettings.value(key))
+        except (TypeError, ValueError):  # A corrupt entry is simply re-probed by the registry
+            pass
+    qsettings.endGroup()
+    return devices
+
+
+def save_device_cache(devices):
+    """Replace the cached device capabilities in QSettings.
+
+    Args:
+        devices: a dictionary of device dictionaries keyed by device serial
+    """
+    qsettings = QSettings("MarrLabCSM", "MuControl")
+    qsettings.remove('Device Cache')
+    qsettings.beginGroup('Device Cache')
+    for key, device in devices.items():
+        qsettings.setValue(key, json.dumps(device))
+    qsettings.endGroup()
+
+
+def get_device_capabilities(name, devices=None):
+    """Look up the cached capabilities of a device by its NI name.
+
+    Args:
+        name (str): name given to the NI card by the drivers, e.g. 'Dev1'
+        devices (dict): optional, an already loaded device cache
+
+    Returns:
+        the device dictionary, or None if the device has never been seen
+    """
+    if devices is None:
+        devices = load_device_cache()
+    for device in devices.values():
+        if device['name'] == name:
+            return device
+    return None
+
+
+def max_ai_rate(device, n_channels):
+    """Maximum per-channel sample rate of an analog input task on `device` with `n_channels` channels.
+
+    Per the NI documentation this is the smaller of the multi-channel rate and the single channel rate divided by
+    the number of channels.
+    """
+    if n_channels <= 1 or not device['ai_max_multi_chan_rate']:
+        return device['ai_max_single_chan_rate'] / max(n_channels, 1)
+    return min(device['ai_max_multi_chan_rate'], device['ai_max_single_chan_rate'] / n_channels)
+
+
 def xy_to_cylindrical(x, y):
     """
     Convert the x and y coordinates from the joystick into degrees from 0 to 360.
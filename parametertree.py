@@ -3,6 +3,9 @@ from pyqtgraph.parametertree import Parameter, ParameterTree
 from PyQt5.QtCore import Qt
 import numpy as np
 from misc_functions import qtsleep
+import latency
+import shapes
+import tracing
 
 class MyParamTree(ParameterTree):
     """The parameter tree widget that lives in the bottom of the main window.
@@ -17,6 +20,7 @@ class MyParamTree(ParameterTree):
 
     """
     paramChange = QtCore.pyqtSignal(object, object)  # MyParamTree outputs a signal with param and changes.
+    swarmToggled = QtCore.pyqtSignal(object)  # Name of the swarm mode toggled with U or START
 
     def __init__(self, config):
         super().__init__()
@@ -27,7 +31,11 @@ class MyParamTree(ParameterTree):
                 {'name': 'Frequency', 'type': 'float', 'value': config.defaults['freq'], 'step': 10, 'siPrefix': True, 'suffix': 'Hz'},
                 {'name': 'Z-Phase', 'type': 'float', 'value': config.defaults['zphase'], 'step': 90},
                 {'name': 'Field Camber', 'type': 'int', 'value': config.defaults['camber'], 'step': 1, 'siPrefix': True, 'suffix': '°'},
-                {'name': 'Swarm Mode', 'type': 'list', 'values': ['Rolling', 'Corkscrew', 'Flipping', 'Switchback'], 'value': 'Rolling'}
+                {'name': 'Field Shape', 'type': 'list', 'values': shapes.names(), 'value': 'Rotating', 'tip': "Field shapes are defined in shapes.py and under Custom Field Shapes in the settings"},
+                {'name': 'Tones', 'type': 'str', 'value': '[]', 'tip': "Multi-tone mode: superimpose fields given as [(weight, frequency, camber, zphase), ...], normalized to the voltage multiplier. Leave empty for a single tone."},
+                {'name': 'Closed-Loop Steering', 'type': 'bool', 'value': False, 'tip': "Steer the Z-Phase toward the waypoints from streamed position estimates, see threads/Steering.py"},
+                {'name': 'Swarm Mode', 'type': 'list', 'values': ['Rolling', 'Corkscrew', 'Flipping', 'Switchback'], 'value': 'Rolling'},
+                {'name': 'Active Rig', 'type': 'list', 'values': [rig['name'] for rig in config.rigs], 'value': config.rigs[0]['name'], 'tip': "The coil system controlled by the UI, keyboard and gamepad"}
             ]},
             {'name': 'Calibration', 'type': 'group', 'children': [
                 {'name': 'Output Mode', 'type': 'list', 'values': ['Normal', 'Calibration'], 'value': 'Normal'},
@@ -50,6 +58,17 @@ class MyParamTree(ParameterTree):
 
         self.running_explode = False
 
+    def show_shape_parameters(self, name):
+        """Show the parameters of a field shape as children of Field Shape, at their default values."""
+        param = self.p.param('Signal Design Parameters', 'Field Shape')
+        param.clearChildren()
+        for key, value in shapes.get(name).parameters.items():
+            param.addChild({'name': key, 'type': 'float', 'value': value, 'step': 0.1})
+
+    def shape_parameters(self):
+        """The values of the parameters of the selected field shape."""
+        return {child.name(): child.value() for child in self.p.param('Signal Design Parameters', 'Field Shape')}
+
     def sendChange(self, param, changes):
         self.paramChange.emit(param, changes)
 
@@ -71,6 +90,8 @@ class MyParamTree(ParameterTree):
 
     def on_key(self, key):
         """ On a keypress on the plot widget, forward the keypress to the correct function below."""
+        if latency.probe is not None:
+            latency.probe.mark('tree')
         qtk = QtCore.Qt
         # Its necessary to have this func map because the key is simply an integer I need to check against
         # the key dictionary in QtCore.Qt.
@@ -131,6 +152,7 @@ class MyParamTree(ParameterTree):
     def Key_U(self):
         self.toggle_swarm()
 
+    @tracing.traced('swarm explode')
     def explode(self):
         """Explode the wheel by applying an orthogonal camber angle briefly."""
         camber = self.getParamValue("Field Camber")
@@ -160,6 +182,7 @@ class MyParamTree(ParameterTree):
             qtsleep(time_between_explodes)  # wait
 
 
+    @tracing.traced('swarm switchback')
     def switchback(self, time, driving_heading, wiggle_angle):
         """Switchback swarm execution code.
 
@@ -201,6 +224,7 @@ class MyParamTree(ParameterTree):
         self.setParamValue('Z-Phase', driving_heading)
 
 
+    @tracing.traced('swarm corkscrew')
     def my_corkscrew(self):
         """My version of the corkscrew motion, described in signal_sandbox notebook."""
         print('running corkscrew')
@@ -252,6 +276,7 @@ class MyParamTree(ParameterTree):
         
     def toggle_swarm(self):
         swarm = self.getParamValue('Swarm Mode')
+        self.swarmToggled.emit(swarm)
 
         if swarm == 'Corkscrew':
             self.toggle_my_corkscrew()
@@ -270,6 +295,8 @@ class MyParamTree(ParameterTree):
         Args:
             gamepadEvent (list): incoming list from the controller class of format ['button', val]. ex. ['LJOY', 45]
         """
+        if latency.probe is not None:
+            latency.probe.mark('tree')
         func_map = {
             'X': self.Key_F,
             'Y': self.Key_G,
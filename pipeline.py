@@ -0,0 +1,153 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy.signal import firwin, get_window
+from pyqtgraph.Qt import QtCore
+
+
+class Decimator:
+    """Streaming anti-aliased decimation of multi-channel chunks by an integer factor.
+
+    The low-pass FIR filter is only evaluated at the kept output samples (the polyphase form), so the cost per input
+    sample is *taps_per_phase* multiply-adds whatever the factor. The last samples of each chunk and the position of
+    the next output sample are carried over, so the output is the same as decimating the whole stream at once,
+    however it is chunked.
+
+    Attributes:
+        factor (int): decimation factor
+        taps (ndarray): the FIR low-pass, cut off at 80 % of the output Nyquist frequency
+        history (ndarray): [channels, len(taps) - 1] input samples carried over from the previous chunk, None before
+            the first chunk
+        offset (int): position of the next output sample relative to the start of the next chunk
+    """
+    def __init__(self, factor, taps_per_phase=16):
+        self.factor = factor
+        self.taps = firwin(factor * taps_per_phase, 0.8 / factor) if factor > 1 else np.ones(1)
+        self.reversed_taps = self.taps[::-1].copy()
+        self.history = None
+        self.offset = 0
+
+    def process(self, chunk):
+        """Decimate the next chunk.
+
+        Args:
+            chunk: a [channels, samples] array
+
+        Returns:
+            a [channels, outputs] array, outputs being about samples / factor
+        """
+        if self.factor == 1:
+            return chunk
+        if self.history is None or self.history.shape[0] != chunk.shape[0]:  # Start from silence
+            self.history = np.zeros([chunk.shape[0], len(self.taps) - 1])
+            self.offset = 0
+        x = np.ascontiguousarray(np.concatenate([self.history, chunk], axis=1))
+        n_taps, length = len(self.taps), x.shape[1]
+        start = n_taps - 1 + self.offset  # Index in x of the next output sample, the end of its filter window
+        n_out = max((length - 1 - start) // self.factor + 1, 0)
+
+        # One filter window per output sample, as a view into x
+        windows = as_strided(x[:, start - n_taps + 1:], shape=(x.shape[0], n_out, n_taps),
+                             strides=(x.strides[0], self.factor * x.strides[1], x.strides[1]))
+        output = windows @ self.reversed_taps
+
+        self.offset = start + n_out * self.factor - length
+        self.history = x[:, length - n_taps + 1:]
+        return output
+
+
+class WelchEstimator:
+    """Streaming Welch estimate of the power spectral density of every channel.
+
+    The stream is cut into overlapping Hann-windowed segments across chunk boundaries (the samples after the last
+    complete segment are carried over), the segments of all channels are transformed in one rfft, and their
+    periodograms are averaged exponentially with *time_constant*, so the estimate follows changes of the signal. The
+    first estimate is the plain mean of the first segments, which is what scipy.signal.welch returns for them. At most
+    *max_segments* segments, the newest, are used per chunk, which bounds the work per chunk whatever its size. The
+    estimate still decays over all segments of the chunk, and the used ones stand in for the skipped ones, so the
+    time constant holds for any chunk size.
+
+    Attributes:
+        rate (float): sample rate of the stream
+        nperseg (int), hop (int): segment length and distance between the starts of two segments
+        frequencies (ndarray): frequency of each bin in Hz
+        psd (ndarray): [channels, bins] current estimate in V²/Hz, None before the first complete segment
+        segments (int): number of segments in the estimate
+    """
+    def __init__(self, rate, nperseg=1024, overlap=0.5, time_constant=1.0, max_segments=32):
+        self.rate = rate
+        self.nperseg = nperseg
+        self.hop = max(nperseg - int(nperseg * overlap), 1)
+        self.window = get_window('hann', nperseg)
+        self.scale = 1 / (rate * np.sum(self.window ** 2))
+        self.frequencies = np.fft.rfftfreq(nperseg, 1 / rate)
+        self.decay = np.exp(-self.hop / (rate * time_constant))
+        self.max_segments = max_segments
+        self.carry = None
+        self.psd = None
+        self.segments = 0
+
+    def process(self, chunk):
+        """Add the complete segments of the next [channels, samples] chunk to the estimate."""
+        if self.carry is None or self.carry.shape[0] != chunk.shape[0]:
+            self.carry = np.zeros([chunk.shape[0], 0])
+            self.psd, self.segments = None, 0
+        x = np.concatenate([self.carry, chunk], axis=1)
+        n = (x.shape[1] - self.nperseg) // self.hop + 1 if x.shape[1] >= self.nperseg else 0
+        self.carry = x[:, n * self.hop:]
+        if n == 0:
+            return
+
+        # The newest segments as a view, detrended and windowed like scipy.signal.welch
+        used = min(n, self.max_segments)
+        first = (n - used) * self.hop
+        x = np.ascontiguousarray(x[:, first:first + (used - 1) * self.hop + self.nperseg])
+        segments = as_strided(x, shape=(x.shape[0], used, self.nperseg),
+                              strides=(x.strides[0], self.hop * x.strides[1], x.strides[1]))
+        segments = (segments - segments.mean(axis=-1, keepdims=True)) * self.window
+        spectra = np.fft.rfft(segments, axis=-1)
+        power = (spectra.real ** 2 + spectra.imag ** 2) * self.scale
+        power[..., 1:None if self.nperseg % 2 else -1] *= 2  # One-sided, DC and Nyquist appear once
+
+        if self.psd is None:
+            psd = power.mean(axis=1)
+        else:  # The newest segment weighs the most, the weights and the decay of the old estimate sum to 1
+            weights = (1 - self.decay) * self.decay ** np.arange(used - 1, -1, -1)
+            weights *= (1 - self.decay ** n) / weights.sum()
+            psd = self.decay ** n * self.psd + np.tensordot(power, weights, axes=([1], [0]))
+        self.psd = psd  # Replaced rather than updated in place, so readers on other threads see a whole estimate
+        self.segments += used
+
+
+class AcquisitionPipeline(QtCore.QObject):
+    """Fans the acquired stream out to a full-rate stream and decimated streams.
+
+    Connect a source's newChunk signal to process with a direct connection, the decimation then runs on the source's
+    thread and only the decimated data reaches the GUI thread. The first decimated stream is meant for the signal
+    plot and also emitted through newDisplayData.
+
+    Attributes:
+        daq_rate (int): rate of the acquired stream
+        decimators (list): one Decimator per decimated stream
+    """
+    newFullRate = QtCore.pyqtSignal(object, object)  # Sample index of the first sample and the full-rate chunk
+    newDecimated = QtCore.pyqtSignal(object, object, object)  # Rate, sample index at that rate and chunk
+    newDisplayData = QtCore.pyqtSignal(object)  # Chunks of the first decimated stream, for the signal plot
+
+    def __init__(self, daq_rate, rates=(1000,)):
+        super().__init__()
+        self.daq_rate = daq_rate
+        self.decimators = [Decimator(max(int(daq_rate // rate), 1)) for rate in rates]
+        self.sample_indices = [0] * len(self.decimators)
+
+    def rates(self):
+        """The actual rate of every decimated stream."""
+        return [self.daq_rate / decimator.factor for decimator in self.decimators]
+
+    def process(self, start_index, chunk):
+        self.newFullRate.emit(start_index, chunk)
+        for index, decimator in enumerate(self.decimators):
+            output = decimator.process(chunk)
+            self.newDecimated.emit(self.daq_rate / decimator.factor, self.sample_indices[index], output)
+            self.sample_indices[index] += output.shape[1]
+            if index == 0 and output.shape[1]:  # Small chunks decimate to nothing now and then
+                self.newDisplayData.emit(output)
@@ -3,46 +3,222 @@ from pyqtgraph.Qt import QtCore
 import numpy as np
 import pyqtgraph.opengl as gl
 from waves import WaveGenerator
+import latency
+import tracing
+from time import perf_counter
+from telemetry import RateCounter, DurationCounter
 
 
 class SignalPlot(pg.PlotWidget):
     """
     This class is a simple wrapper around the pg.PlotWidget to capture keypresses
     when the plot is the active widget.
+
+    The incoming chunks (the display stream of the AcquisitionPipeline) are appended to a rolling buffer holding the
+    last *duration* seconds at the display rate, and the buffer is plotted. Decimated chunks can be only a few
+    samples long, so plotting the chunks themselves would show next to nothing.
+
+    Chunks arriving less than 1/max_fps after the last redraw are still buffered but not drawn, and are counted in
+    dropped_frames, so a fast reader can't starve the GUI thread. The redraw time and key presses are counted for
+    the performance panel.
     """
     keyPressed = QtCore.pyqtSignal(object)
 
-    def __init__(self):
+    def __init__(self, max_fps=60, rate=1000, duration=0.1):
         super().__init__()
+        self.min_frame_interval = 1 / max_fps
+        self.last_frame = 0.0
+        self.dropped_frames = 0
+        self.frame_time = DurationCounter()
+        self.key_counter = RateCounter()
         self.line_width = 1
         self.curve_colors = ['b', 'g', 'r', 'c', 'k', 'm']
         self.pens = [pg.mkPen(i, width=self.line_width) for i in self.curve_colors]
+        self.buffer = None
+        self.filled = 0
+        self.set_rate(rate, duration)
 
         self.setFocusPolicy(QtCore.Qt.StrongFocus)  # By default the plot is the keyboard focus
         self.showGrid(y=True)
 
         self.disableAutoRange('y')
 
+    def set_rate(self, rate, duration=None):
+        """Set the rate of the incoming stream and optionally the duration shown, which empties the buffer."""
+        self.rate = rate
+        if duration is not None:
+            self.duration = duration
+        self.capacity = max(int(round(self.rate * self.duration)), 1)
+        self.buffer = None
+
     def keyPressEvent(self, event):
         """ When a key is pressed, pass it up to the PyQt event handling system. """
         super().keyPressEvent(event)
+        if latency.probe is not None:
+            latency.probe.begin()
+        self.key_counter.tick()
         self.keyPressed.emit(event.key())
 
+    def append(self, chunk):
+        """Shift a [channels, samples] chunk into the rolling buffer."""
+        n_channels, n = np.shape(chunk)
+        if self.buffer is None or self.buffer.shape[0] != n_channels:
+            self.buffer = np.zeros([n_channels, self.capacity])
+            self.filled = 0
+        if n >= self.capacity:
+            self.buffer[:] = chunk[:, n - self.capacity:]
+        else:
+            self.buffer[:, :-n] = self.buffer[:, n:]
+            self.buffer[:, -n:] = chunk
+        self.filled = min(self.filled + n, self.capacity)
+
+    @tracing.traced('SignalPlot redraw')
     def on_new_data_update_plot(self, incomingData):
-        """ Each time the thread sends data, plot every row as a new line."""
+        """ Each time the thread sends data, add it to the buffer and plot every row of the buffer as a line."""
+        start = perf_counter()
+        self.append(incomingData)
+        if start - self.last_frame < self.min_frame_interval:
+            self.dropped_frames += 1
+            return
+        self.last_frame = start
+
         self.clear()  # Clear last update's lines
-        for i in range(0, np.shape(incomingData)[0]):  # For each row in incomingData
+        shown = self.buffer[:, self.capacity - self.filled:]
+        for i in range(0, shown.shape[0]):  # For each row in the buffer
             # Plot all rows
-            self.plot(incomingData[i], clear=False, pen=self.pens[i])
+            self.plot(shown[i], clear=False, pen=self.pens[i % len(self.pens)])
+        self.frame_time.add(perf_counter() - start)
+
+
+class SpectrumPlot(pg.PlotWidget):
+    """Power spectral density of every acquired channel, for diagnosing harmonics and interference.
+
+    The estimate is kept up to date by a WelchEstimator fed with the full-rate stream on the source's thread, and
+    only while the plot is shown. The curves are redrawn from the newest estimate at *fps*, in the colors of the
+    signal plot.
+    """
+    def __init__(self, fps=10):
+        super().__init__()
+        self.estimator = None
+        self.running = False
+        self.curves = []
+        self.pens = [pg.mkPen(color) for color in ['b', 'g', 'r', 'c', 'k', 'm']]
+        self.frame_time = DurationCounter()
+
+        self.setLogMode(y=True)
+        self.showGrid(x=True, y=True)
+        self.setLabel('bottom', 'Frequency', units='Hz')
+        self.setLabel('left', 'PSD [V²/Hz]')
+
+        self.timer = QtCore.QTimer()
+        self.timer.setInterval(int(1000 / fps))
+        self.timer.timeout.connect(self.redraw)
+
+    def set_estimator(self, estimator):
+        """Show the estimate of a WelchEstimator, replacing the previous one."""
+        self.estimator = estimator
+
+    def set_running(self, on):
+        """Start or stop estimating and redrawing, e.g. when the plot is shown or hidden."""
+        self.running = on
+        if on:
+            self.timer.start()
+        else:
+            self.timer.stop()
+
+    def on_new_chunk(self, start_index, chunk):
+        """Slot for the full-rate stream, runs on the source's thread."""
+        estimator = self.estimator
+        if self.running and estimator is not None:
+            estimator.process(chunk)
+
+    @tracing.traced('SpectrumPlot redraw')
+    def redraw(self):
+        estimator = self.estimator
+        if estimator is None or estimator.psd is None:
+            return
+        start = perf_counter()
+        psd = np.maximum(estimator.psd[:, 1:], 1e-30)  # Without DC, and positive for the log axis
+        while len(self.curves) < len(psd):
+            self.curves.append(self.plot(pen=self.pens[len(self.curves) % len(self.pens)]))
+        for curve, row in zip(self.curves, psd):
+            curve.setData(estimator.frequencies[1:], row)
+        self.frame_time.add(perf_counter() - start)
+
+
+class FieldTrace:
+    """Ring buffer of the field measured through the coil monitors, for the trace in ThreeDPlot.
+
+    The monitored coil voltages are mapped back to the field with the pseudo-inverse of the calibration matrix, with
+    its z column scaled by the Z-Coefficient like the commanded field (see WaveGenerator.field_to_coils), so the trace
+    is in the same units as the commanded loop. Chunks of the full-rate stream are written on the source's thread. The
+    last *duration* seconds are kept, and vertices picks a fixed number of evenly spaced samples from them into a
+    preallocated array, so drawing the trace costs the same whatever the read rate.
+
+    Attributes:
+        matrix (ndarray): [coils, 3] calibration matrix
+        inverse (ndarray): [3, coils] pseudo-inverse of the calibration matrix with the Z-Coefficient applied
+        offsets (ndarray): [coils, 1] coil offsets
+        channels (list): index in the read channel list of the monitor of each coil
+        gain (float): coil volts per monitor volt
+        ring (ndarray): [capacity, 3] float32 measured field, oldest samples overwritten first
+        written (int): number of samples written so far
+        pos (ndarray): [vertices, 3] float32 vertex array, filled in place by vertices
+        enabled (bool): chunks are only processed while the trace is shown
+    """
+    def __init__(self, daq_rate, matrix, offsets, channels, gain=1.0, zcoeff=1.0, duration=0.25, vertices=2000):
+        self.matrix = np.asarray(matrix, dtype=float)
+        if len(channels) != self.matrix.shape[0]:
+            raise ValueError(f'{len(channels)} field monitor channels for {self.matrix.shape[0]} coils')
+        self.set_zcoeff(zcoeff)
+        self.offsets = np.asarray(offsets, dtype=float)[:, np.newaxis]
+        self.channels = list(channels)
+        self.gain = gain
+        self.ring = np.zeros([max(int(duration * daq_rate), 2), 3], dtype=np.float32)
+        self.written = 0
+        self.pos = np.zeros([max(vertices, 2), 3], dtype=np.float32)
+        self.steps = np.arange(len(self.pos))
+        self.indices = np.zeros(vertices, dtype=self.steps.dtype)
+        self.enabled = False
+
+    def set_zcoeff(self, zcoeff):
+        """Follow a change of the Z-Coefficient of the rig."""
+        self.inverse = np.linalg.pinv(self.matrix * [1, 1, zcoeff])
+
+    def process(self, start_index, chunk):
+        """Slot for the full-rate stream, append the field measured in a [channels, samples] chunk."""
+        if not self.enabled or chunk.shape[0] <= max(self.channels):
+            return
+        capacity = len(self.ring)
+        field = (self.inverse @ (self.gain * chunk[self.channels, -capacity:] - self.offsets)).T
+        n = len(field)
+        start = (self.written + chunk.shape[1] - n) % capacity
+        first = min(n, capacity - start)
+        self.ring[start:start + first] = field[:first]
+        self.ring[:n - first] = field[first:]
+        self.written += chunk.shape[1]
+
+    def vertices(self):
+        """Fill pos with evenly spaced samples of the buffered trace, oldest first, and return it."""
+        capacity = len(self.ring)
+        available = min(self.written, capacity)
+        np.multiply(self.steps, max(available - 1, 0), out=self.indices)
+        self.indices //= len(self.pos) - 1  # The last vertex is the newest sample
+        self.indices += self.written - available
+        self.indices %= capacity
+        return np.take(self.ring, self.indices, axis=0, out=self.pos)
 
 
 class ThreeDPlot(gl.GLViewWidget):
     """
     Creates an OpenGL 3D plot for pseudo-viewing of the magnetic field.
 
+    Besides the commanded loop, the plot can show a trailing trace of the field measured by the reader (see
+    FieldTrace), redrawn at *trace_fps* from a fixed number of vertices that are updated in place.
+
     """
 
-    def __init__(self, funcg_rate, writechunksize, vmulti, freq, camber, zphase):
+    def __init__(self, funcg_rate, writechunksize, vmulti, freq, camber, zphase, trace_vertices=2000, trace_fps=30):
         super().__init__()
 
         # Instantiate wave generator
@@ -62,12 +238,16 @@ class ThreeDPlot(gl.GLViewWidget):
         self.setBackgroundColor('k')
 
         # Initialize signal design variables
+        self.dropped_frames = 0  # Redraws skipped because changes came in too fast
+        self.frame_time = DurationCounter()
         self.funcg_rate = funcg_rate
-        self.CIRCLEPLOTwritechunksize = 800
+        self.CIRCLEPLOTwritechunksize = self.funcg_rate // 10  # One period of the 10 Hz wave plotted below
         self.vmulti = vmulti
         self.freq = freq
         self.camber = camber
         self.zphase = zphase
+        self.shape = 'Rotating'
+        self.shape_parameters = {}
 
         self.pts = self.WaveGen.generate_waves(
             funcg_rate=self.funcg_rate,
@@ -82,6 +262,49 @@ class ThreeDPlot(gl.GLViewWidget):
         self.last_update = 0.1
         self.plot_data(firstrun=True)
 
+        # Trace of the measured field, created when first shown. The newest part of the trace is the brightest
+        self.trace = None
+        self.show_measured = False
+        self.trace_line = None
+        self.trace_colors = np.ones([trace_vertices, 4], dtype=np.float32)
+        self.trace_colors[:, 2] = 0.2
+        self.trace_colors[:, 3] = np.linspace(0.05, 1, trace_vertices)
+        self.trace_timer = QtCore.QTimer()
+        self.trace_timer.setInterval(int(1000 / trace_fps))
+        self.trace_timer.timeout.connect(self.update_trace)
+
+    def set_trace(self, trace):
+        """Draw the measured field from a FieldTrace with trace_vertices vertices, or None for no measured field."""
+        self.trace = trace
+        if trace is not None:
+            trace.enabled = self.show_measured
+
+    def set_show_measured(self, on):
+        """Show or hide the trace of the measured field."""
+        self.show_measured = on
+        if self.trace is not None:
+            self.trace.enabled = on
+        if on and self.trace_line is None:
+            self.trace_line = gl.GLLinePlotItem(pos=np.zeros([len(self.trace_colors), 3], dtype=np.float32),
+                                                color=self.trace_colors, width=2, antialias=True, mode='line_strip')
+            self.addItem(self.trace_line)
+        if self.trace_line is not None:
+            self.trace_line.setVisible(on)
+        if on:
+            self.trace_timer.start()
+        else:
+            self.trace_timer.stop()
+
+    @tracing.traced('ThreeDPlot trace')
+    def update_trace(self):
+        """Copy the newest measured field into the vertex array of the trace."""
+        if self.trace is None:
+            return
+        start = perf_counter()
+        self.trace_line.setData(pos=self.trace.vertices())
+        self.frame_time.add(perf_counter() - start)
+
+    @tracing.traced('ThreeDPlot redraw')
     def plot_data(self, firstrun=False):
         """
         On a change in signal design properties, plot a new circle.
@@ -91,7 +314,7 @@ class ThreeDPlot(gl.GLViewWidget):
         time_elapsed = now - self.last_update
 
         if time_elapsed < 0.07:  # Basically, if a bunch of changes are made fast, skip plotting
-            pass
+            self.dropped_frames += 1
         else:  # Continue along and plot
             self.last_update = now
             # print(time_elapsed)
@@ -100,6 +323,7 @@ class ThreeDPlot(gl.GLViewWidget):
                 for i, e in enumerate(self.last_lines):
                     self.removeItem(self.last_lines[i])
 
+            self.WaveGen.reset()  # Always start the loop at the same point so the colored segments don't move
             self.pts = self.WaveGen.generate_waves(
                 funcg_rate=self.funcg_rate,
                 writechunksize=self.CIRCLEPLOTwritechunksize,
@@ -107,7 +331,9 @@ class ThreeDPlot(gl.GLViewWidget):
                 freq=10,
                 camber=self.camber,
                 zphase=self.zphase,
-                zcoeff=1)
+                zcoeff=1,
+                shape=self.shape,
+                shape_parameters=self.shape_parameters)
 
             # Plot 4 line segments, two of which are blue.
             self.last_lines = []  # To clear previous lines when a new circle is plotted
@@ -122,3 +348,4 @@ class ThreeDPlot(gl.GLViewWidget):
                                          width=5, antialias=True)
                 self.addItem(line)
                 self.last_lines.append(line)
+            self.frame_time.add(pg.ptime.time() - now)
@@ -0,0 +1,95 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+class SessionRecorder:
+    """Records the acquired chunks of a session to disk, so they can be replayed or analysed later.
+
+    The samples are appended as raw float64 values, one row of all channels per sample, to `<path>`. The rate and
+    channel names are kept in a small JSON sidecar `<path>.json`. This layout can be memory-mapped directly, see
+    open_session.
+
+    Chunks can be handed over with write_in_background from the acquisition thread, they are then written in order on
+    a background thread, so neither the source nor the GUI waits for the disk.
+
+    Attributes:
+        path (str): the file the samples are written to
+        daq_rate (int): sample rate of the recorded data
+        channels (list): names of the recorded channels
+        samples (int): number of samples per channel written so far
+        first_index (int): sample index of the acquisition at the first recorded sample, to align the recording with
+            a parameter log, None while nothing was written through write_chunk
+    """
+    def __init__(self, path, daq_rate, channels):
+        self.path = path
+        self.daq_rate = daq_rate
+        self.channels = list(channels)
+        self.samples = 0
+        self.first_index = None
+        self.file = open(path, 'wb')
+        self.executor = ThreadPoolExecutor(max_workers=1)  # Only starts a thread once write_in_background is used
+        self.write_info()
+
+    def write_info(self):
+        with open(self.path + '.json', 'w') as f:
+            json.dump({'daq_rate': self.daq_rate, 'channels': self.channels, 'dtype': '<f8',
+                       'samples': self.samples, 'first_index': self.first_index}, f)
+
+    def write(self, chunk):
+        """Append a chunk as emitted by the SignalReader.
+
+        Args:
+            chunk: a [channels, samples] array
+        """
+        self.file.write(np.ascontiguousarray(np.transpose(chunk), dtype='<f8').tobytes())
+        self.samples += np.shape(chunk)[1]
+
+    def write_chunk(self, start_index, chunk):
+        """Append a chunk as emitted through the newChunk signal, remembering where the recording started."""
+        if self.first_index is None:
+            self.first_index = int(start_index)
+        self.write(chunk)
+
+    def write_in_background(self, start_index, chunk):
+        """Slot for the newChunk signal with a direct connection: write_chunk on the background thread. The chunk is
+        copied, as sources may reuse their output array."""
+        try:
+            self.executor.submit(self.write_chunk, start_index, np.array(chunk))
+        except RuntimeError:  # A chunk emitted while the recorder was being closed
+            pass
+
+    def close(self):
+        """Wait for the chunks still being written and close the file."""
+        self.executor.shutdown(wait=True)
+        self.file.close()
+        self.write_info()
+
+
+def open_session(path):
+    """Memory-map a recorded session.
+
+    Args:
+        path (str): a file written by SessionRecorder, or a .npy file of shape [samples, channels] with an optional
+            `<path>.json` sidecar giving its 'daq_rate'
+
+    Returns:
+        data: a read-only [samples, channels] array backed by the file, info: dictionary with 'daq_rate' and
+        'channels'
+    """
+    info = {}
+    if os.path.exists(path + '.json'):
+        with open(path + '.json') as f:
+            info = json.load(f)
+
+    if path.endswith('.npy'):
+        data = np.load(path, mmap_mode='r')
+        info.setdefault('channels', [f'ai{i}' for i in range(data.shape[1])])
+    else:
+        channels = info['channels']
+        data = np.memmap(path, dtype=info.get('dtype', '<f8'), mode='r')
+        data = data[:len(data) - len(data) % len(channels)].reshape(-1, len(channels))
+
+    info.setdefault('daq_rate', 1000)
+    return data, info
@@ -2,6 +2,12 @@ from pyqtgraph.Qt import QtCore
 from pyqtgraph.parametertree import Parameter, ParameterTree
 from pyqtgraph.Qt import QtWidgets, QtGui
 import ast  # For literal interpretations of settings inputs
+import copy
+import os
+import numpy as np
+from misc_functions import load_device_cache, get_device_capabilities, max_ai_rate
+from waves import select_write_timing
+import shapes
 
 
 class SettingsWindow(QtWidgets.QDialog):
@@ -14,8 +20,12 @@ class SettingsWindow(QtWidgets.QDialog):
         qsettings: an instantiated version of QSettings, where all of the persistent settings are saved on the host
             computer.
         qss: all of the save locations of values in QSettings, in the form "Read Parameters/DAQ Name"
+        applied: the value of every setting in qss as last applied to the application
         t: the settings parameter tree object
+        devices: the device capabilities cached by the DeviceRegistry thread, used to validate the settings
     """
+    settingsApplied = QtCore.pyqtSignal(object)  # The changed settings as 'Branch/Setting' strings, see closeEvent
+
     def __init__(self):
         super().__init__()
 
@@ -29,11 +39,33 @@ class SettingsWindow(QtWidgets.QDialog):
                 {'name': 'DAQ Name', 'type': 'str', 'value': "Dev1"},
                 {'name': 'Read Channel List', 'type': 'str', 'value': "['ai0', 'ai1', 'ai2', 'ai3', 'ai4', 'ai5']"},
                 {'name': 'DAQ Read Rate [sps]', 'type': 'int', 'value': 1000},
-                {'name': 'Read Chunk Size', 'type': 'int', 'value': 100}
+                {'name': 'Read Chunk Size', 'type': 'int', 'value': 100},
+                {'name': 'Display Rate [sps]', 'type': 'int', 'value': 1000,
+                 'tip': "The signal plot shows the acquired signals decimated to about this rate, so the read rate "
+                        "can be raised for recording and analysis without slowing down the plot"},
+                {'name': 'Display Duration [s]', 'type': 'float', 'value': 0.1, 'step': 0.1,
+                 'tip': "Length of the history shown in the signal plot"},
+                {'name': 'Field Monitor Channels', 'type': 'str', 'value': '[0, 1, 2]',
+                 'tip': "Index in the read channel list of the monitor of each write channel of Rig 1, used to show "
+                        "the measured field in the 3D plot"},
+                {'name': 'Field Monitor Gain', 'type': 'float', 'value': 1.0, 'step': 0.1,
+                 'tip': "Coil volts per volt on the field monitor channels"},
+                {'name': 'Shared Start Trigger', 'type': 'bool', 'value': False,
+                 'tip': "Start reading on the start trigger of the function generator, so the read and write samples "
+                        "are aligned exactly. Reading then waits until the output tasks have started."}
             ]},
             {'name': 'Write Parameters', 'type': 'group', 'children': [
                 {'name': 'Function Gen. Name', 'type': 'str', 'value': "cDAQ1Mod1"},
-                {'name': 'Write Channel List', 'type': 'str', 'value': '[0, 1, 2]'}
+                {'name': 'Write Channel List', 'type': 'str', 'value': '[0, 1, 2]'},
+                {'name': 'Calibration Matrix', 'type': 'str', 'value': '[[1, 0, 0], [0, 1, 0], [0, 0, 1]]',
+                 'tip': "One row per write channel with the x, y and z field gains of that coil"},
+                {'name': 'Calibration Offsets', 'type': 'str', 'value': '[0, 0, 0]',
+                 'tip': "One constant offset per write channel"},
+                {'name': 'Additional Rigs', 'type': 'str', 'value': '[]',
+                 'tip': "Other coil systems as [('Device Name', [0, 1, 2]), ...], optionally followed by a "
+                        "calibration matrix and offsets: ('Device Name', [0, 1, 2], matrix, offsets)"},
+                {'name': 'Samples per Period', 'type': 'int', 'value': 100, 'step': 10},
+                {'name': 'Write Latency [ms]', 'type': 'int', 'value': 25, 'step': 5}
             ]},
             {'name': 'Default Signal Values', 'type': 'group', 'children': [
                 {'name': 'Z-Coefficient', 'type': 'float', 'value': 0.653, 'step': 0.001},
@@ -42,7 +74,23 @@ class SettingsWindow(QtWidgets.QDialog):
                  'suffix': 'Hz'},
                 {'name': 'Z-Phase', 'type': 'int', 'value': 270, 'step': 1},
                 {'name': 'Field Camber', 'type': 'int', 'value': 60, 'step': 1, 'siPrefix': True,
-                 'suffix': '°'}
+                 'suffix': '°'},
+                {'name': 'Custom Field Shapes', 'type': 'str', 'value': '[]',
+                 'tip': "Extra field shapes as [('Name', 'x', 'y', 'z'), ...], optionally followed by a dict of "
+                        "parameters. The x, y and z expressions may use t, I, camber, zphase, cos_t, sin_t, numpy "
+                        "functions such as sin and the parameters, e.g. ('Tilted', 'I * cos_t', 'I * sin_t', "
+                        "'I * tilt', {'tilt': 0.3})"}
+            ]},
+            {'name': 'Triggered Capture', 'type': 'group', 'children': [
+                {'name': 'Pre-Trigger [s]', 'type': 'float', 'value': 0.5, 'step': 0.1,
+                 'tip': "Full-rate history kept in memory and saved from before each trigger"},
+                {'name': 'Post-Trigger [s]', 'type': 'float', 'value': 1.0, 'step': 0.1},
+                {'name': 'Capture Folder', 'type': 'str', 'value': '',
+                 'tip': "Where the captures are written, empty to turn triggered capture off"},
+                {'name': 'Threshold Channel', 'type': 'int', 'value': -1,
+                 'tip': "Index in the read channel list of the channel whose rising crossings of the threshold "
+                        "level trigger a capture, -1 to not trigger on a threshold"},
+                {'name': 'Threshold Level', 'type': 'float', 'value': 1.0, 'step': 0.1, 'suffix': 'V'}
             ]}
         ]
 
@@ -50,31 +98,16 @@ class SettingsWindow(QtWidgets.QDialog):
         self.qsettings = QtCore.QSettings("MarrLabCSM", "MuControl")  # Instantiate settings object
         self.qss = self.get_parameter_strings()  # pulling all default strings
 
-        # Edge case: if this is the first time running the program or the settings are missing, use defaults.
-        if self.qsettings.value(self.qss[0]) is None:
-            self.save_default_settings()
+        # Edge case: if this is the first time running the program or some settings are missing (e.g. settings added
+        # in a newer version), use the defaults for those.
+        self.save_default_settings(missing_only=True)
+
+        # Same structure as the defaults, but with the values read in from QSettings
+        self.params = copy.deepcopy(self.default_params)
+        for branch in self.params:
+            for child in branch['children']:
+                child['value'] = self.qsettings.value(f"{branch['name']}/{child['name']}")
 
-        self.params = [
-            {'name': 'Read Parameters', 'type': 'group', 'children': [
-                {'name': 'DAQ Name', 'type': 'str', 'value': self.qsettings.value(self.qss[0])},
-                {'name': 'Read Channel List', 'type': 'str', 'value': self.qsettings.value(self.qss[1])},
-                {'name': 'DAQ Read Rate [sps]', 'type': 'int', 'value': self.qsettings.value(self.qss[2])},
-                {'name': 'Read Chunk Size', 'type': 'int', 'value': self.qsettings.value(self.qss[3])}
-            ]},
-            {'name': 'Write Parameters', 'type': 'group', 'children': [
-                {'name': 'Function Gen. Name', 'type': 'str', 'value': self.qsettings.value(self.qss[4])},
-                {'name': 'Write Channel List', 'type': 'str', 'value': self.qsettings.value(self.qss[5])}
-            ]},
-            {'name': 'Default Signal Values', 'type': 'group', 'children': [
-                {'name': 'Z-Coefficient', 'type': 'float', 'value': self.qsettings.value(self.qss[6]), 'step': 0.001},
-                {'name': 'Voltage Multiplier', 'type': 'float', 'value': self.qsettings.value(self.qss[7]), 'step': 0.25},
-                {'name': 'Frequency', 'type': 'float', 'value': self.qsettings.value(self.qss[8]), 'step': 10,
-                 'siPrefix': True, 'suffix': 'Hz'},
-                {'name': 'Z-Phase', 'type': 'int', 'value': self.qsettings.value(self.qss[9]), 'step': 1},
-                {'name': 'Field Camber', 'type': 'int', 'value': self.qsettings.value(self.qss[10]), 'step': 1,
-                 'siPrefix': True, 'suffix': '°'}
-            ]}
-        ]
         # Load the above parameter object into the parameter tree widget
         self.p = Parameter.create(name='self.params', type='group', children=self.params)
         self.t = ParameterTree()
@@ -84,16 +117,28 @@ class SettingsWindow(QtWidgets.QDialog):
         self.savebtn = QtWidgets.QPushButton('Save and Close')
         self.savebtn.clicked.connect(self.close)
 
+        # Label listing any problems found when checking the settings against the connected devices
+        self.validationlbl = QtWidgets.QLabel()
+        self.validationlbl.setWordWrap(True)
+        self.validationlbl.setStyleSheet('color: red')
+
         # Set layout
         layout = QtGui.QVBoxLayout()
         layout.addWidget(self.t)
-        layout.addWidget(QtWidgets.QLabel('After clicking the save button below, restart the application to use the'\
-                                          ' new settings!'))
+        layout.addWidget(self.validationlbl)
+        layout.addWidget(QtWidgets.QLabel('The new settings are applied when clicking the save button below, only the'
+                                          ' affected devices are restarted.'))
         layout.addWidget(self.savebtn)
         self.setLayout(layout)
 
+        # Device capabilities from the last session, refreshed by on_devices_changed once the registry has scanned
+        self.devices = load_device_cache()
+        self.p.sigTreeStateChanged.connect(self.show_validation)
+
         # Initialize variable aliases
         self.initialize_variable_aliases()
+        self.applied = self.current_values()
+        self.show_validation()
 
     def get_parameter_strings(self):
         """
@@ -125,13 +170,19 @@ class SettingsWindow(QtWidgets.QDialog):
             val = self.p.param(branch, child).value()
             self.qsettings.setValue(string, val)
 
-    def save_default_settings(self):
+    def save_default_settings(self, missing_only=False):
         """
         Go through the default parameter tree and save its values into the QSettings memory.
+
+        Args:
+            missing_only (bool): only save the defaults of settings which are not in QSettings yet
         """
         for branch in self.default_params:
             for index, child in enumerate(branch['children']):
-                self.qsettings.setValue(f"{branch['name']}/{child['name']}", child['value'])
+                string = f"{branch['name']}/{child['name']}"
+                if missing_only and self.qsettings.value(string) is not None:
+                    continue
+                self.qsettings.setValue(string, child['value'])
 
 
     def initialize_variable_aliases(self):
@@ -144,13 +195,23 @@ class SettingsWindow(QtWidgets.QDialog):
         self.readchannel_list = ast.literal_eval(self.getParamValue('Read Parameters', 'Read Channel List'))
         self.daq_rate = int(self.getParamValue('Read Parameters', 'DAQ Read Rate [sps]'))
         self.readchunksize = int(self.getParamValue('Read Parameters', 'Read Chunk Size'))
+        self.display_rate = int(self.getParamValue('Read Parameters', 'Display Rate [sps]'))
+        self.display_duration = float(self.getParamValue('Read Parameters', 'Display Duration [s]'))
+        self.field_channels = ast.literal_eval(self.getParamValue('Read Parameters', 'Field Monitor Channels'))
+        self.field_gain = float(self.getParamValue('Read Parameters', 'Field Monitor Gain'))
+        self.shared_start_trigger = self.getParamValue('Read Parameters', 'Shared Start Trigger') in (True, 'true')
 
         # WRITE
         self.funcg_name = self.getParamValue('Write Parameters', 'Function Gen. Name')
         self.writechannel_list = ast.literal_eval(self.getParamValue('Write Parameters', 'Write Channel List'))
-        self.funcg_rate = 8000 
-        self.writechunksize = 200
-        print(f'Signal Refresh Rate = {self.funcg_rate / self.writechunksize}')  # Should print 40, as 8000 sps / 200 chunks = 40 updates per second
+        self.rigs = [self.rig_dict('Rig 1', self.funcg_name, self.writechannel_list,
+                                   ast.literal_eval(self.getParamValue('Write Parameters', 'Calibration Matrix')),
+                                   ast.literal_eval(self.getParamValue('Write Parameters', 'Calibration Offsets')))]
+        for index, rig in enumerate(ast.literal_eval(self.getParamValue('Write Parameters', 'Additional Rigs'))):
+            self.rigs.append(self.rig_dict(f'Rig {index + 2}', *rig))
+        self.samples_per_period = int(self.getParamValue('Write Parameters', 'Samples per Period'))
+        self.write_latency = int(self.getParamValue('Write Parameters', 'Write Latency [ms]')) / 1000
+        self.funcg_max_rate = self.write_rate_limit()
 
         # DEFAULT SIGNAL VALUES
         self.defaults = {
@@ -164,7 +225,194 @@ class SettingsWindow(QtWidgets.QDialog):
             'calib_zamp': 1
             }
 
+        # TRIGGERED CAPTURE
+        threshold_channel = int(self.getParamValue('Triggered Capture', 'Threshold Channel'))
+        self.capture = {
+            'pre': float(self.getParamValue('Triggered Capture', 'Pre-Trigger [s]')),
+            'post': float(self.getParamValue('Triggered Capture', 'Post-Trigger [s]')),
+            'folder': self.getParamValue('Triggered Capture', 'Capture Folder'),
+            'threshold_channel': threshold_channel if threshold_channel >= 0 else None,
+            'threshold_level': float(self.getParamValue('Triggered Capture', 'Threshold Level'))
+            }
+
+        # Custom field shapes join the built-in ones in the registry of shapes.py, so the parameter tree lists them
+        for shape in self.custom_shapes():
+            try:
+                shapes.register(shapes.FieldShape(*shape))
+            except (ValueError, SyntaxError, TypeError) as e:
+                print(f'Skipping custom field shape {shape[0]}: {e}')
+
+        # The write rate and chunk size are chosen from the signal requirements, the SignalWriter re-selects them
+        # whenever the commanded frequency changes.
+        self.funcg_rate, self.writechunksize = select_write_timing(
+            max_freq=self.defaults['freq'],
+            max_rate=self.funcg_max_rate,
+            samples_per_period=self.samples_per_period,
+            latency=self.write_latency)
+        print(f'Signal Refresh Rate = {self.funcg_rate / self.writechunksize}')  # Should print 40 with a latency of 25 ms
+
+
+    @staticmethod
+    def rig_dict(name, funcg_name, writechannel_list, matrix=None, offsets=None):
+        """Describe one coil system for the SignalWriter.
+
+        Without a calibration matrix, the first three write channels get the x, y and z field and any further
+        channels get nothing.
+
+        Args:
+            name (str): name shown in the parameter tree
+            funcg_name (str): name given to the NI card by the drivers
+            writechannel_list (list): list containing all of the connected channels
+            matrix (list): calibration matrix with one [x, y, z] row per write channel
+            offsets (list): constant offset of each write channel
+
+        Returns:
+            a dictionary with the rig description
+        """
+        if matrix is None:
+            matrix = np.eye(len(writechannel_list), 3).tolist()
+        if offsets is None:
+            offsets = [0] * len(writechannel_list)
+        return {'name': name, 'funcg_name': funcg_name, 'writechannel_list': writechannel_list,
+                'matrix': matrix, 'offsets': offsets}
+
+    def write_rate_limit(self, fallback=8000):
+        """The maximum write rate shared by the function generators of all rigs, from the capabilities cached by the
+        DeviceRegistry.
+
+        Args:
+            fallback (int): the rate used for devices whose capabilities are not known yet
+
+        Returns:
+            the maximum rate in samples per second
+        """
+        limits = []
+        for rig in self.rigs:
+            device = get_device_capabilities(rig['funcg_name'], self.devices)
+            if device is None or device['ao_max_rate'] <= 0:
+                limits.append(fallback)
+            else:
+                limits.append(int(device['ao_max_rate']))
+        return min(limits)
+
+    def custom_shapes(self):
+        """The custom field shapes from the settings as a list of (name, x, y, z[, parameters]) tuples."""
+        try:
+            return list(ast.literal_eval(self.getParamValue('Default Signal Values', 'Custom Field Shapes')))
+        except (ValueError, SyntaxError):
+            return []
+
+    def validate_settings(self):
+        """Check the settings in the parameter tree against the cached device capabilities.
+
+        Devices that have never been seen are reported, but channel and rate checks are only done for devices whose
+        capabilities are known.
+
+        Returns:
+            a list of strings describing each problem, empty if the settings look valid
+        """
+        problems = []
+        try:
+            readchannel_list = ast.literal_eval(self.getParamValue('Read Parameters', 'Read Channel List'))
+            writechannel_list = ast.literal_eval(self.getParamValue('Write Parameters', 'Write Channel List'))
+            additional_rigs = ast.literal_eval(self.getParamValue('Write Parameters', 'Additional Rigs'))
+            rigs = [self.rig_dict('Rig 1', self.getParamValue('Write Parameters', 'Function Gen. Name'),
+                                  writechannel_list,
+                                  ast.literal_eval(self.getParamValue('Write Parameters', 'Calibration Matrix')),
+                                  ast.literal_eval(self.getParamValue('Write Parameters', 'Calibration Offsets')))]
+            rigs += [self.rig_dict(f'Rig {index + 2}', *rig) for index, rig in enumerate(additional_rigs)]
+        except (ValueError, SyntaxError, TypeError):
+            return ['The channel, matrix and rig lists must be python lists, e.g. [0, 1, 2].']
+
+        for rig in rigs:
+            if np.shape(rig['matrix']) != (len(rig['writechannel_list']), 3):
+                problems.append(f"The calibration matrix of {rig['name']} needs one [x, y, z] row per write channel.")
+            if np.shape(rig['offsets']) != (len(rig['writechannel_list']),):
+                problems.append(f"The calibration offsets of {rig['name']} need one value per write channel.")
+
+        try:
+            ast.literal_eval(self.getParamValue('Default Signal Values', 'Custom Field Shapes'))
+        except (ValueError, SyntaxError):
+            problems.append('The custom field shapes must be a python list of tuples.')
+        for shape in self.custom_shapes():
+            try:
+                shapes.FieldShape(*shape).kernel()
+            except (ValueError, SyntaxError, TypeError) as e:
+                problems.append(f'Custom field shape {shape[0] if shape else shape}: {e}')
+
+        try:
+            field_channels = ast.literal_eval(self.getParamValue('Read Parameters', 'Field Monitor Channels'))
+            if len(field_channels) != len(writechannel_list) or \
+                    not all(0 <= index < len(readchannel_list) for index in field_channels):
+                problems.append('The field monitor channels need the index of one read channel per write channel of '
+                                'Rig 1.')
+        except (ValueError, SyntaxError, TypeError):
+            problems.append('The field monitor channels must be a python list, e.g. [0, 1, 2].')
+
+        capture_folder = self.getParamValue('Triggered Capture', 'Capture Folder')
+        if capture_folder and not os.path.isdir(capture_folder):
+            problems.append(f'The capture folder {capture_folder} does not exist.')
+        if int(self.getParamValue('Triggered Capture', 'Threshold Channel')) >= len(readchannel_list):
+            problems.append('The threshold channel must be the index of one of the read channels.')
+
+        # READ
+        daq_name = self.getParamValue('Read Parameters', 'DAQ Name')
+        daq_rate = int(self.getParamValue('Read Parameters', 'DAQ Read Rate [sps]'))
+        device = get_device_capabilities(daq_name, self.devices)
+        if device is None or not device['connected']:
+            problems.append(f'Read device {daq_name} is not connected.')
+        if device is not None:
+            missing = [c for c in readchannel_list if c not in device['ai_channels']]
+            if missing:
+                problems.append(f'{daq_name} has no analog input channels {missing}.')
+            max_rate = max_ai_rate(device, len(readchannel_list))
+            if 0 < max_rate < daq_rate:
+                problems.append(f'{daq_name} can read {len(readchannel_list)} channels at most at '
+                                f'{max_rate:.0f} sps.')
+
+        # WRITE, every rig
+        for rig in rigs:
+            funcg_name, writechannel_list = rig['funcg_name'], rig['writechannel_list']
+            device = get_device_capabilities(funcg_name, self.devices)
+            if device is None or not device['connected']:
+                problems.append(f'Write device {funcg_name} is not connected.')
+            if device is not None:
+                missing = [i for i in writechannel_list if f'ao{i}' not in device['ao_channels']]
+                if missing:
+                    problems.append(f'{funcg_name} has no analog output channels {missing}.')
+
+        return problems
+
+    def show_validation(self, *args):
+        """Validate the settings and list any problems in the settings window."""
+        self.validationlbl.setText('<br>'.join(self.validate_settings()))
+
+    def on_devices_changed(self, devices):
+        """Slot for the DeviceRegistry thread, which emits the device cache whenever devices are added or removed.
+
+        Args:
+            devices (dict): device dictionaries keyed by device serial
+        """
+        self.devices = devices
+        self.show_validation()
+
+    def current_values(self):
+        """The value of every setting, keyed by its location in QSettings."""
+        return {string: self.p.param(*string.split('/')).value() for string in self.qss}
 
     def closeEvent(self, evnt):
         print('Dialog was closed.')
         self.save_settings()
+
+        # Apply the changed settings to the running application
+        values = self.current_values()
+        changed = [string for string in self.qss if values[string] != self.applied[string]]
+        if not changed:
+            return
+        try:
+            self.initialize_variable_aliases()
+        except (ValueError, SyntaxError, TypeError, IndexError) as e:
+            print(f'The new settings could not be applied: {e}')
+            return
+        self.applied = values
+        self.settingsApplied.emit(changed)
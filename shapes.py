@@ -0,0 +1,115 @@
+import ast
+import functools
+import numpy as np
+
+# Names an expression may use besides the shape's own parameters. Angles are in radians.
+FUNCTIONS = {name: getattr(np, name) for name in (
+    'sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan', 'arctan2', 'sinh', 'cosh', 'tanh', 'exp', 'log', 'sqrt',
+    'abs', 'sign', 'mod', 'where', 'clip', 'minimum', 'maximum', 'radians', 'degrees')}
+FUNCTIONS['pi'] = np.pi
+VARIABLES = ('t', 'I', 'camber', 'zphase', 'cos_t', 'sin_t')
+MAX_PARAMETERS = 8  # Parameters per shape, fixed so every parameter snapshot has the same width (see alignment.py)
+
+
+class FieldShape:
+    """A field shape, given as expressions of the x, y and z field.
+
+    The expressions are numpy expressions of the phase `t` of each sample, the voltage multiplier `I`, the `camber`
+    and `zphase` in radians, `cos_t` and `sin_t`, the functions in FUNCTIONS and the shape's own parameters, e.g.
+
+        FieldShape('Elliptical', 'I * (sin(zphase) * cos_t - ratio * sin(camber) * cos(zphase) * sin_t)', ...,
+                   parameters={'ratio': 0.5})
+
+    Attributes:
+        name (str): name shown in the parameter tree
+        expressions (tuple): the x, y and z expressions
+        parameters (dict): the shape's own parameters and their default values, at most MAX_PARAMETERS
+    """
+    def __init__(self, name, x, y, z, parameters=None):
+        self.name = name
+        self.expressions = (x, y, z)
+        self.parameters = dict(parameters or {})
+        if len(self.parameters) > MAX_PARAMETERS:
+            raise ValueError(f'Field shape {name} has more than {MAX_PARAMETERS} parameters')
+
+    def kernel(self, **parameters):
+        """The compiled kernel of this shape, see compile_kernel. Keyword arguments override the parameters."""
+        values = dict(self.parameters, **parameters)
+        return compile_kernel(self.expressions, tuple(sorted((name, float(v)) for name, v in values.items())))
+
+
+def check_expression(expression, names):
+    """Raise a ValueError unless the expression is plain arithmetic of the allowed names and function calls."""
+    tree = ast.parse(expression.strip(), mode='eval')
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id not in names:
+            raise ValueError(f"Unknown name '{node.id}' in field expression '{expression}'")
+        if isinstance(node, ast.Call) and not isinstance(node.func, ast.Name):
+            raise ValueError(f"Only the listed functions can be called in field expression '{expression}'")
+        if isinstance(node, (ast.Attribute, ast.Subscript, ast.Lambda, ast.comprehension)):
+            raise ValueError(f"Field expressions can't use '{type(node).__name__}', in '{expression}'")
+
+
+@functools.lru_cache(maxsize=128)
+def compile_kernel(expressions, parameters):
+    """Compile the x, y and z expressions of a shape into a single vectorized function.
+
+    The parameter values are baked in as defaults of the function, so each combination of expressions and parameter
+    values is compiled once and then cached. cos_t and sin_t are only calculated when an expression uses them.
+
+    Args:
+        expressions (tuple): the x, y and z expressions
+        parameters (tuple): sorted (name, value) pairs of the shape's parameters
+
+    Returns:
+        a function kernel(t, I, camber, zphase) returning the x, y and z field, each broadcastable against t
+    """
+    names = set(FUNCTIONS) | set(VARIABLES) | {name for name, _ in parameters}
+    for expression in expressions:
+        check_expression(expression, names)
+
+    arguments = ''.join(f', {name}={value!r}' for name, value in parameters)
+    used = {node.id for expression in expressions for node in ast.walk(ast.parse(expression.strip(), mode='eval'))
+            if isinstance(node, ast.Name)}
+    lines = [f'def kernel(t, I, camber, zphase{arguments}):']
+    if 'cos_t' in used:
+        lines.append('    cos_t = cos(t)')
+    if 'sin_t' in used:
+        lines.append('    sin_t = sin(t)')
+    lines.append('    return ({}), ({}), ({})'.format(*(expression.strip() for expression in expressions)))
+
+    namespace = {'__builtins__': {}, **FUNCTIONS}
+    exec(compile('\n'.join(lines), f'<field shape {expressions}>', 'exec'), namespace)
+    return namespace['kernel']
+
+
+_ROTATING = ('I * (sin(zphase) * cos_t - {s}sin(camber) * cos(zphase) * sin_t)',
+             '-I * (cos(zphase) * cos_t + {s}sin(camber) * sin(zphase) * sin_t)',
+             'I * ({s}cos(camber) * sin_t)')
+_PULSE = '(mod(t, 2 * pi) < 2 * pi * duty) * '
+
+SHAPES = {}
+
+
+def register(shape):
+    """Add a shape to the registry, replacing any shape with the same name. Compiles it to catch errors early."""
+    shape.kernel()
+    SHAPES[shape.name] = shape
+
+
+def get(name):
+    return SHAPES[name]
+
+
+def names():
+    return list(SHAPES)
+
+
+register(FieldShape('Rotating', *(e.format(s='') for e in _ROTATING)))
+register(FieldShape('Elliptical', *(e.format(s='ratio * ') for e in _ROTATING), parameters={'ratio': 0.5}))
+register(FieldShape('Conical Precession', 'I * sin(radians(cone)) * cos_t', 'I * sin(radians(cone)) * sin_t',
+                    'I * cos(radians(cone))', parameters={'cone': 30}))
+register(FieldShape('Pulsed', *(_PULSE + e.format(s='') for e in _ROTATING), parameters={'duty': 0.5}))
+register(FieldShape('Rotating + DC Bias',
+                    *(e.format(s='') + f' + I * bias_{axis}' for e, axis in zip(_ROTATING, 'xyz')),
+                    parameters={'bias_x': 0, 'bias_y': 0, 'bias_z': 0.5}))
@@ -0,0 +1,113 @@
+import math
+import threading
+import numpy as np
+
+
+class HeadingController:
+    """Computes the Z-Phase that steers a swarm toward a target or along a path of waypoints.
+
+    Every position estimate gives the direction from the swarm to the current waypoint. Once the swarm is within
+    *tolerance* of the waypoint, it steers toward the next one. The direction is turned into a Z-Phase with
+    *heading_sign* and *heading_offset*: a rolling swarm moves along the Z-Phase minus 90° in the x-y plane of the
+    coils, so the defaults suit positions in coil coordinates. For camera pixels (y pointing down, rotated camera),
+    adjust the sign and offset to match the setup.
+
+    Only scalar math is used, numpy scalars would make an update take several times longer, so one update takes a
+    few microseconds.
+
+    The waypoints can be replaced from another thread, e.g. the command API, while the steering thread updates: the
+    new path is queued and taken up at the start of the next update.
+
+    Attributes:
+        waypoints (list): (x, y) points to visit in order, in the units of the position estimates
+        index (int): the waypoint currently steered toward
+        tolerance (float): distance at which a waypoint counts as reached
+        max_turn_rate (float): fastest change of the Z-Phase in °/s, None for no limit
+        loop (bool): start over with the first waypoint after the last one
+        zphase (float): the most recent Z-Phase, None before the first update
+    """
+    def __init__(self, waypoints=(), tolerance=20.0, max_turn_rate=None, heading_offset=90.0, heading_sign=1.0,
+                 loop=False):
+        self.tolerance = tolerance
+        self.max_turn_rate = max_turn_rate
+        self.heading_offset = heading_offset
+        self.heading_sign = heading_sign
+        self.loop = loop
+        self.lock = threading.Lock()
+        self.pending_waypoints = None
+        self.set_waypoints(waypoints)
+        self.take_waypoints()
+
+    def set_waypoints(self, waypoints):
+        """Replace the path, a single (x, y) target is a path of one waypoint. Safe to call from any thread.
+
+        Raises:
+            ValueError: if a coordinate is not a finite number
+        """
+        waypoints = [(float(x), float(y)) for x, y in waypoints]
+        if not np.all(np.isfinite(waypoints)):
+            raise ValueError('Waypoints must be finite numbers')
+        with self.lock:
+            self.pending_waypoints = waypoints
+
+    def take_waypoints(self):
+        """Start over on the path queued by set_waypoints, if there is one."""
+        with self.lock:
+            waypoints, self.pending_waypoints = self.pending_waypoints, None
+        if waypoints is not None:
+            self.waypoints = waypoints
+            self.index = 0
+            self.zphase = None
+            self.last_time = None
+
+    @property
+    def finished(self):
+        return self.index >= len(self.waypoints)
+
+    def update(self, x, y, t):
+        """Steer from a new position estimate.
+
+        Args:
+            x, y (float): estimated position of the swarm
+            t (float): time of the estimate in s
+
+        Returns:
+            the Z-Phase in °, or None once the last waypoint is reached
+        """
+        if self.pending_waypoints is not None:
+            self.take_waypoints()
+        while not self.finished:
+            target_x, target_y = self.waypoints[self.index]
+            dx, dy = target_x - x, target_y - y
+            if dx * dx + dy * dy > self.tolerance * self.tolerance:
+                break
+            self.index += 1
+            if self.finished and self.loop:
+                self.index = 0
+                if len(self.waypoints) == 1:
+                    break
+        if self.finished:
+            return None
+
+        zphase = (self.heading_sign * math.degrees(math.atan2(dy, dx)) + self.heading_offset) % 360
+        if self.max_turn_rate is not None and self.zphase is not None:
+            limit = self.max_turn_rate * max(t - self.last_time, 0.0)
+            turn = (zphase - self.zphase + 180) % 360 - 180
+            zphase = (self.zphase + max(-limit, min(limit, turn))) % 360
+        self.zphase, self.last_time = zphase, t
+        return zphase
+
+
+def load_track(path):
+    """Load recorded position estimates for replay.
+
+    Args:
+        path (str): a .npy file or a comma separated text file with the columns t [s], x, y
+
+    Returns:
+        a [n, 3] array of the estimates, sorted by time, without the rows that are not finite
+    """
+    track = np.load(path) if path.endswith('.npy') else np.loadtxt(path, delimiter=',', ndmin=2)
+    track = np.asarray(track, dtype=float)[:, :3]
+    track = track[np.all(np.isfinite(track), axis=1)]
+    return track[np.argsort(track[:, 0], kind='stable')]
@@ -0,0 +1,341 @@
+import itertools
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pyqtgraph.Qt import QtCore
+from command_client import PARAMETERS
+from recording import SessionRecorder
+
+
+def load_plan(path):
+    """Read a sweep definition and expand it into its list of conditions.
+
+    The definition is a JSON file with either a "grid", whose parameters are swept in every combination (the first
+    parameter changes slowest), or a "list" of conditions:
+
+        {"grid": {"freq": [5, 10, 20], "camber": [0, 45, 90], "vmulti": [1, 2]},
+         "settle": 1.0, "dwell": 5.0, "rigs": [0], "record": true}
+
+    Parameters are named like the command API parameters (see command_client.PARAMETERS).
+
+    Returns:
+        a dictionary with the 'conditions' (a list of {parameter: value}), 'settle' and 'dwell' in s, the 'rigs' the
+        conditions are applied to (None for all) and whether to 'record' the dwell of every condition
+    """
+    with open(path) as f:
+        definition = json.load(f)
+    if 'grid' in definition:
+        names = list(definition['grid'])
+        conditions = [dict(zip(names, values)) for values in
+                      itertools.product(*(definition['grid'][name] for name in names))]
+    else:
+        conditions = list(definition['list'])
+    for condition in conditions:
+        for name, value in condition.items():
+            if name not in PARAMETERS:
+                raise ValueError(f'Unknown sweep parameter {name}, use one of {", ".join(PARAMETERS)}')
+            condition[name] = float(value)
+    rigs = definition.get('rigs')
+    if rigs is not None and (not isinstance(rigs, list) or not rigs
+                             or not all(isinstance(rig, int) and rig >= 0 for rig in rigs)):
+        raise ValueError(f'The sweep rigs must be a list of rig numbers, not {rigs}')
+    return {'conditions': conditions, 'settle': float(definition.get('settle', 1.0)),
+            'dwell': float(definition.get('dwell', 5.0)), 'rigs': rigs,
+            'record': bool(definition.get('record', False))}
+
+
+class ChannelSummary:
+    """Running statistics of every channel over a dwell, updated chunk by chunk.
+
+    Besides the mean, standard deviation, RMS and extremes, the amplitude and phase of every channel at the commanded
+    frequency are found by correlating with a complex exponential on the sample clock (a lock-in), which is what the
+    field read back from the coil monitors is compared with.
+    """
+    def __init__(self, daq_rate, freq=None):
+        self.daq_rate = daq_rate
+        self.freq = freq
+        self.count = 0
+        self.total = self.squares = self.minimum = self.maximum = self.phasor = None
+
+    def add(self, start_index, chunk):
+        if self.total is None:
+            n_channels = chunk.shape[0]
+            self.total, self.squares = np.zeros(n_channels), np.zeros(n_channels)
+            self.minimum, self.maximum = np.full(n_channels, np.inf), np.full(n_channels, -np.inf)
+            self.phasor = np.zeros(n_channels, dtype=complex)
+        self.count += chunk.shape[1]
+        self.total += chunk.sum(axis=1)
+        self.squares += np.einsum('ij,ij->i', chunk, chunk)
+        np.minimum(self.minimum, chunk.min(axis=1), out=self.minimum)
+        np.maximum(self.maximum, chunk.max(axis=1), out=self.maximum)
+        if self.freq:
+            indices = np.arange(start_index, start_index + chunk.shape[1])
+            self.phasor += chunk @ np.exp(-2j * np.pi * self.freq * indices / self.daq_rate)
+
+    def result(self):
+        """The statistics as lists, one value per channel, ready to be written as JSON."""
+        if not self.count:
+            return {}
+        mean = self.total / self.count
+        summary = {'samples': self.count, 'mean': mean, 'rms': np.sqrt(self.squares / self.count),
+                   'std': np.sqrt(np.maximum(self.squares / self.count - mean ** 2, 0)), 'min': self.minimum,
+                   'max': self.maximum}
+        if self.freq:
+            summary['amplitude'] = 2 * np.abs(self.phasor) / self.count
+            summary['phase'] = np.angle(self.phasor)
+        return {name: value.tolist() if isinstance(value, np.ndarray) else value for name, value in summary.items()}
+
+
+class SweepRunner(QtCore.QObject):
+    """Steps the writer through the conditions of a parameter sweep and summarises the acquired data of each.
+
+    The runner is driven by the full-rate stream (connect AcquisitionPipeline.newFullRate to process with a direct
+    connection), so all timing is counted in samples of the reader's clock on the source's thread, and parameters are
+    written straight into the writer's state like the command API does, without going through the GUI. For every
+    condition:
+
+        1. the parameters are applied,
+        2. the runner waits until the writer's parameter history shows the parameters on the output, then another
+           *settle* seconds,
+        3. for *dwell* seconds the chunks are summarised (see ChannelSummary) and, if enabled, recorded to their own
+           session file,
+        4. the summary, tagged with the condition and the sample indices of the dwell, is appended as a JSON line to
+           results.jsonl in the output folder.
+
+    The results file is the progress of the sweep: started again on the same folder, the runner skips the conditions
+    already in it, so an interrupted sweep resumes with the condition it was in. The parameters from before the sweep
+    are restored once it finishes or is stopped.
+
+    stop and restart may be called from any thread, e.g. the GUI's. They take the same lock as process, so they never
+    run halfway through a chunk.
+
+    Attributes:
+        plan (dict): the sweep, see load_plan
+        folder (str): where the plan, the results and the recordings are written
+        writer: the writeThread (or debug data source) whose parameters are set, replaced through restart
+        rig_count (int): number of rigs of the writer, a replacement must have as many
+        daq_rate (int): rate of the stream
+        channels (list): names of the acquired channels
+        done (set): numbers of the finished conditions
+        current (int): number of the condition being run, None when finished
+        phase (str): 'apply', 'settle' or 'dwell'
+    """
+    conditionFinished = QtCore.pyqtSignal(object)  # The result of a condition, as written to results.jsonl
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self, plan, folder, writer, daq_rate, channels):
+        super().__init__()
+        self.plan = plan
+        self.folder = folder
+        self.writer = writer
+        self.daq_rate = daq_rate
+        self.channels = list(channels)
+        os.makedirs(folder, exist_ok=True)
+        self.results_path = os.path.join(folder, 'results.jsonl')
+
+        # Resume from an earlier run of the same plan
+        plan_path = os.path.join(folder, 'plan.json')
+        if os.path.exists(plan_path):
+            with open(plan_path) as f:
+                if json.load(f) != plan:
+                    raise ValueError(f'{folder} holds the results of a different sweep')
+        else:
+            with open(plan_path, 'w') as f:
+                json.dump(plan, f, indent=1)
+        self.done = set()
+        if os.path.exists(self.results_path):
+            with open(self.results_path) as f:
+                lines = f.read().split('\n')
+            for line in lines:
+                try:
+                    self.done.add(json.loads(line)['condition'])
+                except (ValueError, KeyError):  # Empty, or cut short by the interruption
+                    pass
+            if lines[-1]:  # Start the next result on a line of its own
+                with open(self.results_path, 'a') as f:
+                    f.write('\n')
+
+        self.rig_count = self.n_rigs(writer)
+        self.check_rigs(writer)
+        self.initial = self.read_parameters()
+        self.executor = ThreadPoolExecutor(max_workers=1)  # Writes files off the acquisition thread
+        self.lock = threading.RLock()
+        self.current = None
+        self.recorder = None
+        self.stopped = False
+        self.next_condition()
+
+    def __len__(self):
+        return len(self.plan['conditions'])
+
+    @property
+    def settle_samples(self):
+        return int(self.plan['settle'] * self.daq_rate)
+
+    @property
+    def dwell_samples(self):
+        return int(self.plan['dwell'] * self.daq_rate)
+
+    @staticmethod
+    def n_rigs(writer):
+        return len(writer.state['freq']) if hasattr(writer, 'state') else 1  # The debug data sources have a single rig
+
+    def check_rigs(self, writer):
+        """Raise a ValueError if the sweep cannot drive the rigs of a writer."""
+        n_rigs = self.n_rigs(writer)
+        if n_rigs != self.rig_count:
+            raise ValueError(f'The sweep started with {self.rig_count} rigs, the writer has {n_rigs}')
+        for rig in self.plan['rigs'] or []:
+            if rig >= n_rigs:
+                raise ValueError(f'The sweep uses rig {rig}, the writer has rigs 0 to {n_rigs - 1}')
+
+    def rig_indices(self):
+        return list(range(self.rig_count)) if self.plan['rigs'] is None else list(self.plan['rigs'])
+
+    def read_parameters(self):
+        """The writer's current values of the swept parameters."""
+        names = {name for condition in self.plan['conditions'] for name in condition}
+        if hasattr(self.writer, 'state'):
+            return {name: self.writer.state[PARAMETERS[name]].copy() for name in names}
+        return {name: getattr(self.writer, PARAMETERS[name], None) for name in names}
+
+    def write_parameters(self, values):
+        """Set parameters, given as single values for the swept rigs or as arrays of all rigs from read_parameters."""
+        for name, value in values.items():
+            if value is None:
+                continue
+            if not hasattr(self.writer, 'state'):
+                setattr(self.writer, PARAMETERS[name], float(np.max(value)))
+            elif np.ndim(value):
+                self.writer.state[PARAMETERS[name]][:] = value
+            else:
+                self.writer.state[PARAMETERS[name]][self.rig_indices()] = value
+
+    def next_condition(self):
+        """Move on to the next condition that is not done yet."""
+        remaining = [number for number in range(len(self)) if number not in self.done]
+        self.current = remaining[0] if remaining else None
+        self.restart()
+
+    def restart(self, writer=None, daq_rate=None):
+        """Run the current condition from the start, e.g. after the data source or the writer was replaced.
+
+        Args:
+            writer: the new writer, checked with check_rigs
+            daq_rate (int): the new rate of the stream
+        """
+        with self.lock:
+            if writer is not None:
+                self.check_rigs(writer)
+                self.writer = writer
+            if daq_rate is not None:
+                self.daq_rate = daq_rate
+            if self.recorder is not None:
+                self.executor.submit(self.recorder.close)
+            self.phase = 'apply'
+            self.applied_index = self.dwell_start = None
+            self.summary = self.recorder = None
+
+    def applied(self, sample_index):
+        """Whether the output at a sample was generated with the current condition, and from which sample it was.
+
+        Without a parameter history (the debug data sources) the parameters take effect immediately.
+        """
+        history = getattr(self.writer, 'history', None)
+        if history is None or history.count == 0:
+            return True, self.applied_index
+        record, _ = history.lookup_read_index(sample_index, self.daq_rate)
+        rigs = self.rig_indices()
+        for name, value in self.plan['conditions'][self.current].items():
+            if not np.allclose(record[PARAMETERS[name]][rigs], value):
+                return False, None
+        return True, max(self.applied_index, int(record['time'] * self.daq_rate))
+
+    def commanded_freq(self):
+        """Frequency of the first swept rig, for the lock-in of the summary."""
+        if hasattr(self.writer, 'state'):
+            return float(self.writer.state['freq'][self.rig_indices()[0]])
+        return getattr(self.writer, 'freq', None)
+
+    def process(self, start_index, chunk):
+        """Slot for the full-rate stream, advances the sweep on the source's thread."""
+        with self.lock:
+            if self.current is not None:
+                self.advance(start_index, chunk)
+
+    def advance(self, start_index, chunk):
+        """Run the current condition on the next chunk, with the lock held."""
+        end_index = start_index + chunk.shape[1]
+        if self.phase == 'apply':
+            self.write_parameters(self.plan['conditions'][self.current])
+            self.applied_index = end_index
+            self.phase = 'settle'
+            return
+
+        if self.phase == 'settle':
+            on_output, since = self.applied(end_index - 1)
+            if not on_output:
+                return
+            self.dwell_start = max(since + self.settle_samples, start_index)
+            self.phase = 'dwell'
+            self.summary = ChannelSummary(self.daq_rate, self.commanded_freq())
+            if self.plan['record']:
+                path = os.path.join(self.folder, f'condition_{self.current:04d}.bin')
+                self.recorder = SessionRecorder(path, self.daq_rate, self.channels)
+
+        # Summarise the part of the chunk inside the dwell window
+        dwell_end = self.dwell_start + self.dwell_samples
+        first, last = max(self.dwell_start, start_index), min(dwell_end, end_index)
+        if last > first:
+            part = chunk[:, first - start_index:last - start_index]
+            self.summary.add(first, part)
+            if self.recorder is not None:
+                self.executor.submit(self.recorder.write_chunk, first, part.copy())
+        if end_index >= dwell_end:
+            self.finish_condition()
+
+    def finish_condition(self):
+        result = {'condition': self.current, 'parameters': self.plan['conditions'][self.current],
+                  'rigs': self.rig_indices(), 'applied_index': int(self.applied_index),
+                  'dwell_start': int(self.dwell_start), 'dwell_end': int(self.dwell_start + self.dwell_samples),
+                  'daq_rate': self.daq_rate, 'channels': self.channels, 'summary': self.summary.result()}
+        if self.recorder is not None:
+            result['recording'] = self.recorder.path
+            self.executor.submit(self.recorder.close)
+            self.recorder = None
+        self.executor.submit(self.append_result, result)
+        self.done.add(self.current)
+        self.conditionFinished.emit(result)
+        self.next_condition()
+        if self.current is None:
+            self.stop()
+            self.finished.emit()
+
+    def append_result(self, result):
+        try:
+            with open(self.results_path, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+        except OSError as e:
+            print(f'Could not write the result of condition {result["condition"]}: {e}')
+
+    def stop(self):
+        """End the sweep, or abandon the condition being run, and restore the parameters from before the sweep.
+
+        Files still being written are finished on the background thread, so this never blocks the acquisition.
+        """
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            self.current = None
+            if self.recorder is not None:
+                self.executor.submit(self.recorder.close)
+                self.recorder = None
+            self.write_parameters(self.initial)
+            self.executor.shutdown(wait=False)
+
+    def close(self):
+        """Wait for the results and recordings being written, after stop."""
+        self.executor.shutdown(wait=True)
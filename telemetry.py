@@ -0,0 +1,108 @@
+import os
+from time import perf_counter, process_time
+import numpy as np
+
+try:  # psutil is optional, only used for the memory usage shown in the performance panel
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class RateCounter:
+    """Counts events and the intervals between them.
+
+    Every counter is written by a single thread and only read by others, so no lock is needed. The values are
+    cumulative and readers work with the difference between two snapshots (see RateCounter.since).
+
+    Attributes:
+        count (int): number of events
+        interval_sum (float): sum of the intervals between events in s
+        interval_sumsq (float): sum of the squared intervals, for the jitter
+        last (float): perf_counter time of the last event
+    """
+    def __init__(self):
+        self.count = 0
+        self.interval_sum = 0.0
+        self.interval_sumsq = 0.0
+        self.last = None
+
+    def tick(self):
+        """Count an event now."""
+        now = perf_counter()
+        if self.last is not None:
+            interval = now - self.last
+            self.interval_sum += interval
+            self.interval_sumsq += interval * interval
+        self.last = now
+        self.count += 1
+
+    def snapshot(self):
+        return self.count, self.interval_sum, self.interval_sumsq
+
+    @staticmethod
+    def since(snapshot, previous, elapsed):
+        """Event rate and interval jitter between two snapshots.
+
+        Args:
+            snapshot, previous: results of snapshot()
+            elapsed (float): time in s between the snapshots
+
+        Returns:
+            rate in events/s, standard deviation of the interval in s
+        """
+        count = snapshot[0] - previous[0]
+        if count < 2:
+            return count / elapsed, 0.0
+        mean = (snapshot[1] - previous[1]) / count
+        variance = (snapshot[2] - previous[2]) / count - mean * mean
+        return count / elapsed, np.sqrt(max(variance, 0.0))
+
+
+class DurationCounter:
+    """Accumulates how long something takes, e.g. a plot redraw. Written by one thread only, like RateCounter.
+
+    Attributes:
+        count (int): number of measurements
+        total (float): sum of the durations in s
+        maximum (float): longest duration since the reader last reset it
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.maximum:
+            self.maximum = duration
+
+    def snapshot(self):
+        return self.count, self.total
+
+    @staticmethod
+    def since(snapshot, previous):
+        """Mean duration in s between two snapshots, 0 without measurements."""
+        count = snapshot[0] - previous[0]
+        return (snapshot[1] - previous[1]) / count if count else 0.0
+
+
+class ProcessMonitor:
+    """CPU and memory usage of this process."""
+    def __init__(self):
+        self.last_wall = perf_counter()
+        self.last_cpu = process_time()
+        self.process = psutil.Process(os.getpid()) if psutil is not None else None
+
+    def cpu_percent(self):
+        """CPU usage since the last call, in percent of one core."""
+        wall, cpu = perf_counter(), process_time()
+        percent = 100 * (cpu - self.last_cpu) / max(wall - self.last_wall, 1e-9)
+        self.last_wall, self.last_cpu = wall, cpu
+        return percent
+
+    def memory_mb(self):
+        """Resident memory in MB, or None without psutil."""
+        if self.process is None:
+            return None
+        return self.process.memory_info().rss / 2 ** 20
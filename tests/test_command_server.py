@@ -0,0 +1,86 @@
+import json
+import os
+import sys
+import unittest
+from time import perf_counter
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from command_client import ACK, BATCH_HEADER, BINARY_MAGIC, COMMAND, ACTIVE_RIG
+from threads.CommandServer import CommandServer
+
+
+class FakeWriter:
+    """Stands in for the SignalWriter: two rigs, the first one active."""
+    def __init__(self):
+        self.state = {name: np.full(2, 10.0) for name in ('vmulti', 'freq', 'camber', 'zphase', 'zcoeff')}
+
+    @property
+    def freq(self):
+        return self.state['freq'][0]
+
+    @freq.setter
+    def freq(self, value):
+        self.state['freq'][0] = value
+
+
+class FakeConnection:
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+class TestCommandValidation(unittest.TestCase):
+    def setUp(self):
+        self.writer = FakeWriter()
+        self.server = CommandServer(self.writer)
+        self.connection = FakeConnection()
+
+    def send_json(self, commands):
+        line = json.dumps({'id': 1, 'commands': commands}).encode() + b'\n'
+        self.assertTrue(self.server.process(self.connection, bytearray(line), perf_counter()))
+        return json.loads(self.connection.sent[-1])
+
+    def send_binary(self, commands):
+        frame = BATCH_HEADER.pack(BINARY_MAGIC, 1, len(commands)) + b''.join(COMMAND.pack(*c) for c in commands)
+        self.assertTrue(self.server.process(self.connection, bytearray(frame), perf_counter()))
+        return ACK.unpack(self.connection.sent[-1])
+
+    def test_valid_command_is_applied(self):
+        reply = self.send_json([{'cmd': 'freq', 'value': 20, 'rig': 1}])
+        self.assertTrue(reply['ok'])
+        self.assertEqual(self.writer.state['freq'].tolist(), [10.0, 20.0])
+
+    def test_nan_is_refused(self):
+        reply = self.send_json([{'cmd': 'freq', 'value': float('nan')}])  # json.dumps writes NaN
+        self.assertFalse(reply['ok'])
+        self.assertEqual(self.writer.state['freq'].tolist(), [10.0, 10.0])
+
+    def test_infinite_delay_is_refused(self):
+        reply = self.send_json([['delay', float('inf')], ['freq', 20]])
+        self.assertFalse(reply['ok'])
+        self.assertEqual(self.server.schedule, [])
+
+    def test_bad_rig_is_refused(self):
+        for rig in (-1, 2, 0.5, True):
+            reply = self.send_json([{'cmd': 'freq', 'value': 20, 'rig': rig}])
+            self.assertFalse(reply['ok'], rig)
+        self.assertEqual(self.writer.state['freq'].tolist(), [10.0, 10.0])
+
+    def test_scheduled_command_is_checked_when_received(self):
+        reply = self.send_json([['delay', 1], ['freq', 20, 5]])
+        self.assertFalse(reply['ok'])
+        self.assertEqual(self.server.schedule, [])
+
+    def test_binary_nan_and_bad_rig_are_refused(self):
+        _, _, status, applied, _ = self.send_binary([(3, ACTIVE_RIG, float('nan'))])
+        self.assertEqual((status, applied), (1, 0))
+        _, _, status, applied, _ = self.send_binary([(3, 7, 20.0)])
+        self.assertEqual((status, applied), (1, 0))
+        self.assertEqual(self.writer.state['freq'].tolist(), [10.0, 10.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import numpy as np
+from time import perf_counter
+from scipy.signal import lfilter
+from pyqtgraph.Qt import QtCore
+from waves import WaveGenerator
+from telemetry import RateCounter
+from lifecycle import sleep_while_running
+
+
+class CoilSimulator(QtCore.QThread):
+    """Debugging thread that simulates the amplifiers and coils in place of the national instruments cards.
+
+    The commanded coil signals are calculated by the WaveGenerator exactly as the SignalWriter would, but at the read
+    rate. Each amplifier multiplies its input by `gain` and saturates at `rail`. Each coil is modelled as a series RL
+    circuit, a first order low-pass with time constant L/R, discretized exactly for a zero-order hold input:
+
+        i[n] = a * i[n-1] + (1 - a) / R * v[n],    a = exp(-R / (L * daq_rate))
+
+    The filter state is kept between chunks, so chunk boundaries are seamless. The emitted AI data has the amplifier
+    voltage monitor of every coil followed by the current monitor of every coil, both scaled back by the gain so they
+    are in the units of the command: at low frequency and below saturation all rows follow the command.
+
+    It has the same signal parameters as the SignalWriter, so the main window controls it the same way in debug mode.
+
+    Attributes:
+        daq_rate (int): simulated read rate
+        chunksize (int): samples per channel per emitted chunk
+        gain, rail, resistance, inductance: amplifier and coil properties, scalars or one value per coil
+        noise (float): standard deviation of the noise added to the monitors
+        running (bool): used to control the state of the run loop from outside this thread
+
+    """
+    newData = QtCore.pyqtSignal(object)  # Designates that this class will have an output signal 'newData'
+    newChunk = QtCore.pyqtSignal(object, object)  # Emits the sample index of the first sample and the data
+
+    def __init__(self, daq_rate, chunksize, vmulti, freq, camber, zphase, zcoeff, calib_xamp, calib_yamp, calib_zamp,
+                 matrix=None, offsets=None, gain=20.0, rail=30.0, resistance=2.0, inductance=0.005, noise=0.002):
+        super().__init__()
+        self.daq_rate = daq_rate
+        self.chunksize = chunksize
+        self.vmulti = vmulti
+        self.freq = freq
+        self.camber = camber
+        self.zphase = zphase
+        self.zcoeff = zcoeff
+        self.calib_xamp = calib_xamp
+        self.calib_yamp = calib_yamp
+        self.calib_zamp = calib_zamp
+        self.calib_mode = False
+        self.shape = 'Rotating'
+        self.shape_parameters = {}
+        self.tones = None
+        self.matrix = np.eye(3) if matrix is None else np.asarray(matrix, dtype=float)
+        self.offsets = None if offsets is None else np.asarray(offsets, dtype=float)
+        self.coils = self.matrix.shape[0]
+        self.gain = gain
+        self.rail = rail
+        self.resistance = resistance
+        self.inductance = inductance
+        self.noise = noise
+
+        self.WaveGen = WaveGenerator()
+        self.zi = np.zeros([self.coils, 1])  # lfilter state, the coil currents
+        self.sample_index = 0
+        self.chunk_counter = RateCounter()  # Stands in for the reader's counter in the performance panel
+        self.running = False
+
+    def command(self):
+        """Calculate the next chunk of commanded coil signals, [coils, chunksize]."""
+        if self.calib_mode:
+            waves = self.WaveGen.generate_calib_waves(self.daq_rate, self.chunksize, self.calib_xamp,
+                                                      self.calib_yamp, self.calib_zamp)
+            return np.pad(waves, [(0, max(self.coils - 3, 0)), (0, 0)], mode='constant')[:self.coils]
+        return self.WaveGen.generate_waves(self.daq_rate, self.chunksize, self.vmulti, self.freq, self.camber,
+                                           self.zphase, self.zcoeff, self.matrix, self.offsets, self.shape,
+                                           self.tones, self.shape_parameters)
+
+    def simulate(self, command):
+        """Run a chunk of commanded signals through the amplifier and coil models.
+
+        Args:
+            command: a [coils, samples] array of amplifier inputs
+
+        Returns:
+            a [2 * coils, samples] array, the voltage monitors followed by the current monitors
+        """
+        gain = np.broadcast_to(np.asarray(self.gain, dtype=float), [self.coils])[:, None]
+        rail = np.broadcast_to(np.asarray(self.rail, dtype=float), [self.coils])[:, None]
+        resistance = np.broadcast_to(np.asarray(self.resistance, dtype=float), [self.coils])
+        inductance = np.broadcast_to(np.asarray(self.inductance, dtype=float), [self.coils])
+
+        voltage = np.clip(gain * command, -rail, rail)
+        current = np.empty_like(voltage)
+        a = np.exp(-resistance / (inductance * self.daq_rate))
+        for coil in range(self.coils):  # lfilter shares its coefficients across rows, so filter each coil separately
+            current[coil], self.zi[coil] = lfilter([(1 - a[coil]) / resistance[coil]], [1, -a[coil]], voltage[coil],
+                                                   zi=self.zi[coil])
+
+        output = np.concatenate([voltage / gain, current * resistance[:, None] / gain])
+        if self.noise:
+            output += np.random.normal(scale=self.noise, size=output.shape)
+        return output
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        self.running = True
+        self.WaveGen.reset()
+        self.zi[:] = 0
+        start_time, start_index = perf_counter(), self.sample_index
+
+        while self.running:
+            output = self.simulate(self.command())
+            self.newData.emit(output)  # send the new output to the pyqtSignal 'newData'
+            self.newChunk.emit(self.sample_index, output)
+            self.chunk_counter.tick()
+            self.sample_index += self.chunksize
+
+            # Emit at the rate a real card would acquire
+            delay = start_time + (self.sample_index - start_index) / self.daq_rate - perf_counter()
+            if delay > 0:
+                sleep_while_running(self, delay)
@@ -0,0 +1,264 @@
+import heapq
+import itertools
+import json
+import math
+import selectors
+import socket
+from time import perf_counter
+from pyqtgraph.Qt import QtCore
+from command_client import (DEFAULT_PORT, MAX_LINE, MAX_COMMANDS, BINARY_MAGIC, BATCH_HEADER, COMMAND, ACK, OPCODES,
+                            PARAMETERS, SWARM_MODES, ACTIVE_RIG)
+from telemetry import RateCounter, DurationCounter
+
+
+class CommandServer(QtCore.QThread):
+    """A QThread serving the local command API, so external programs can steer the swarm.
+
+    Clients on this machine connect over TCP and send batches of commands as JSON lines or binary frames (the
+    protocol is described in command_client.py). Signal parameters are written straight into the writeThread's
+    parameter state from this thread, the same way the parameter tree sets them, so they take effect with the next
+    generated chunk. Swarm modes run in the parameter tree, so they are handed to the main window with the
+    swarmCommand signal. Commands after a delay are kept in a schedule and applied when they are due.
+
+    All connections are served from one selector loop without blocking, and every batch is acknowledged with the
+    time between receiving and applying it.
+
+    Attributes:
+        writer: the writeThread (or debug data source) whose parameters are set
+        steering: the SteeringThread controlled by the steering and waypoints commands, set by the main window
+        capture: the TriggeredCapture triggered by the capture command, set by the main window
+        host (str), port (int): address the server listens on
+        batch_counter (RateCounter): batches received, for the performance panel
+        ack_latency (DurationCounter): time from receiving a batch to applying it
+        running (bool): used to control the state of the run loop from outside this thread
+    """
+    swarmCommand = QtCore.pyqtSignal(object, object)  # Swarm mode name, or None to stop, and whether to start it
+    errorMessage = QtCore.pyqtSignal(object)
+
+    def __init__(self, writer, port=DEFAULT_PORT, host='127.0.0.1'):
+        super().__init__()
+        self.writer = writer
+        self.steering = None
+        self.capture = None
+        self.host = host
+        self.port = port
+        self.schedule = []  # Heap of (due time, sequence number, command)
+        self.sequence = itertools.count()
+        self.batch_counter = RateCounter()
+        self.ack_latency = DurationCounter()
+        self.running = False
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        self.running = True
+        selector = selectors.DefaultSelector()
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            server.bind((self.host, self.port))
+        except OSError as e:
+            self.errorMessage.emit(f'Could not start the command API on port {self.port}: {e}')
+            server.close()
+            return
+        server.listen()
+        server.setblocking(False)
+        selector.register(server, selectors.EVENT_READ, None)
+
+        while self.running:
+            timeout = 0.05
+            if self.schedule:
+                timeout = min(timeout, max(self.schedule[0][0] - perf_counter(), 0))
+            for key, _ in selector.select(timeout):
+                if key.data is None:  # New connection
+                    connection, _ = server.accept()
+                    connection.setblocking(False)
+                    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    selector.register(connection, selectors.EVENT_READ, bytearray())
+                    continue
+                try:
+                    data = key.fileobj.recv(65536)
+                except OSError:
+                    data = b''
+                received = perf_counter()
+                key.data.extend(data)
+                if not data or not self.process(key.fileobj, key.data, received):
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+            self.run_schedule()
+
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+
+    def process(self, connection, buffer, received):
+        """Execute every complete batch in a connection's buffer and acknowledge it.
+
+        Returns:
+            False if the connection sent something malformed or could not be replied to, and should be closed
+        """
+        while buffer:
+            if buffer[0] == BINARY_MAGIC:
+                if len(buffer) < BATCH_HEADER.size:
+                    return True
+                _, batch_id, count = BATCH_HEADER.unpack_from(buffer)
+                end = BATCH_HEADER.size + count * COMMAND.size
+                if count > MAX_COMMANDS:
+                    self.send(connection, ACK.pack(BINARY_MAGIC, batch_id, 1, 0, 0.0))
+                    return False
+                if len(buffer) < end:
+                    return True
+                commands = [(OPCODES.get(code, code), value, None if rig == ACTIVE_RIG else rig, None)
+                            for code, rig, value in COMMAND.iter_unpack(bytes(buffer[BATCH_HEADER.size:end]))]
+                del buffer[:end]
+                applied, _, error, latency = self.execute(commands, received)
+                if not self.send(connection, ACK.pack(BINARY_MAGIC, batch_id, error is not None, applied,
+                                                      1e6 * latency)):
+                    return False
+            else:
+                end = buffer.find(b'\n')
+                if end < 0:
+                    return len(buffer) <= MAX_LINE
+                line = bytes(buffer[:end])
+                del buffer[:end + 1]
+                if not line.strip():
+                    continue
+                batch_id = None
+                try:
+                    batch = json.loads(line)
+                    batch_id = batch.get('id')
+                    commands = [self.parse_json_command(command) for command in batch['commands'][:MAX_COMMANDS]]
+                except (ValueError, KeyError, TypeError, AttributeError, IndexError) as e:
+                    reply = {'id': batch_id, 'ok': False, 'error': f'Malformed batch: {e}'}
+                else:
+                    applied, scheduled, error, latency = self.execute(commands, received)
+                    reply = {'id': batch_id, 'ok': error is None, 'applied': applied, 'scheduled': scheduled,
+                             'latency_us': round(1e6 * latency, 1)}
+                    if error is not None:
+                        reply['error'] = error
+                if not self.send(connection, json.dumps(reply).encode() + b'\n'):
+                    return False
+        return True
+
+    @staticmethod
+    def send(connection, data):
+        """Send a reply without letting a client that disconnected, or stopped reading so its socket is full, take
+        the server down.
+
+        Returns:
+            False if the reply could not be sent and the connection should be closed
+        """
+        try:
+            connection.sendall(data)
+        except OSError as e:  # BrokenPipeError, ConnectionResetError, BlockingIOError, ...
+            print(f'Closing a command API connection: {e}')
+            return False
+        return True
+
+    @staticmethod
+    def parse_json_command(command):
+        """Turn a JSON command into a (name, value, rig, mode) tuple."""
+        if isinstance(command, dict):
+            return command['cmd'], command.get('value'), command.get('rig'), command.get('mode')
+        return command[0], command[1] if len(command) > 1 else None, command[2] if len(command) > 2 else None, None
+
+    def execute(self, commands, received):
+        """Apply the commands of a batch, scheduling those that follow a delay.
+
+        Returns:
+            the number of commands applied and scheduled, an error message or None, and the time in s since the
+            batch was received
+        """
+        applied = scheduled = 0
+        delay = 0.0
+        error = None
+        for command in commands:
+            try:
+                if command[0] == 'delay':
+                    delay += self.finite(command[1])
+                elif delay > 0:
+                    self.check(*command)  # Refuse it now rather than when it is due
+                    heapq.heappush(self.schedule, (received + delay, next(self.sequence), command))
+                    scheduled += 1
+                else:
+                    self.apply(*command)
+                    applied += 1
+            except (ValueError, KeyError, TypeError, IndexError) as e:
+                error = f'{command[0]}: {e}'
+                break
+        latency = perf_counter() - received
+        self.batch_counter.tick()
+        self.ack_latency.add(latency)
+        return applied, scheduled, error, latency
+
+    def run_schedule(self):
+        """Apply the scheduled commands that are due."""
+        now = perf_counter()
+        while self.schedule and self.schedule[0][0] <= now:
+            _, _, command = heapq.heappop(self.schedule)
+            try:
+                self.apply(*command)
+            except (ValueError, KeyError, TypeError, IndexError) as e:
+                print(f'Scheduled command {command[0]} failed: {e}')
+
+    @staticmethod
+    def finite(value):
+        """The value as a float. JSON and binary batches can carry NaN and infinity, which must never reach the
+        writer: they would be generated as NaN samples, or break the choice of the write timing."""
+        value = float(value)
+        if not math.isfinite(value):
+            raise ValueError(f'{value} is not a finite number')
+        return value
+
+    def check_rig(self, rig):
+        """Raise a ValueError unless the rig of a command is one of the writer's rigs."""
+        n_rigs = len(self.writer.state['freq']) if hasattr(self.writer, 'state') else 1  # Debug sources have one
+        if isinstance(rig, bool) or not isinstance(rig, int) or not 0 <= rig < n_rigs:
+            raise ValueError(f'Unknown rig {rig}, use 0 to {n_rigs - 1}')
+
+    def check(self, name, value, rig=None, mode=None):
+        """Raise a ValueError if a signal parameter command has a value that is not a finite number or an unknown
+        rig."""
+        if name in PARAMETERS:
+            self.finite(value)
+            if rig is not None:
+                self.check_rig(rig)
+
+    def apply(self, name, value, rig=None, mode=None):
+        """Apply one command.
+
+        Args:
+            name (str): the command, see command_client.py
+            value: its value
+            rig (int): index of the rig, None for the rig selected in the parameter tree
+            mode (str): name of the swarm mode for the swarm command
+
+        Raises:
+            ValueError: for unknown commands, rigs or swarm modes and values that are not finite numbers
+        """
+        if name in PARAMETERS:
+            self.check(name, value, rig)
+            parameter, value = PARAMETERS[name], float(value)
+            if rig is None or not hasattr(self.writer, 'state'):
+                setattr(self.writer, parameter, value)
+            else:
+                self.writer.state[parameter][rig] = value
+        elif name == 'swarm':
+            if mode is None:
+                mode = SWARM_MODES[int(value)]
+            if mode not in SWARM_MODES:
+                raise ValueError(f'Unknown swarm mode {mode}')
+            self.swarmCommand.emit(mode, True)
+        elif name == 'stop':
+            self.swarmCommand.emit(None, False)
+        elif name == 'capture':
+            if self.capture is None:
+                raise ValueError('Triggered capture is turned off')
+            self.capture.trigger('api')
+        elif name in ('steering', 'waypoints') and self.steering is None:
+            raise ValueError('Closed-loop steering is turned off')
+        elif name == 'steering':
+            self.steering.enabled = bool(value)
+        elif name == 'waypoints':
+            self.steering.controller.set_waypoints(value)
+        else:
+            raise ValueError(f'Unknown command {name}')
@@ -1,7 +1,11 @@
 from pyqtgraph.Qt import QtCore
 from misc_functions import xy_to_cylindrical
+from collections import deque
 from time import sleep
 import XInput as xi
+import latency
+import tracing
+from telemetry import RateCounter
 
 
 class ControllerThread(QtCore.QThread):
@@ -11,14 +15,21 @@ class ControllerThread(QtCore.QThread):
         SLEEP (float): the time that the while loop pauses while checking controller events. Higher sleep constants
             equals better performance.
         running (bool): used to control the state of the run loop from outside this thread
+        synthetic (bool): if True, no controller is polled and only events put in injected_events are processed. Used
+            by latency_test.py to send events through the same path as a real gamepad.
+        injected_events (deque): synthetic events, objects with the same attributes as XInput events
+        event_counter (RateCounter): rate of the emitted events, for the performance panel
     """
     newGamepadEvent = QtCore.pyqtSignal(object)
 
-    def __init__(self, sleep_constant=0.001):
+    def __init__(self, sleep_constant=0.001, synthetic=False):
         super().__init__()
 
         self.running = False
         self.sleep_constant = sleep_constant
+        self.synthetic = synthetic
+        self.injected_events = deque()
+        self.event_counter = RateCounter()
         # Initialize variables to keep track of x and y
         self.x = 0
         self.y = 0
@@ -29,9 +40,9 @@ class ControllerThread(QtCore.QThread):
         self.running = True
 
         # Try connecting to the gamepad
-        connected = xi.get_connected()
-
-        if any(controller is True for controller in connected):
+        if self.synthetic:
+            print("Processing synthetic controller events.")
+        elif any(controller is True for controller in xi.get_connected()):
             print("A controller is connected!")
         else:
             print("No controller connected.")
@@ -40,9 +51,13 @@ class ControllerThread(QtCore.QThread):
         # Start the process loop
         while self.running:
             sleep(self.sleep_constant)
-            events = xi.get_events()
-            for event in events:
-                self.filter_events(event)
+            events = [] if self.synthetic else list(xi.get_events())
+            while self.injected_events:
+                events.append(self.injected_events.popleft())
+            if events:
+                with tracing.span('controller events'):
+                    for event in events:
+                        self.filter_events(event)
 
     def filter_events(self, event):
         """Filter the events and emit the salient ones.
@@ -61,6 +76,9 @@ class ControllerThread(QtCore.QThread):
         # Buttons
         if event.type == 4:
             # print(event.button)
+            if latency.probe is not None:
+                latency.probe.begin()
+            self.event_counter.tick()
             self.newGamepadEvent.emit([event.button, 1])
             # QtCore.QThread.msleep(10)
 
@@ -70,6 +88,9 @@ class ControllerThread(QtCore.QThread):
                 self.x, self.y = event.dir
 
             magnitude, degrees = xy_to_cylindrical(self.x, self.y)  # Convert to cylindrical
+            if latency.probe is not None:
+                latency.probe.begin()
+            self.event_counter.tick()
             self.newGamepadEvent.emit(['LJOY', degrees])
 
 
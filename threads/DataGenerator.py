@@ -1,5 +1,6 @@
 import numpy as np
 from pyqtgraph.Qt import QtCore
+from telemetry import RateCounter
 
 
 class Generator(QtCore.QThread):
@@ -9,6 +10,7 @@ class Generator(QtCore.QThread):
 
     """
     newData = QtCore.pyqtSignal(object)  # Designates that this class will have an output signal 'newData'
+    newChunk = QtCore.pyqtSignal(object, object)  # Emits the sample index of the first sample and the data
 
     def __init__(self, multi, freq, chunksize=100, delay=20):
         super().__init__()
@@ -17,6 +19,8 @@ class Generator(QtCore.QThread):
         self.multi = multi
         self.freq = freq
         self.output = np.zeros([6, self.chunksize])
+        self.sample_index = 0
+        self.chunk_counter = RateCounter()  # Stands in for the reader's counter in the performance panel
         self.running = False
 
     def run(self):
@@ -26,6 +30,9 @@ class Generator(QtCore.QThread):
             try:
                 self.output = self.multi * np.random.normal(size=(6, self.chunksize))
                 self.newData.emit(self.output)  # send the new output to the pyqtSignal 'newData'
+                self.newChunk.emit(self.sample_index, self.output)
+                self.sample_index += self.chunksize
+                self.chunk_counter.tick()
                 QtCore.QThread.msleep(self.delay)
             except Exception as e:
                 print(str(e))
@@ -0,0 +1,64 @@
+from pyqtgraph.Qt import QtCore
+import nidaqmx
+from misc_functions import device_key, probe_ni_device, load_device_cache, save_device_cache
+from lifecycle import sleep_while_running
+
+
+class DeviceRegistry(QtCore.QThread):
+    """A QThread that enumerates the connected NI devices in the background and caches their capabilities.
+
+    Enumerating and probing NI devices is slow, so it is done once here instead of on the GUI-facing threads. The
+    results are cached in QSettings keyed by device serial, which means the capabilities of a previously seen device
+    are available immediately at startup, before the first scan has finished. The device list is then polled every
+    *poll_interval* seconds and any device that appears (hot-plug) is probed, while devices that disappear are marked
+    as disconnected but kept in the cache.
+
+    Attributes:
+        devices (dict): device dictionaries (see misc_functions.probe_ni_device) keyed by device serial
+        poll_interval (float): time in s between checks for added or removed devices
+        running (bool): used to control the state of the run loop from outside this thread
+
+    """
+    devicesChanged = QtCore.pyqtSignal(object)  # Emits a copy of the devices dictionary whenever it changes
+
+    def __init__(self, poll_interval=2.0):
+        super().__init__()
+        self.devices = load_device_cache()
+        self.poll_interval = poll_interval
+        self.running = False
+
+    def run(self):
+        """Scan for devices, then keep polling for hot-plugged devices until running is set to False."""
+        self.running = True
+
+        while self.running:
+            try:
+                if self.scan():
+                    save_device_cache(self.devices)
+                    self.devicesChanged.emit(dict(self.devices))
+            except Exception as e:  # NI driver missing or busy, try again on the next poll
+                print(str(e))
+
+            sleep_while_running(self, self.poll_interval)  # Returns early when the thread is stopped
+
+    def scan(self):
+        """Compare the connected devices against the cache and probe any new ones.
+
+        Returns:
+            True if the cache changed, False otherwise
+        """
+        present = {device_key(device): device for device in nidaqmx.system.System.local().devices}
+        changed = False
+
+        for key, device in present.items():
+            cached = self.devices.get(key)
+            if cached is None or not cached['connected'] or cached['name'] != device.name:
+                self.devices[key] = probe_ni_device(device)
+                changed = True
+
+        for key, cached in self.devices.items():
+            if key not in present and cached['connected']:
+                cached['connected'] = False
+                changed = True
+
+        return changed
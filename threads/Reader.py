@@ -3,6 +3,8 @@ from pyqtgraph.Qt import QtCore
 import nidaqmx
 from nidaqmx.stream_readers import AnalogMultiChannelReader
 from misc_functions import find_ni_devices
+import tracing
+from telemetry import RateCounter
 
 
 class SignalReader(QtCore.QThread):
@@ -14,20 +16,32 @@ class SignalReader(QtCore.QThread):
         daq_rate (int): rate at which the NI DAQ card collects data
         readchunksize (int): The QThread waits until there is *readchunksize* values in the buffer before emitting
         output (ndarray): the numpy array holding the voltage values, this object gets emit through the newData signal
+        start_trigger (str): optional terminal to start the acquisition on, e.g. '/cDAQ1Mod1/ao/StartTrigger' to share
+            the start trigger of the SignalWriter so both streams count samples from the same instant
+        sample_index (int): absolute index of the first sample of the next chunk, counted from the task start
+        chunk_counter (RateCounter): rate of the acquired chunks, for the performance panel
         running (bool): used to control the state of the run loop from outside this thread
 
+    Every chunk is emitted twice: through newData as before, and through newChunk together with the absolute index
+    of its first sample, so it can be matched to the parameters the SignalWriter was generating at that moment.
+
     """
 
     newData = QtCore.pyqtSignal(object)  # Designates that this class will have an output signal 'newData'
+    newChunk = QtCore.pyqtSignal(object, object)  # Emits the sample index of the first sample and the data
     errorMessage = QtCore.pyqtSignal(object)
 
-    def __init__(self, daq_name, readchannel_list, daq_rate, readchunksize, delay=20):
+    def __init__(self, daq_name, readchannel_list, daq_rate, readchunksize, delay=20, start_trigger=None):
         super().__init__()
         self.daq_name = daq_name
         self.readchannel_list = readchannel_list
         self.daq_rate = daq_rate
         self.readchunksize = readchunksize
+        self.start_trigger = start_trigger
         self.output = np.zeros([len(self.readchannel_list), self.readchunksize])
+        self.sample_index = 0
+        self.readTask = None
+        self.chunk_counter = RateCounter()
         self.running = False
 
     def run(self):
@@ -68,17 +82,52 @@ class SignalReader(QtCore.QThread):
                                        f'Devices connected: {find_ni_devices()}')
                 return
 
+            # Wait for the shared start trigger, if any, so sample 0 of both streams is the same instant
+            if self.start_trigger is not None:
+                try:
+                    readTask.triggers.start_trigger.cfg_dig_edge_start_trig(self.start_trigger)
+                except Exception as e:
+                    self.errorMessage.emit(f"Couldn't use {self.start_trigger} as the start trigger of the read task"
+                                           f" ({e}). The read and write streams will be aligned in software.")
+
             # Define the reader and start the *task*
             reader = AnalogMultiChannelReader(readTask.in_stream)
+            self.sample_index = 0
+            self.readTask = readTask
             readTask.start()
 
             # Waits until there are *readchunksize* values in the buffer and emits the output array
             while self.running:
                 try:
-                    reader.read_many_sample(data=self.output,
-                                            number_of_samples_per_channel=self.readchunksize)
-                    self.output = np.around(self.output, 4)
-                    self.newData.emit(self.output)
+                    with tracing.span('reader wait'):
+                        reader.read_many_sample(data=self.output,
+                                                number_of_samples_per_channel=self.readchunksize)
+                    with tracing.span('reader emit'):
+                        self.output = np.around(self.output, 4)
+                        self.newData.emit(self.output)
+                        self.newChunk.emit(self.sample_index, self.output)
+                    self.sample_index += self.readchunksize
+                    self.chunk_counter.tick()
                 except Exception as e:
-                    print(str(e))
-                    pass
+                    if self.running:  # Reads fail once stop aborts the task
+                        print(str(e))
+            self.readTask = None
+
+    def stop(self):
+        """End the run loop without waiting for the next chunk. Aborting the task makes a read that is waiting for
+        samples, or for the start trigger, return at once."""
+        self.running = False
+        readTask = self.readTask
+        if readTask is not None:
+            try:
+                readTask.control(nidaqmx.constants.TaskMode.TASK_ABORT)
+            except nidaqmx.DaqError:
+                pass
+
+    def acquired_samples(self):
+        """The number of samples per channel acquired so far, used by the SignalWriter to place its start on the
+        reader's sample clock. Zero while the task is waiting for its start trigger."""
+        readTask = self.readTask
+        if readTask is None:
+            return 0
+        return readTask.in_stream.total_samp_per_chan_acquired
@@ -0,0 +1,86 @@
+import numpy as np
+from time import perf_counter
+from pyqtgraph.Qt import QtCore
+from recording import open_session
+from archive import SUFFIX, SessionArchive, open_archive
+from telemetry import RateCounter
+from lifecycle import sleep_while_running
+
+
+class ReplaySource(QtCore.QThread):
+    """Debugging thread that streams a recorded session in place of the national instruments cards.
+
+    The recording is memory-mapped (see recording.open_session), so even long sessions start instantly and only the
+    chunks being played are read from disk. Archived sessions (see archive.py) are decompressed block by block, and
+    the archive is closed when the thread ends. Chunks are emitted through the same newData and newChunk signals as
+    the SignalReader, paced at *speed* times real-time.
+
+    Attributes:
+        path (str): the recorded session
+        chunksize (int): samples per channel per emitted chunk
+        speed (float): playback speed, 1 is real-time. Can be changed while playing.
+        loop (bool): start over at the end of the recording
+        daq_rate (int): sample rate of the recording
+        sample_index (int): index of the first sample of the next chunk
+        running (bool): used to control the state of the run loop from outside this thread
+
+    """
+    newData = QtCore.pyqtSignal(object)  # Designates that this class will have an output signal 'newData'
+    newChunk = QtCore.pyqtSignal(object, object)  # Emits the sample index of the first sample and the data
+
+    def __init__(self, path, chunksize=100, speed=1.0, loop=True):
+        super().__init__()
+        self.path = path
+        self.chunksize = chunksize
+        self.speed = speed
+        self.loop = loop
+        self.data, info = open_archive(path) if path.endswith(SUFFIX) else open_session(path)
+        self.daq_rate = info['daq_rate']
+        self.sample_index = 0
+        self.seek_request = None
+        self.chunk_counter = RateCounter()  # Stands in for the reader's counter in the performance panel
+        self.running = False
+
+    @property
+    def duration(self):
+        """Length of the recording in s."""
+        return len(self.data) / self.daq_rate
+
+    def seek(self, seconds):
+        """Continue playing from `seconds` into the recording. Safe to call from any thread."""
+        self.seek_request = int(np.clip(seconds * self.daq_rate, 0, max(len(self.data) - 1, 0)))
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        self.running = True
+        # The pacing is anchored to a sample and a wall clock time, and re-anchored on seeks and speed changes
+        anchor_index, anchor_time, anchor_speed = self.sample_index, perf_counter(), self.speed
+
+        while self.running:
+            if self.seek_request is not None:
+                self.sample_index, self.seek_request = self.seek_request, None
+                anchor_index, anchor_time = self.sample_index, perf_counter()
+            if self.speed != anchor_speed:
+                anchor_index, anchor_time, anchor_speed = self.sample_index, perf_counter(), self.speed
+
+            if self.sample_index >= len(self.data):
+                if not self.loop:
+                    break
+                self.seek(0)
+                continue
+
+            chunk = np.array(self.data[self.sample_index:self.sample_index + self.chunksize].T)  # Copy off the map
+            self.newData.emit(chunk)
+            self.newChunk.emit(self.sample_index, chunk)
+            self.chunk_counter.tick()
+            self.sample_index += chunk.shape[1]
+
+            # Wait until this chunk would have finished playing
+            due = anchor_time + (self.sample_index - anchor_index) / (self.daq_rate * anchor_speed)
+            delay = due - perf_counter()
+            if delay > 0:
+                sleep_while_running(self, delay)
+
+        self.running = False
+        if isinstance(self.data, SessionArchive):
+            self.data.close()
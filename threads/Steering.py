@@ -0,0 +1,130 @@
+import json
+import math
+import socket
+import struct
+from time import perf_counter
+from pyqtgraph.Qt import QtCore
+from steering import HeadingController, load_track
+from telemetry import RateCounter, DurationCounter
+from lifecycle import sleep_while_running
+
+POSITION = struct.Struct('<ddd')  # t [s], x, y of one position estimate
+
+
+def parse_position(datagram):
+    """Decode a position estimate from a POSITION struct or a JSON list [t, x, y].
+
+    Returns:
+        t, x, y as floats
+
+    Raises:
+        ValueError: if the datagram is not three finite numbers, e.g. NaN from a tracker that lost the swarm
+    """
+    if len(datagram) == POSITION.size:
+        values = POSITION.unpack(datagram)
+    else:
+        values = json.loads(datagram)
+        if not isinstance(values, list) or len(values) != 3 or not all(
+                isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+            raise ValueError(f'A position estimate is a list [t, x, y], not {values}')
+    try:
+        values = tuple(float(value) for value in values)
+    except OverflowError:  # Integers too large for a float
+        raise ValueError(f'Position estimate {values} is not finite')
+    if not all(math.isfinite(value) for value in values):
+        raise ValueError(f'Position estimate {values} is not finite')
+    return values
+
+
+class SteeringThread(QtCore.QThread):
+    """A QThread steering the swarm in closed loop from streamed position estimates.
+
+    The estimates come from tracking software as UDP datagrams on localhost, either POSITION structs or JSON lists
+    [t, x, y], or are replayed from a file (see steering.load_track) at *speed* times real-time. Only the newest
+    estimate is used, older datagrams waiting in the socket are dropped, and datagrams that are not three finite
+    numbers are ignored (see parse_position). Each estimate is run through the
+    HeadingController and, while steering is enabled, the result is written straight to the writeThread's Z-Phase,
+    bypassing the parameter tree.
+
+    Attributes:
+        writer: the writeThread (or debug data source) whose Z-Phase is set
+        controller (HeadingController): the steering law and path, waypoints can be replaced at any time
+        enabled (bool): whether the Z-Phase is written, estimates are received either way
+        position (tuple): the newest (t, x, y) estimate
+        update_counter (RateCounter), update_time (DurationCounter): loop rate and time per update
+        running (bool): used to control the state of the run loop from outside this thread
+    """
+    errorMessage = QtCore.pyqtSignal(object)
+
+    def __init__(self, writer, port=5758, track_file=None, speed=1.0):
+        super().__init__()
+        self.writer = writer
+        self.port = port
+        self.track_file = track_file
+        self.speed = speed
+        self.controller = HeadingController()
+        self.enabled = False
+        self.position = None
+        self.update_counter = RateCounter()
+        self.update_time = DurationCounter()
+        self.running = False
+
+    def run(self):
+        """ This method runs when the thread is started."""
+        self.running = True
+        if self.track_file:
+            self.replay()
+        else:
+            self.listen()
+
+    def listen(self):
+        """Receive position estimates over UDP."""
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            receiver.bind(('127.0.0.1', self.port))
+        except OSError as e:
+            self.errorMessage.emit(f'Could not receive position estimates on port {self.port}: {e}')
+            receiver.close()
+            return
+        receiver.settimeout(0.05)
+        while self.running:
+            try:
+                datagram = receiver.recv(1024)
+                receiver.setblocking(False)
+                try:
+                    while True:  # Keep only the newest estimate
+                        datagram = receiver.recv(1024)
+                except BlockingIOError:
+                    pass
+                receiver.settimeout(0.05)
+            except socket.timeout:
+                continue
+            try:
+                t, x, y = parse_position(datagram)
+            except ValueError:  # Includes malformed JSON
+                continue
+            self.update(t, x, y)
+        receiver.close()
+
+    def replay(self):
+        """Feed the estimates of a recorded track at their recorded pace."""
+        track = load_track(self.track_file)
+        start = perf_counter()
+        for t, x, y in track.tolist():
+            if not self.running:
+                break
+            delay = (t - track[0, 0]) / self.speed - (perf_counter() - start)
+            if delay > 0:
+                sleep_while_running(self, delay)
+            self.update(t, x, y)
+
+    def update(self, t, x, y):
+        """Steer from one position estimate."""
+        start = perf_counter()
+        self.position = (t, x, y)
+        if self.enabled:
+            zphase = self.controller.update(x, y, t)
+            if zphase is not None:
+                self.writer.zphase = zphase
+        self.update_counter.tick()
+        self.update_time.add(perf_counter() - start)
@@ -1,9 +1,36 @@
 import numpy as np
+import threading
+from fractions import Fraction
+from math import gcd
+from time import perf_counter, monotonic_ns
 from pyqtgraph.Qt import QtCore
 import nidaqmx
 from nidaqmx.stream_writers import AnalogMultiChannelWriter
-from waves import WaveGenerator
+from waves import WaveGenerator, select_write_timing
 from misc_functions import find_ni_devices
+from alignment import ParameterHistory, shape_fields, tone_fields
+import latency
+import tracing
+from telemetry import RateCounter
+
+
+class RigParameter:
+    """Exposes one signal parameter of the active rig as a plain attribute of the SignalWriter.
+
+    The values of all rigs live in the SignalWriter.state arrays so every rig can be generated in one vectorized pass,
+    while the rest of the application keeps reading and writing e.g. `writeThread.freq` for the rig selected in the
+    parameter tree.
+    """
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj.state[self.name][obj.active_rig].item()
+
+    def __set__(self, obj, value):
+        obj.state[self.name][obj.active_rig] = value
 
 
 class SignalWriter(QtCore.QThread):
@@ -13,153 +40,730 @@ class SignalWriter(QtCore.QThread):
     by other threads as this thread simply reads them. Also, keep in mind that the __init__ method only runs once to
     establish properties and default values.
 
+    Several coil systems (rigs) can be driven at once. Each rig has its own parameter state, and every tick the field
+    of all rigs is computed in a single [N, 3, writechunksize] batch and transformed into coil signals with each rig's
+    calibration matrix in one matmul (see WaveGenerator.field_to_coils). The rigs are grouped into one NI task per
+    device. The first task is the master: its sample clock and start trigger are shared with the other tasks where
+    the hardware allows it, and its callback writes the batch to every task.
+
     Attributes:
-        funcg_name (str): name given to the NI card by the drivers
-        writechannel_list (list): list containing all of the connected channels
+        rigs (list): one dictionary per rig with its 'name', 'funcg_name', 'writechannel_list', and optionally its
+            calibration 'matrix' and 'offsets' (see SettingsWindow.rig_dict)
+        coil_counts (list): number of write channels of each rig
+        matrices (ndarray): [N, coils, 3] calibration matrices, padded with zero rows to the largest rig
+        offsets (ndarray): [N, coils] coil offsets, padded with zeros to the largest rig
+        active_rig (int): index of the rig whose parameters are exposed as vmulti, freq, camber, etc.
+        state (dict): arrays with the value of each signal parameter for every rig
+        shape (str): name of the field shape of every rig, see shapes.py
+        shape_parameters (dict): values of the shape's own parameters, e.g. the ratio of the Elliptical shape.
+            Replaced as a whole rather than updated, missing parameters take the defaults of the shape
+        tones (ndarray): [K, 4] multi-tone components of every rig, or None for a single tone, see waves.parse_tones
         funcg_rate (int): rate at which the NI DAQ card generate data
-        writechunksize (int): The QThread adds this amount of data to the buffer at once. Hard coded to be the rate
-            divided by 10.
-        zcoeff (float): used to calculate the signals, defined in detail other places
+        writechunksize (int): The QThread adds this amount of data to the buffer at once.
+        funcg_max_rate (int): the maximum rate of the function generator, cached by the DeviceRegistry
+        samples_per_period (int): target number of samples per period of the commanded frequency
+        write_latency (float): duration of one chunk in s
+        reference: the SignalReader whose sample clock is the shared clock, set by the main window
+        history (ParameterHistory): parameter snapshot of every generated chunk, stamped with its absolute sample
+            index and the time of its first sample on the shared clock
+        event_log (ParameterLog): optional binary log that gets every snapshot whose parameters differ from the
+            previous one once its chunk is on the output (see log_generated), set by the main window
+        arm_time (float): time on the shared clock of the first sample of the current arm
+        arm_uncertainty (float): uncertainty of arm_time in s, zero when the reader shares the writer's start trigger
+        sample_index (int): absolute index of the first sample of the next chunk, counted from the first start
+        callback_counter (RateCounter): rate and jitter of the add_more_data callback, for the performance panel
+        underruns (int): number of chunks that could not be written in time
+        allow_regeneration (bool): whether a steady output may be handed over to the hardware, see below
+        steady_time (float): time in s the parameters must stay unchanged before the output is regenerated
+        max_loop_time (float): longest loop in s that will be regenerated
+        regenerating (bool): whether the hardware is currently looping its buffer
+        output_on (bool): whether the field is on, toggling it ramps the field within one chunk, see below
+        gain (float): envelope of the field at the end of the last generated chunk, 0 while the output is off
+        stopping (bool): set by stop, the run loop ends once the field has been ramped down
         running (bool): used to control the state of the run loop from outside this thread
 
+    The write rate and chunk size are re-selected with waves.select_write_timing every chunk. When they change, the
+    callback only requests a re-arm, which is then done on this thread: the tasks are stopped, re-timed and restarted.
+    The queued samples the stopped tasks never generated are dropped and the phase is rewound over them (see
+    drop_queued), so the field continues from the last generated sample, after a short gap while the tasks restart.
+
+    When no parameter has changed for *steady_time*, the output is periodic. The tasks are then re-armed with an
+    integer number of periods in their buffers and regeneration allowed, so the hardware loops the buffer without
+    any callbacks (see regenerate). On the next parameter change the tasks are stopped, the phase is picked up at the
+    sample the hardware had reached and streaming resumes after a short gap in the output (see resume_streaming).
+
+    The thread is started once, when the application starts, and keeps its tasks configured and generating until it
+    is stopped. Toggle Output only sets *output_on*: the next generated chunk ramps the field from or to zero (the coil
+    offsets), so the output reacts within the buffered chunks instead of waiting for the tasks to be created. While the
+    output is off, the idle level is steady and soon handed over to the hardware.
+
     """
     errorMessage = QtCore.pyqtSignal(object)
 
+    # Signal parameters of the active rig, see RigParameter
+    vmulti = RigParameter()
+    freq = RigParameter()
+    camber = RigParameter()
+    zphase = RigParameter()
+    zcoeff = RigParameter()
+    calib_xamp = RigParameter()
+    calib_yamp = RigParameter()
+    calib_zamp = RigParameter()
+
     def __init__(self, funcg_name, writechannel_list, funcg_rate, writechunksize, zcoeff, vmulti, freq, camber, zphase,
-                 calib_xamp, calib_yamp, calib_zamp):
+                 calib_xamp, calib_yamp, calib_zamp, funcg_max_rate=8000, samples_per_period=100, write_latency=0.025,
+                 rigs=None):
         super().__init__()  # Inherit properties of a QThread
 
         # Static variables
+        if rigs is None:
+            rigs = [{'name': 'Rig 1', 'funcg_name': funcg_name, 'writechannel_list': writechannel_list}]
+        self.rigs = rigs
         self.funcg_name = funcg_name
         self.writechannel_list = writechannel_list
         self.funcg_rate = funcg_rate
         self.writechunksize = writechunksize
-        self.zcoeff = zcoeff
+        self.funcg_max_rate = funcg_max_rate
+        self.samples_per_period = samples_per_period
+        self.write_latency = write_latency
 
-        # Changing variables
-        self.vmulti = vmulti
-        self.freq = freq  # single integer
-        self.camber = camber
-        self.zphase = zphase  # single integer
+        # Changing variables, every rig starts with the same default values
+        self.active_rig = 0
+        defaults = {'vmulti': vmulti, 'freq': freq, 'camber': camber, 'zphase': zphase, 'zcoeff': zcoeff,
+                    'calib_xamp': calib_xamp, 'calib_yamp': calib_yamp, 'calib_zamp': calib_zamp}
+        self.state = {name: np.full(len(self.rigs), value, dtype=float) for name, value in defaults.items()}
+
+        self.shape = 'Rotating'  # Field shape from shapes.py, shared by all rigs so they stay in one batch
+        self.shape_parameters = {}
+        self.tones = None  # Multi-tone components, also shared by all rigs, each rig scales them with its vmulti
 
         # Calibration variables
         self.calib_mode = False  # variable to store whether in calibration mode
-        self.calib_xamp = calib_xamp
-        self.calib_yamp = calib_yamp
-        self.calib_zamp = calib_zamp
+
+        # Field to coil calibration of every rig, stacked so all rigs are transformed in one matmul
+        self.coil_counts = [len(rig['writechannel_list']) for rig in self.rigs]
+        coils = max(self.coil_counts + [3])
+        self.matrices = np.zeros([len(self.rigs), coils, 3])
+        self.offsets = np.zeros([len(self.rigs), coils])
+        for index, rig in enumerate(self.rigs):
+            count = self.coil_counts[index]
+            self.matrices[index, :count] = rig.get('matrix', np.eye(count, 3))
+            self.offsets[index, :count] = rig.get('offsets', np.zeros(count))
 
         # pre-allocate an empty output array
-        self.output = np.zeros([len(self.writechannel_list), self.writechunksize])
+        self.output = np.zeros([len(self.rigs), coils, self.writechunksize])
         self.running = False  # Variable to keep track of whether the thread is running.
 
         # Instantiate the WaveGenerator
         self.WaveGen = WaveGenerator()
 
+        # Set from the NI callback when the write timing should change, the re-arm itself happens on this thread
+        self.rearm_request = threading.Event()
+        self.pending_timing = None
+
+        # Sample clock alignment, see arm
+        self.reference = None
+        self.history = ParameterHistory(len(self.rigs))
+        self.event_log = None
+        self.logged_signature = None
+        self.unlogged = []  # History counts of the snapshots waiting to be logged, see log_generated
+        self.log_lock = threading.Lock()
+        self.arm_index = 0  # sample_index of the first sample of the current arm
+        self.arm_time = 0.0
+        self.arm_uncertainty = 0.0
+        self.sample_index = 0
+        self.queued_since_arm = 0
+        self.first_start = None
+
+        # Counters read by the performance panel
+        self.callback_counter = RateCounter()
+        self.underruns = 0
+
+        # Hardware regeneration of a steady output
+        self.allow_regeneration = True
+        self.steady_time = 1.0
+        self.max_loop_time = 10.0
+        self.regenerating = False
+        self.pending_regeneration = False
+        self.steady_state = None  # Signature of the parameters, see steady_signature
+        self.steady_chunks = 0  # Number of chunks generated with the same signature
+        self.loop_index = 0  # sample_index of the first sample of the regenerated loop
+        self.loop_length = 0
+        self.loop_rates = None  # Phase accumulator and frequencies of the loop, see phase_rates
+
+        # Output envelope, the tasks keep running while the output is off
+        self.output_on = False
+        self.gain = 0.0
+        self.ramp_end = 0  # queued_since_arm at the end of the last ramp to the idle level
+        self.stopping = False
+
+        # NI tasks and their stream writers, created when the thread is started
+        self.writeTasks = []
+        self.writers = []
+
+        # One task per device, holding the indices of the rigs on that device
+        self.task_groups = []
+        for index, rig in enumerate(self.rigs):
+            group = next((g for g in self.task_groups if g['funcg_name'] == rig['funcg_name']), None)
+            if group is None:
+                group = {'funcg_name': rig['funcg_name'], 'rig_indices': []}
+                self.task_groups.append(group)
+            group['rig_indices'].append(index)
+        self.reset_stats()
+
     def run(self):
         """Runs when the start method is called on the thread.
 
-        First, the output channels are initialized. If the thread can't, it emits an error signal. Next, it sets the
-        generation rate and mode. Other properties are set for continuous modulation of the signal.
+        First, the output channels of every task are initialized. If the thread can't, it emits an error signal. Next,
+        the timing is configured and the tasks are started (see **arm**), generating the idle level until the output
+        is turned on.
+
+        The thread then stays in a loop until running is set to False, or until the field is ramped down after a
+        call to **stop**, waiting for re-arm requests from the **add_more_data** callback. Once the loop exits, the
+        tasks are closed.
+
+        """
+        self.running = True
+        self.writeTasks = []
+        self.writers = []
+        self.regenerating = False
+        self.steady_chunks = 0
+        self.gain = 0.0  # The tasks start from the idle level
+        self.stopping = False
+
+        for group in self.task_groups:
+            writeTask = nidaqmx.Task()  # Start the task
+            self.writeTasks.append(writeTask)
+
+            # Add output channels of every rig on this device
+            for rig_index in group['rig_indices']:
+                for index, i in enumerate(self.rigs[rig_index]['writechannel_list']):
+                    channel_string = group['funcg_name'] + '/' + f'ao{i}'
+                    try:
+                        writeTask.ao_channels.add_ao_voltage_chan(channel_string)
+                    except Exception as e:
+                        if index == 0:
+                            self.errorMessage.emit(
+                                f"Could not open write channels of {self.rigs[rig_index]['name']}. Are device names "
+                                f"correct? Devices connected: {find_ni_devices()}")
+                            self.close_tasks()
+                            return
+
+            # Set more properties for continuous signal modulation
+            writeTask.out_stream.regen_mode = nidaqmx.constants.RegenerationMode.DONT_ALLOW_REGENERATION
+
+            # Initialize the writer
+            self.writers.append(AnalogMultiChannelWriter(writeTask.out_stream))
+
+        self.writeTask = self.writeTasks[0]  # The master task
+        self.funcg_rate, self.writechunksize = self.select_timing()
+        self.reset_stats()
+        if not self.arm():
+            self.close_tasks()
+            return
+
+        # Wait for re-arm requests from the callback until the output is toggled off. While the hardware regenerates,
+        # there are no callbacks and parameter changes are picked up here instead
+        while self.running:
+            self.log_generated()
+            if self.stopping and self.ramped_down():
+                break
+            if self.rearm_request.wait(timeout=0.002 if self.stopping else 0.01 if self.regenerating else 0.05):
+                self.rearm_request.clear()
+                for writeTask in self.writeTasks:
+                    writeTask.stop()
+                if self.pending_regeneration:
+                    self.pending_regeneration = False
+                    if not self.regenerate():
+                        break
+                    continue
+                self.drop_queued()  # At the old rate, before the timing changes
+                self.funcg_rate, self.writechunksize = self.pending_timing
+                if not self.arm():
+                    break
+            elif self.regenerating and self.steady_signature() != self.steady_state:
+                for writeTask in self.writeTasks:
+                    writeTask.stop()
+                self.resume_streaming()
+                if not self.arm():
+                    break
+
+        self.running = False
+        self.log_generated()
+        self.close_tasks()
+
+    def stop(self):
+        """Ramp the field down and end the run loop once the hardware has generated the ramp. Does not block."""
+        self.output_on = False
+        self.stopping = True
+
+    def stop_time(self):
+        """Upper bound in s on the time stop takes: the two queued chunks and the ramp chunk are generated first."""
+        return 3 * self.writechunksize / self.funcg_rate + 0.01
+
+    def ramped_down(self):
+        """Whether the coils are at the idle level, i.e. the end of the last ramp down has been generated."""
+        return self.gain == 0 and (self.regenerating or self.generated_samples() >= self.ramp_end)
+
+    def close_tasks(self):
+        """Close every NI task of this thread."""
+        for writeTask in self.writeTasks:
+            writeTask.close()
+
+    def arm(self):
+        """Configure the timing of the stopped writeTasks, fill their buffers and start them.
 
         The buffer size is set to be 2 times the *writechunksize* to allow for some wiggle room if a data point is a
         microsecond late.
 
-        Next, an event is registered along with the continuous generation mode that signals the **add_more_data**
-        method after every *writechunksize* values are transferred from the buffer. This is what allows this run method
-        to loop, as the writeTask never truly finishes as data points are constantly being added to the buffer.
+        The other tasks are clocked by the sample clock of the master task and wait for its start trigger. If the
+        devices can't share these signals, the tasks run on their own clocks and are kept in step by the blocking
+        writes in the master callback.
+
+        Next, an event is registered on the master task along with the continuous generation mode that signals the
+        **add_more_data** method after every *writechunksize* values are transferred from the buffer. This is what
+        keeps the output going, as the tasks never truly finish as data points are constantly being added to the
+        buffer.
 
         For the first write to the buffer, two *writechunksize* chunks are written to fill up the buffer completely.
 
+        Finally, the start of the tasks is placed on the shared clock by reading the number of samples the reader has
+        acquired right before and after the start. When the reader waits for the start trigger of this task, both
+        counts are zero on the first arm and the alignment is exact. Otherwise the midpoint is used and half the
+        difference is kept as arm_uncertainty.
+
+        Returns:
+            True if the tasks were started, False if the initial write failed
         """
-        self.running = True
-        self.writeTask = nidaqmx.Task()  # Start the task
+        self.configure_timing(2 * self.writechunksize)
+        self.reset_arm()
+        arm_count = self.history.count
 
-        # Add input channels
-        for index, i in enumerate(self.writechannel_list):
-            channel_string = self.funcg_name + '/' + f'ao{i}'
-            try:
-                self.writeTask.ao_channels.add_ao_voltage_chan(channel_string)
-            except Exception as e:
-                if index == 0:
-                    self.errorMessage.emit('Could not open write channels. Are device names correct?'
-                                           f" Devices connected: {find_ni_devices()}")
-                    return
-
-        # Set the generation rate, and buffer size.
-        self.writeTask.timing.cfg_samp_clk_timing(
-            rate=self.funcg_rate,
-            sample_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS)
-
-        # Set more properties for continuous signal modulation
-        self.writeTask.out_stream.regen_mode = nidaqmx.constants.RegenerationMode.DONT_ALLOW_REGENERATION
-        self.writeTask.out_stream.output_buf_size = 2 * self.writechunksize
-
-        # Register the listening method to add more data
+        # Register the listening method to add more data, replacing the callback of a previous arm
+        self.writeTask.register_every_n_samples_transferred_from_buffer_event(
+            sample_interval=self.writechunksize,
+            callback_method=None)
         self.writeTask.register_every_n_samples_transferred_from_buffer_event(
             sample_interval=self.writechunksize,
             callback_method=self.add_more_data)
 
-        # Initialize the writer
-        self.writer = AnalogMultiChannelWriter(self.writeTask.out_stream)
+        # Write the first set of data into the output buffers
+        try:
+            self.write(self.generate())  # Write two chunks of data to avoid interruption
+        except:
+            self.errorMessage.emit('Could not write data to the output. Is the output device name correct?'
+                                   f" Devices connected: {find_ni_devices()}")
+            return False
+
+        self.write(self.generate())  # write a second chunk to the buffers
+
+        # Start the tasks, the NI driver then continually calls add_more_data
+        self.start_tasks(arm_count)
+        return True
+
+    def configure_timing(self, buffer_size):
+        """Set the sample clock and buffer size of the stopped writeTasks, sharing the master's clock if possible.
+
+        The driver only checks the routes of the shared clock and trigger when a task is committed, so the other tasks
+        are committed here and fall back to their own clock if that fails, instead of failing to start later.
+        """
+        master = self.task_groups[0]['funcg_name']
+        for index, writeTask in enumerate(self.writeTasks):
+            shared = False
+            if index > 0:
+                try:
+                    writeTask.timing.cfg_samp_clk_timing(
+                        rate=self.funcg_rate,
+                        source=f'/{master}/ao/SampleClock',
+                        sample_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS)
+                    writeTask.triggers.start_trigger.cfg_dig_edge_start_trig(f'/{master}/ao/StartTrigger')
+                    writeTask.out_stream.output_buf_size = buffer_size
+                    writeTask.control(nidaqmx.constants.TaskMode.TASK_COMMIT)
+                    shared = True
+                except nidaqmx.DaqError as e:
+                    print(f'Could not share the sample clock of {master}: {e}')
+                    writeTask.triggers.start_trigger.disable_start_trig()
+            if not shared:
+                # Set the generation rate
+                writeTask.timing.cfg_samp_clk_timing(
+                    rate=self.funcg_rate,
+                    sample_mode=nidaqmx.constants.AcquisitionType.CONTINUOUS)
+                writeTask.out_stream.output_buf_size = buffer_size
+
+    def reset_arm(self):
+        """Zero the counters that restart with the tasks."""
+        for stats in self.task_stats:
+            stats['samples_since_arm'] = 0  # The NI sample counters restart with the task
+        self.queued_since_arm = 0
+        self.arm_index = self.sample_index
+        self.ramp_end = 0
+        self.arm_time = 0.0  # Snapshots of the prefill are stamped relative to the start, see start_tasks
+
+    def start_tasks(self, arm_count):
+        """Start the tasks, the master last as the others wait for its start trigger, and place the start on the
+        shared clock.
+
+        Args:
+            arm_count (int): history count before the prefill, its snapshots are moved onto the shared clock
+        """
+        before = self.reference_samples()
+        for writeTask in reversed(self.writeTasks):
+            writeTask.start()
+        after = self.reference_samples()
+
+        if self.reference is not None:
+            self.arm_time = (before + after) / 2 / self.reference.daq_rate
+            self.arm_uncertainty = (after - before) / 2 / self.reference.daq_rate
+        else:  # No reader, fall back to the time since the first start
+            if self.first_start is None:
+                self.first_start = perf_counter()
+            self.arm_time = perf_counter() - self.first_start
+            self.arm_uncertainty = 0.001
+        for count in range(arm_count, self.history.count):
+            self.history.records['time'][count % self.history.capacity] += self.arm_time
+
+    def steady_signature(self):
+        """Everything the generated output depends on. The output is steady while this does not change."""
+        return (self.output_on, self.gain, self.calib_mode, self.shape, tuple(sorted(self.shape_parameters.items())),
+                None if self.tones is None else self.tones.tobytes(), self.funcg_rate,
+                b''.join(values.tobytes() for values in self.state.values()))
+
+    def periodic_length(self):
+        """The shortest buffer holding an integer number of periods of every generated frequency and at least two
+        chunks, or None if the frequencies are not exact fractions or the loop would exceed *max_loop_time*."""
+        if not self.output_on and self.gain == 0:
+            freqs = []  # The idle level is constant
+        elif self.calib_mode:
+            freqs = [20]  # generate_calib_waves default
+        elif self.tones is not None:
+            freqs = self.tones[:, 1]
+        else:
+            freqs = self.state['freq']
+
+        length = 1
+        for freq in np.abs(freqs):
+            fraction = Fraction(float(freq)).limit_denominator(1000)
+            if abs(float(fraction) - freq) > 1e-9:
+                return None
+            samples_per_period = (fraction / self.funcg_rate).denominator  # Samples for an integer number of periods
+            length = length * samples_per_period // gcd(length, samples_per_period)
+        length *= -(-2 * self.writechunksize // length)  # Round up to two chunks
+        if length > self.max_loop_time * self.funcg_rate:
+            return None
+        return length
+
+    def phase_rates(self):
+        """The name of the WaveGenerator phase accumulator of the current output and its angular frequencies."""
+        if self.calib_mode:
+            return 'calib_phase', 2 * np.pi * 20 * np.ones(len(self.rigs))
+        if self.tones is not None:
+            return 'tone_phase', 2 * np.pi * self.tones[:, 1]
+        return 'phase', 2 * np.pi * self.state['freq']  # A new array, later changes of the state don't affect it
+
+    def advance_phases(self, n, rates=None):
+        """Move a phase accumulator by n samples, negative to rewind.
+
+        Args:
+            n (int): number of samples
+            rates (tuple): the accumulator and angular frequencies from phase_rates, by default those of the current
+                output
+        """
+        accumulator, ω = self.phase_rates() if rates is None else rates
+        W = self.WaveGen
+        setattr(W, accumulator, W.advance(getattr(W, accumulator), ω, self.funcg_rate, n)[1])
+
+    def generated_samples(self):
+        """Samples the stopped master task has generated since it was started."""
+        try:
+            return self.writeTask.out_stream.total_samp_per_chan_generated
+        except nidaqmx.DaqError:
+            return self.queued_since_arm
+
+    def drop_queued(self):
+        """Rewind the phase and sample index of the stopped tasks over the samples that were queued but never
+        generated, and forget their parameter snapshots, so the next arm continues from the last generated sample.
+        Must be called before the timing or the parameters the queued chunks were generated with change."""
+        self.log_generated()
+        discarded = self.queued_since_arm - self.generated_samples()
+        self.advance_phases(-discarded)
+        self.sample_index -= discarded
+        self.history.truncate(self.sample_index)
+        with self.log_lock:
+            self.unlogged = [count for count in self.unlogged if count < self.history.count]
+
+    def log_generated(self):
+        """Append the waiting snapshots whose chunk has started on the output to the event log.
+
+        Snapshots are only logged once their chunk is being generated: before the tasks are started, the snapshots of
+        the prefill are not yet on the shared clock (see start_tasks), and queued chunks may still be dropped by a
+        re-arm (see drop_queued). Logging them late keeps the times in the log in order.
+        """
+        event_log = self.event_log
+        with self.log_lock:
+            if not self.unlogged:
+                return
+            if event_log is None:
+                self.unlogged = []
+                return
+            generated = self.arm_index + self.generated_samples()
+            records = self.history.records
+            while self.unlogged:
+                record = records[self.unlogged[0] % self.history.capacity]
+                if record['sample_index'] >= generated:
+                    break
+                event_log.append(**{name: record[name] for name in records.dtype.names})
+                self.unlogged.pop(0)
+
+    def regenerate(self):
+        """Re-arm the stopped tasks to loop an integer number of periods of the current output in hardware.
+
+        The samples that were queued but never generated are dropped (see drop_queued), so the loop continues with
+        the phase the output stopped at. The parameters may have changed since the callback requested regeneration,
+        so the loop is sized again here. If the output is no longer periodic, the tasks are re-armed for streaming.
+
+        Returns:
+            True if the tasks were started, False if the write failed
+        """
+        self.drop_queued()
+
+        self.loop_length = self.periodic_length()
+        self.steady_state, self.steady_chunks = self.steady_signature(), 0
+        if self.loop_length is None:
+            return self.arm()
+        self.loop_index = self.sample_index
+        self.loop_rates = self.phase_rates()  # The parameters may have changed by the time the loop is left
+        chunksize, self.writechunksize = self.writechunksize, self.loop_length
+        try:
+            for writeTask in self.writeTasks:
+                writeTask.out_stream.regen_mode = nidaqmx.constants.RegenerationMode.ALLOW_REGENERATION
+            self.configure_timing(self.loop_length)
+            self.reset_arm()
+            arm_count = self.history.count
+            self.writeTask.register_every_n_samples_transferred_from_buffer_event(
+                sample_interval=chunksize,
+                callback_method=None)
+            self.write(self.generate())
+        except nidaqmx.DaqError as e:
+            self.errorMessage.emit(f'Could not switch to hardware regeneration: {e}')
+            return False
+        finally:
+            self.writechunksize = chunksize
+
+        self.start_tasks(arm_count)
+        self.regenerating = True
+        return True
+
+    def resume_streaming(self):
+        """Leave regeneration after the tasks were stopped, continuing the phase from the last generated sample.
+
+        This is called once the parameters have already changed, so the phase is advanced with the accumulator and
+        frequencies of the loop that was generated. The output pauses while the tasks are re-armed.
+        """
+        generated = self.generated_samples()
+        # The loop holds whole periods, so only the remainder counts
+        self.advance_phases(generated % self.loop_length, self.loop_rates)
+        self.sample_index = self.loop_index + generated
+        for writeTask in self.writeTasks:
+            writeTask.out_stream.regen_mode = nidaqmx.constants.RegenerationMode.DONT_ALLOW_REGENERATION
+        self.regenerating = False
+        self.steady_chunks = 0
+        self.funcg_rate, self.writechunksize = self.select_timing()
+
+    def reference_samples(self):
+        """Number of samples acquired by the reference reader, or 0 without one."""
+        if self.reference is None:
+            return 0
+        try:
+            return self.reference.acquired_samples()
+        except nidaqmx.DaqError:
+            return 0
+
+    def generate(self):
+        """Generate the next chunk of output for every rig according to the current parameters.
+
+        The calibration waves are coil voltages already, so they skip the calibration matrix and only drive the first
+        three coils of each rig.
+
+        Returns:
+            a [N, coils, writechunksize] array
+        """
+        state = self.state
+        snapshot = dict(
+            sample_index=self.sample_index,
+            time=self.arm_time + self.queued_since_arm / self.funcg_rate,
+            monotonic_ns=monotonic_ns(),
+            funcg_rate=self.funcg_rate,
+            calib_mode=self.calib_mode,
+            vmulti=state['vmulti'], freq=state['freq'], camber=state['camber'], zphase=state['zphase'],
+            zcoeff=state['zcoeff'],
+            phase=self.WaveGen.calib_phase if self.calib_mode else self.WaveGen.phase,
+            **shape_fields(self.shape, self.shape_parameters),
+            **tone_fields(self.tones, self.WaveGen.tone_phase))
+        self.history.append(**snapshot)
+        if self.event_log is not None:
+            signature = self.steady_signature()
+            if signature != self.logged_signature:
+                self.logged_signature = signature
+                with self.log_lock:
+                    self.unlogged.append(self.history.count - 1)
+        if latency.probe is not None and latency.probe.pending('generate'):
+            self.mark_latency()
+        self.sample_index += self.writechunksize
+        self.queued_since_arm += self.writechunksize
 
         if not self.calib_mode:
             self.output = self.WaveGen.generate_waves(
                 funcg_rate=self.funcg_rate,
                 writechunksize=self.writechunksize,
-                vmulti=self.vmulti,
-                freq=self.freq,
-                camber=self.camber,
-                zphase=self.zphase,
-                zcoeff=self.zcoeff)
+                vmulti=state['vmulti'],
+                freq=state['freq'],
+                camber=state['camber'],
+                zphase=state['zphase'],
+                zcoeff=state['zcoeff'],
+                matrix=self.matrices,
+                offsets=self.offsets,
+                shape=self.shape,
+                shape_parameters=self.shape_parameters,
+                tones=self.tones)
         elif self.calib_mode:
-            self.output = self.WaveGen.generate_calib_waves(
+            self.output = np.zeros([len(self.rigs), self.matrices.shape[1], self.writechunksize])
+            self.output[:, :3] = self.WaveGen.generate_calib_waves(
                 funcg_rate=self.funcg_rate,
                 writechunksize=self.writechunksize,
-                calib_xamp=self.calib_xamp,
-                calib_yamp=self.calib_yamp,
-                calib_zamp=self.calib_zamp
+                calib_xamp=state['calib_xamp'],
+                calib_yamp=state['calib_yamp'],
+                calib_zamp=state['calib_zamp']
             )
 
-        # Write the first set of data into the output buffer
-        try:
-            self.writer.write_many_sample(data=self.output)  # Write two chunks of beginning data to avoid interruption
-        except:
-            self.errorMessage.emit('Could not write data to the output. Is the output device name correct?'
-                                   f" Devices connected: {find_ni_devices()}")
-            return
+        # Ramp the field from or to zero over this chunk when the output was toggled
+        target = 1.0 if self.output_on else 0.0
+        if self.gain != 1.0 or target != 1.0:
+            idle = self.offsets[:, :, np.newaxis]
+            envelope = np.linspace(self.gain, target, self.writechunksize + 1)[1:]
+            self.output = idle + envelope * (self.output - idle)
+            if target == 0 and self.gain != 0:
+                self.ramp_end = self.queued_since_arm
+            self.gain = target
+        return self.output
 
-        self.writer.write_many_sample(data=self.output)  # write a second chunk to the buffer
+    def mark_latency(self):
+        """Stamp the pending latency event as generated, and estimate when this chunk reaches the coils from the
+        number of samples still queued ahead of it."""
+        now = perf_counter()
+        generated = 0
+        if self.writeTasks:
+            try:
+                generated = self.writeTask.out_stream.total_samp_per_chan_generated
+            except (nidaqmx.DaqError, AttributeError):  # Not started yet
+                pass
+        latency.probe.mark('generate', now)
+        latency.probe.mark('output', now + max(self.queued_since_arm - generated, 0) / self.funcg_rate)
 
-        # Start the task, which will hold the thread at this location, continually calling add_more_data
-        self.writeTask.start()
+    def write(self, batch):
+        """Write the rows of a generated batch to the task of each device and keep the per-device statistics.
 
+        Args:
+            batch: a [N, coils, writechunksize] array from generate
+        """
+        for group, writer, stats in zip(self.task_groups, self.writers, self.task_stats):
+            start = perf_counter()
+            # Drop the padding rows, concatenate makes the C-contiguous copy NI requires
+            data = np.concatenate([batch[i, :self.coil_counts[i]] for i in group['rig_indices']])
+            writer.write_many_sample(data=data)
+            stats['write_time'] += perf_counter() - start
+            stats['samples_written'] += batch.shape[-1]
+            stats['samples_since_arm'] += batch.shape[-1]
+
+    def max_commanded_freq(self):
+        """The highest frequency in Hz that is currently being generated on any rig."""
+        if self.calib_mode:
+            return 20  # generate_calib_waves default
+        if self.tones is not None:
+            return np.max(np.abs(self.tones[:, 1]))
+        return np.max(np.abs(self.state['freq']))
+
+    def select_timing(self):
+        """Choose the write rate and chunk size for the current parameters, see waves.select_write_timing."""
+        return select_write_timing(
+            max_freq=self.max_commanded_freq(),
+            max_rate=self.funcg_max_rate,
+            samples_per_period=self.samples_per_period,
+            latency=self.write_latency,
+            current_rate=self.funcg_rate)
+
+    def reset_stats(self):
+        """Zero the per-device counters used by rig_stats."""
+        self.task_stats = [{'samples_written': 0, 'samples_since_arm': 0, 'write_time': 0.0} for _ in self.task_groups]
+        self.last_stats = [(perf_counter(), 0, 0.0) for _ in self.task_groups]
+
+    def rig_stats(self):
+        """Report the throughput and latency of every rig since the last call.
+
+        The latency is the time a sample written now waits in the buffer before it is generated, plus the time
+        taken by the write itself.
+
+        Returns:
+            a list with one dictionary per rig: 'name', 'rate' in samples/s, 'buffer_latency' and 'write_time' in s
+        """
+        report = []
+        now = perf_counter()
+        for index, (group, stats) in enumerate(zip(self.task_groups, self.task_stats)):
+            last_time, last_samples, last_write_time = self.last_stats[index]
+            samples = stats['samples_written'] - last_samples
+            writes = max(samples / max(self.writechunksize, 1), 1)
+            rate = samples / (now - last_time)
+            self.last_stats[index] = (now, stats['samples_written'], stats['write_time'])
+
+            buffer_latency = 0.0
+            if self.running and not self.regenerating and index < len(self.writeTasks):
+                try:
+                    generated = self.writeTasks[index].out_stream.total_samp_per_chan_generated
+                    buffer_latency = (stats['samples_since_arm'] - generated) / self.funcg_rate
+                except nidaqmx.DaqError:  # The task is being re-armed or closed
+                    pass
+
+            for rig_index in group['rig_indices']:
+                report.append({
+                    'name': self.rigs[rig_index]['name'],
+                    'rate': rate,
+                    'buffer_latency': buffer_latency,
+                    'write_time': (stats['write_time'] - last_write_time) / writes,
+                })
+        return report
+
+    @tracing.traced('writer callback')
     def add_more_data(self, task_handle, every_n_samples_event_type, number_of_samples, callback_data):
-        """This method adds data to the buffer when it is called.
+        """This method adds data to the buffers when it is called.
 
-        If running is false, it instead closes the NI writeTask.
+        If the commanded signal needs a different write rate, a re-arm is requested from the run loop. The current
+        timing is kept streaming until then. If running is false, nothing is written and the run loop closes the tasks.
 
         """
         if self.running is True:
-            if not self.calib_mode:
-                self.output = self.WaveGen.generate_waves(
-                    funcg_rate=self.funcg_rate,
-                    writechunksize=self.writechunksize,
-                    vmulti=self.vmulti,
-                    freq=self.freq,
-                    camber=self.camber,
-                    zphase=self.zphase,
-                    zcoeff=self.zcoeff)
-            elif self.calib_mode:
-                self.output = self.WaveGen.generate_calib_waves(
-                    funcg_rate=self.funcg_rate,
-                    writechunksize=self.writechunksize,
-                    calib_xamp=self.calib_xamp,
-                    calib_yamp=self.calib_yamp,
-                    calib_zamp=self.calib_zamp
-                )
-            self.writer.write_many_sample(data=self.output)
+            self.callback_counter.tick()
+            self.log_generated()
+            timing = self.select_timing()
+            if timing != (self.funcg_rate, self.writechunksize) and not self.rearm_request.is_set():
+                self.pending_timing = timing
+                self.rearm_request.set()
 
-        else:
-            self.writeTask.close()
+            # Hand a steady output over to the hardware
+            signature = self.steady_signature()
+            if signature == self.steady_state:
+                self.steady_chunks += 1
+            else:
+                self.steady_state, self.steady_chunks = signature, 0
+            if (self.allow_regeneration and not self.rearm_request.is_set()
+                    and self.steady_chunks * self.writechunksize >= self.steady_time * self.funcg_rate
+                    and self.periodic_length() is not None):
+                self.pending_regeneration = True
+                self.rearm_request.set()
+
+            try:
+                self.write(self.generate())
+            except nidaqmx.DaqError as e:  # The tasks are being stopped by a re-arm, or the chunk was too late
+                if not self.rearm_request.is_set():
+                    self.underruns += 1
+                print(str(e))
 
         return 0
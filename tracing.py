@@ -0,0 +1,169 @@
+import functools
+import json
+import os
+import threading
+from time import perf_counter_ns
+import numpy as np
+from pyqtgraph.Qt import QtCore
+
+enabled = False  # Spans are only recorded while this is True, see set_enabled
+_capacity = 65536  # Ring size of threads that start recording
+
+_names = []  # Span names, spans store an index into this list
+_name_ids = {}
+_rings = []  # The SpanRing of every thread that recorded a span
+_local = threading.local()
+_lock = threading.Lock()  # Only taken when a new name or thread shows up
+
+
+class SpanRing:
+    """A preallocated ring buffer of the timing spans recorded by one thread.
+
+    Each thread gets its own ring, so recording a span never takes a lock. Once the ring is full the oldest spans are
+    overwritten.
+
+    Attributes:
+        starts, ends (ndarray): perf_counter_ns timestamps of each span
+        name_ids (ndarray): index of the span name in the module level name list
+        count (int): total number of spans recorded by the thread
+    """
+    def __init__(self, thread_id, thread_name, capacity):
+        self.thread_id = thread_id
+        self.thread_name = thread_name
+        self.starts = np.zeros(capacity, dtype=np.int64)
+        self.ends = np.zeros(capacity, dtype=np.int64)
+        self.name_ids = np.zeros(capacity, dtype=np.int32)
+        self.capacity = capacity
+        self.count = 0
+
+    def record(self, name_id, start, end):
+        position = self.count % self.capacity
+        self.starts[position] = start
+        self.ends[position] = end
+        self.name_ids[position] = name_id
+        self.count += 1
+
+
+class Span:
+    """Context manager recording the time spent inside it, see span()."""
+    __slots__ = ('name_id', 'start')
+
+    def __init__(self, name_id):
+        self.name_id = name_id
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        _ring().record(self.name_id, self.start, perf_counter_ns())
+        return False
+
+
+class _NullSpan:
+    """Stand-in for Span while tracing is disabled."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def set_enabled(on, capacity=65536):
+    """Turn span recording on or off.
+
+    Args:
+        on (bool): whether to record spans
+        capacity (int): size of the ring of each thread that starts recording after this call
+    """
+    global enabled, _capacity
+    _capacity = capacity
+    enabled = on
+
+
+def _name_id(name):
+    name_id = _name_ids.get(name)
+    if name_id is None:
+        with _lock:
+            name_id = _name_ids.setdefault(name, len(_names))
+            if name_id == len(_names):
+                _names.append(name)
+    return name_id
+
+
+def _ring():
+    ring = getattr(_local, 'ring', None)
+    if ring is None:
+        # Name QThreads after their class (SignalWriter, ...), others such as the NI callback thread by Python's name
+        thread = threading.current_thread()
+        name = type(QtCore.QThread.currentThread()).__name__
+        if name == 'QThread':
+            name = 'GUI' if thread is threading.main_thread() else thread.name
+        ring = SpanRing(thread.ident, name, _capacity)
+        with _lock:
+            _rings.append(ring)
+        _local.ring = ring
+    return ring
+
+
+def span(name):
+    """Time a block of code, e.g.
+
+        with tracing.span('reader chunk'):
+            ...
+
+    Returns a shared no-op context manager while tracing is disabled.
+    """
+    if not enabled:
+        return _null_span
+    return Span(_name_id(name))
+
+
+def traced(name):
+    """Decorator timing every call of a function as a span called `name`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _ring().record(_name_id(name), start, perf_counter_ns())
+        return wrapper
+    return decorator
+
+
+def export_chrome_trace(path):
+    """Write every recorded span to a Chrome trace / Perfetto JSON file.
+
+    Open the file in chrome://tracing or https://ui.perfetto.dev to see the spans of every thread on one timeline.
+
+    Args:
+        path (str): file to write
+
+    Returns:
+        the number of spans written
+    """
+    pid = os.getpid()
+    events = []
+    with _lock:
+        rings = list(_rings)
+        names = list(_names)
+
+    for ring in rings:
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': ring.thread_id,
+                       'args': {'name': ring.thread_name}})
+        n = min(ring.count, ring.capacity)
+        starts, ends, name_ids = ring.starts[:n].copy(), ring.ends[:n].copy(), ring.name_ids[:n].copy()
+        for start, end, name_id in zip(starts.tolist(), ends.tolist(), name_ids.tolist()):
+            events.append({'name': names[name_id], 'ph': 'X', 'pid': pid, 'tid': ring.thread_id,
+                           'ts': start / 1000, 'dur': (end - start) / 1000})
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return sum(1 for event in events if event['ph'] == 'X')
@@ -1,23 +1,124 @@
+import ast
 import numpy as np
+import shapes
+
+# Write rates the SignalWriter can pick from. Doubling steps keep the number of task re-arms low when the frequency is
+# swept, while never giving less than the target samples per period.
+RATE_LADDER = (1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000, 256000)
+MAX_TONES = 8  # Multi-tone components, fixed so every parameter snapshot has the same width (see alignment.py)
+
+
+def select_write_timing(max_freq, max_rate, samples_per_period=100, latency=0.025, current_rate=None):
+    """Choose the write rate and chunk size from the signal requirements.
+
+    The rate is the lowest rate on the RATE_LADDER giving at least *samples_per_period* samples per period of the
+    highest commanded frequency, limited by the maximum rate of the device. The chunk size follows from the latency
+    goal, i.e. each chunk covers *latency* seconds, so the refresh rate of the signal does not depend on the write rate.
+
+    To avoid re-arming the writer back and forth around a rung of the ladder, the current rate is kept as long as it
+    still satisfies the requirement and is at most one rung above the ideal rate.
+
+    Args:
+        max_freq (float): highest frequency in Hz that will be generated
+        max_rate (float): maximum output rate of the function generator in samples per second
+        samples_per_period (int): target number of samples per period of max_freq
+        latency (float): duration of one chunk in s
+        current_rate (int): the rate currently in use, if any
+
+    Returns:
+        funcg_rate, writechunksize
+    """
+    needed = abs(max_freq) * samples_per_period
+    rungs = [rate for rate in RATE_LADDER if rate <= max_rate] or [int(max_rate)]
+    funcg_rate = next((rate for rate in rungs if rate >= needed), rungs[-1])
+
+    if current_rate in rungs and needed <= current_rate <= 2 * funcg_rate:
+        funcg_rate = current_rate
+
+    writechunksize = max(int(round(funcg_rate * latency)), 1)
+    return funcg_rate, writechunksize
+
+
+def parse_tones(text):
+    """Parse the multi-tone setting of the parameter tree.
+
+    Args:
+        text (str): a list of (weight, frequency [Hz], camber [°], zphase [°]) tuples, one per tone, e.g.
+            "[(1, 10, 60, 270), (0.5, 35, 45, 90)]". An empty list turns the multi-tone mode off.
+
+    Returns:
+        a [K, 4] array of the tones, or None for an empty list
+
+    Raises:
+        ValueError: if the text is not such a list, or has more than MAX_TONES tones
+    """
+    try:
+        tones = np.array(ast.literal_eval(text or '[]'), dtype=float)
+    except (SyntaxError, TypeError, ValueError):
+        raise ValueError(f'Tones must be a list of (weight, frequency, camber, zphase) tuples, not {text}')
+    if tones.size == 0:
+        return None
+    if tones.ndim != 2 or tones.shape[1] != 4:
+        raise ValueError(f'Tones must be a list of (weight, frequency, camber, zphase) tuples, not {text}')
+    if len(tones) > MAX_TONES:
+        raise ValueError(f'At most {MAX_TONES} tones can be superimposed')
+    if not np.any(tones[:, 0]):
+        raise ValueError('At least one tone needs a weight other than 0')
+    return tones
+
 
 class WaveGenerator:
     """A class containing the wave generating functions.
 
+    The phase of each wave is accumulated from chunk to chunk, so consecutive chunks join up without a glitch even
+    when the frequency, write rate or chunk size changes in between.
+
+    Every signal parameter may either be a single number or an array with one value per coil system (rig). With
+    arrays of length N, all rigs are computed at once in a single vectorized pass and the output has the shape
+    [N, 3, writechunksize] instead of [3, writechunksize].
+
     Attributes:
-        last_freq (float): a variable which stores the last frequency generated. This allows the wave generator
-            to "know" if it needs to start the next wave chunk a portion through the wave
-        waves_per_chunk (float): How many Hz happens in the writechunksize chunk.
-        start_frac (float): The fraction of wave that was generated on the last chunk
+        phase (float or ndarray): phase in radians of the rotating field at the start of the next chunk, per rig
+        calib_phase (float or ndarray): phase in radians of the calibration waves at the start of the next chunk
+        tone_phase (float or ndarray): phase in radians of each multi-tone component at the start of the next chunk
     """
     def __init__(self):
-        self.last_freq = 20
-        self.start_frac = 0.0
-        self.counter = 0
-        self.calib_counter = 0
+        self.phase = 0.0
+        self.calib_phase = 0.0
+        self.tone_phase = 0.0
+
+    def reset(self):
+        """Start the next chunk of every wave at a phase of 0."""
+        self.phase = 0.0
+        self.calib_phase = 0.0
+        self.tone_phase = 0.0
+
+    def advance(self, phase, ω, funcg_rate, writechunksize):
+        """Return the phase of each sample in a chunk and the phase at the start of the next chunk.
+
+        Args:
+            phase (float or ndarray): phase in radians at the start of this chunk
+            ω (float or ndarray): angular frequency in rad/s
+            funcg_rate : the rate at which samples are written from the function generator
+            writechunksize : chunk size of signal to be calculated
 
-    def generate_waves(self, funcg_rate, writechunksize, vmulti, freq, camber, zphase, zcoeff):
+        Returns:
+            t: array of the phase of each sample, shape [..., writechunksize], next_phase: the phase to start the next
+            chunk with, shape of ω
         """
-        Given all signal parameters, a chunk of signal will be calculated and output.
+        ω = np.asarray(ω, dtype=float)
+        if np.shape(phase) != ω.shape:  # The number of rigs changed, start over
+            phase = np.zeros(ω.shape)
+
+        t = np.asarray(phase)[..., None] + ω[..., None] * np.arange(writechunksize) / funcg_rate
+        next_phase = (phase + ω * writechunksize / funcg_rate) % (2 * np.pi)
+        return t, next_phase
+
+    def generate_field(self, funcg_rate, writechunksize, vmulti, freq, camber, zphase, shape='Rotating',
+                       shape_parameters=None):
+        """
+        Given the field parameters, calculate a chunk of the desired field vector of the rotating field, or of another
+        shape from the registry in shapes.py.
 
         Args:
             funcg_rate : the rate at which samples are written from the function generator
@@ -26,59 +127,137 @@ class WaveGenerator:
             freq : frequency of wave in Hz
             camber : camber angle of field
             zphase : direction of the lowest(?) z point in the field
-            zcoeff : a coefficient to account for zcoils being assymetric in a setup
+            shape : name of the field shape, see shapes.py
+            shape_parameters : values of the shape's own parameters, the defaults of the shape for those missing
 
         Returns:
-            a [3,writechunksize] array of signal data
+            a [3,writechunksize] array of the x, y and z field, or [N,3,writechunksize] for N rigs
         """
-        # Redefine input variables into shorthand characters
-        I = vmulti
+        # Redefine input variables into shorthand characters, as columns so they broadcast against the samples
+        I = np.asarray(vmulti, dtype=float)[..., None]
         f = freq
-        ω = 2 * np.pi * f
-        θ = np.radians(camber)
-        ζ = np.radians(zphase)
+        ω = 2 * np.pi * np.asarray(f, dtype=float)
+        θ = np.radians(camber)[..., None]
+        ζ = np.radians(zphase)[..., None]
+
+        t, self.phase = self.advance(self.phase, ω, funcg_rate, writechunksize)
+
+        # The kernel is compiled once per shape and parameters and cached, constant components are broadcast to full
+        # chunks
+        kernel = shapes.get(shape).kernel(**(shape_parameters or {}))
+        field = np.stack(np.broadcast_arrays(*kernel(t, I, θ, ζ)), axis=-2)
 
-        # Calculate some needed variables for the rest
-        chunkspersec = funcg_rate // writechunksize
-        waves_per_chunk = f / chunkspersec
-        start_frac = waves_per_chunk % 1
+        return field
 
-        t = np.linspace(start=0, stop=ω / chunkspersec, num=writechunksize)
+    def generate_multitone_field(self, funcg_rate, writechunksize, vmulti, tones, shape='Rotating',
+                                 shape_parameters=None):
+        """
+        Calculate a chunk of the superposition of K fields with different frequencies, cambers and headings, e.g. to
+        address several swarms at once.
 
-        if self.last_freq != f:  # Then we can start generating waves as normal, starting from y=0
-            self.counter = 0
-            self.last_freq = f
+        All K components are computed in one batch of shape [..., K, 3, writechunksize] and summed, so the cost grows
+        linearly with K. Each component keeps its own phase accumulator. The weights are normalized by the sum of
+        their magnitudes, so the amplitude of the superposition never exceeds vmulti.
 
-        elif self.last_freq == f:
-            self.counter += 1
+        Args:
+            funcg_rate : the rate at which samples are written from the function generator
+            writechunksize : chunk size of signal to be calculated
+            vmulti : voltage multiplier, one per rig
+            tones : a [K, 4] array of the (weight, frequency [Hz], camber [°], zphase [°]) of each component, see
+                parse_tones
+            shape : name of the field shape of every component, see shapes.py
+            shape_parameters : values of the shape's own parameters, see generate_field
 
-        freq_shifter = self.counter * (2 * np.pi * start_frac)
+        Returns:
+            a [3,writechunksize] array of the x, y and z field, or [N,3,writechunksize] for N rigs
+        """
+        tones = np.asarray(tones, dtype=float)
+        weights = tones[..., 0] / np.sum(np.abs(tones[..., 0]), axis=-1, keepdims=True)
 
-        output = np.array([
-            I * (np.sin(ζ) * np.cos(t + freq_shifter) - np.sin(θ) * np.cos(ζ) * np.sin(t + freq_shifter)),  # x-coils
-            -I * (np.cos(ζ) * np.cos(t + freq_shifter) + np.sin(θ) * np.sin(ζ) * np.sin(t + freq_shifter)),  # y-coils
-            zcoeff * I * (np.cos(θ) * np.sin(t + freq_shifter))  # z-coils
-        ])
+        # Components along the second to last axis, samples along the last
+        I = (np.asarray(vmulti, dtype=float)[..., None] * weights)[..., None]
+        ω = 2 * np.pi * tones[..., 1]
+        θ = np.radians(tones[..., 2])[..., None]
+        ζ = np.radians(tones[..., 3])[..., None]
 
-        return output
+        t, self.tone_phase = self.advance(self.tone_phase, ω, funcg_rate, writechunksize)
 
-    def generate_calib_waves(self, funcg_rate, writechunksize, calib_xamp, calib_yamp, calib_zamp, f=20):
-        """ Generate three sin waves for calibration at 20Hz, 90 degrees out of phase from all."""
+        kernel = shapes.get(shape).kernel(**(shape_parameters or {}))
+        components = np.stack(np.broadcast_arrays(*kernel(t, I, θ, ζ)), axis=-2)  # [..., K, 3, writechunksize]
+        return components.sum(axis=-3)
 
-        ω = 2 * np.pi * f
+    @staticmethod
+    def field_to_coils(field, zcoeff=1, matrix=None, offsets=None):
+        """Transform desired field vectors into coil signals with a calibration matrix.
 
-        chunkspersec = funcg_rate // writechunksize
-        waves_per_chunk = f / chunkspersec  # 20 / 100 = 1/5
-        start_frac = waves_per_chunk % 1
+        Row i of the matrix holds the contribution of the x, y and z field to coil i, which covers the gain of each
+        coil, crosstalk between axes and rigs with more than three coils. The z-coefficient scales the z column, so
+        with the default identity matrix it behaves as it always has. The whole chunk is transformed in one matmul.
 
-        freq_shifter = self.calib_counter * (2 * np.pi * start_frac)
-        self.calib_counter += 1
+        Args:
+            field: a [3,writechunksize] or [N,3,writechunksize] array from generate_field
+            zcoeff: a coefficient to account for zcoils being assymetric in a setup, one per rig
+            matrix: a [coils,3] or [N,coils,3] calibration matrix, defaults to the identity matrix
+            offsets: a [coils] or [N,coils] array of constant offsets added to each coil
 
-        t = np.linspace(start=0, stop=ω / chunkspersec, num=writechunksize)
-        output = np.array([
-            calib_xamp * np.cos(t + freq_shifter),
-            calib_yamp * np.cos(t + (np.pi / 2) + freq_shifter),
-            calib_zamp * np.cos(t + np.pi + freq_shifter)
-        ])
+        Returns:
+            a [coils,writechunksize] or [N,coils,writechunksize] array of coil signals
+        """
+        if matrix is None:
+            matrix = np.eye(3)
+        zcoeff = np.asarray(zcoeff, dtype=float)
+        column_gains = np.stack([np.ones_like(zcoeff), np.ones_like(zcoeff), zcoeff], axis=-1)
+
+        output = np.matmul(matrix * column_gains[..., None, :], field)
+        if offsets is not None:
+            output += np.asarray(offsets)[..., None]
         return output
 
+    def generate_waves(self, funcg_rate, writechunksize, vmulti, freq, camber, zphase, zcoeff, matrix=None,
+                       offsets=None, shape='Rotating', tones=None, shape_parameters=None):
+        """
+        Given all signal parameters, a chunk of signal will be calculated and output.
+
+        Args:
+            funcg_rate : the rate at which samples are written from the function generator
+            writechunksize : chunk size of signal to be calculated
+            vmulti : voltage multiplier
+            freq : frequency of wave in Hz
+            camber : camber angle of field
+            zphase : direction of the lowest(?) z point in the field
+            zcoeff : a coefficient to account for zcoils being assymetric in a setup
+            matrix : optional calibration matrix, see field_to_coils
+            offsets : optional coil offsets, see field_to_coils
+            shape : name of the field shape, see shapes.py
+            tones : optional [K, 4] array of multi-tone components, which replace freq, camber and zphase, see
+                generate_multitone_field
+            shape_parameters : values of the shape's own parameters, see generate_field
+
+        Returns:
+            a [3,writechunksize] array of signal data, or [N,coils,writechunksize] for N rigs
+        """
+        if tones is None:
+            field = self.generate_field(funcg_rate, writechunksize, vmulti, freq, camber, zphase, shape,
+                                        shape_parameters)
+        else:
+            field = self.generate_multitone_field(funcg_rate, writechunksize, vmulti, tones, shape, shape_parameters)
+        return self.field_to_coils(field, zcoeff, matrix, offsets)
+
+    def generate_calib_waves(self, funcg_rate, writechunksize, calib_xamp, calib_yamp, calib_zamp, f=20):
+        """ Generate three sin waves for calibration at 20Hz, 90 degrees out of phase from all.
+
+        The amplitudes may be arrays with one value per rig, see generate_waves.
+        """
+        calib_xamp = np.asarray(calib_xamp, dtype=float)[..., None]
+        calib_yamp = np.asarray(calib_yamp, dtype=float)[..., None]
+        calib_zamp = np.asarray(calib_zamp, dtype=float)[..., None]
+
+        ω = 2 * np.pi * f * np.ones(calib_xamp.shape[:-1])
+        t, self.calib_phase = self.advance(self.calib_phase, ω, funcg_rate, writechunksize)
+
+        output = np.stack([
+            calib_xamp * np.cos(t),
+            calib_yamp * np.cos(t + (np.pi / 2)),
+            calib_zamp * np.cos(t + np.pi)
+        ], axis=-2)
+        return output